@@ -0,0 +1,275 @@
+import os
+import time
+import threading
+import contextvars
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from token_utils import estimate_message_tokens, estimate_tokens
+from deadline import check_deadline
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+@dataclass
+class TurnBudget:
+    max_tokens: Optional[int] = None
+    max_calls: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "TurnBudget":
+        max_tokens = os.getenv("TURN_MAX_TOKENS")
+        max_calls = os.getenv("TURN_MAX_CALLS")
+        return cls(
+            max_tokens=int(max_tokens) if max_tokens else None,
+            max_calls=int(max_calls) if max_calls else None,
+        )
+
+
+@dataclass
+class LLMCallRecord:
+    role: str
+    agent: Optional[str]
+    model: Optional[str]
+    prompt_tokens: int
+    completion_tokens: int
+    latency: float
+    estimated: bool
+    error: Optional[str] = None
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@dataclass
+class UsageSummary:
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    by_role: dict = field(default_factory=lambda: defaultdict(lambda: {"calls": 0, "tokens": 0, "latency": 0.0}))
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, record: LLMCallRecord):
+        self.calls += 1
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.latency += record.latency
+        key = record.role if record.agent is None else f"{record.role}:{record.agent}"
+        self.by_role[key]["calls"] += 1
+        self.by_role[key]["tokens"] += record.total_tokens
+        self.by_role[key]["latency"] += record.latency
+
+    def format(self) -> str:
+        roles = ", ".join(
+            f"{k} {v['calls']}回/{v['tokens']}tok/{v['latency']:.1f}s"
+            for k, v in sorted(self.by_role.items(), key=lambda kv: -kv[1]["tokens"])
+        )
+        return (
+            f"LLM呼び出し {self.calls}回 / 入力 {self.prompt_tokens} / 出力 {self.completion_tokens} トークン"
+            f" / LLM待ち合計 {self.latency:.1f}s" + (f" ({roles})" if roles else "")
+        )
+
+
+# ========== 投機ブランチの仮計上 ==========
+class BranchCharge:
+    """投機ブランチ内のLLM呼び出しを仮計上しておき、採用されたら予算に本計上し、外れたら取り消す。"""
+
+    def __init__(self):
+        self.state = "pending"  # pending / committed / discarded
+        self._trackers: set["UsageTracker"] = set()
+        self._lock = threading.Lock()
+
+    def _register(self, tracker: "UsageTracker") -> str:
+        with self._lock:
+            if self.state == "pending":
+                self._trackers.add(tracker)
+            return self.state
+
+    def _settle(self, state: str):
+        with self._lock:
+            if self.state != "pending":
+                return
+            self.state = state
+            trackers, self._trackers = self._trackers, set()
+        for tracker in trackers:
+            tracker.settle(self)
+
+    def commit(self):
+        self._settle("committed")
+
+    def discard(self):
+        self._settle("discarded")
+
+
+# 投機ブランチのタスクは自分のコンテキストにBranchChargeを持ち、その中のLLM呼び出しが仮計上になる
+_current_branch: contextvars.ContextVar[Optional[BranchCharge]] = contextvars.ContextVar("branch_charge", default=None)
+
+
+def set_branch_charge(charge: Optional[BranchCharge]):
+    _current_branch.set(charge)
+
+
+def current_branch_charge() -> Optional[BranchCharge]:
+    return _current_branch.get()
+
+
+# ========== ターン・セッション単位の集計 ==========
+class UsageTracker:
+    def __init__(self, budget: Optional[TurnBudget] = None):
+        self.budget = budget or TurnBudget()
+        self.records: list[LLMCallRecord] = []
+        self.turn = UsageSummary()
+        self.session = UsageSummary()
+        # 予算に数える呼び出し回数とトークン数（投機ブランチの分は採用が決まるまで _pending に置く）
+        self._charged_calls = 0
+        self._charged_tokens = 0
+        self._pending: dict[BranchCharge, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def start_turn(self):
+        with self._lock:
+            self.turn = UsageSummary()
+            self._charged_calls = 0
+            self._charged_tokens = 0
+            self._pending = {}
+
+    def end_turn(self) -> UsageSummary:
+        with self._lock:
+            return self.turn
+
+    def _charge(self, branch: Optional[BranchCharge], calls: int, tokens: int):
+        state = "committed" if branch is None else branch._register(self)
+        if state == "committed":
+            self._charged_calls += calls
+            self._charged_tokens += tokens
+        elif state == "pending":
+            pending = self._pending.setdefault(branch, [0, 0])
+            pending[0] += calls
+            pending[1] += tokens
+        # discarded: 外れたブランチの呼び出しは予算に数えない
+
+    def reserve(self, estimated_prompt_tokens: int, branch: Optional[BranchCharge] = None):
+        # 呼び出し前に予算を確認し、超える場合はLLMを呼ばずに中断する
+        with self._lock:
+            budget = self.budget
+            calls, tokens = self._charged_calls, self._charged_tokens
+            if branch is not None:
+                # 投機ブランチは仮計上分も含めて判定し、採用される発言者や指名の呼び出しの予算は食わない
+                calls += sum(p[0] for p in self._pending.values())
+                tokens += sum(p[1] for p in self._pending.values())
+            if budget.max_calls is not None and calls + 1 > budget.max_calls:
+                raise BudgetExceeded(f"1ターンのLLM呼び出し上限（{budget.max_calls}回）を超えました")
+            if budget.max_tokens is not None and tokens + estimated_prompt_tokens > budget.max_tokens:
+                raise BudgetExceeded(f"1ターンのトークン上限（{budget.max_tokens}）を超えました")
+            self._charge(branch, 1, 0)
+
+    def record(self, record: LLMCallRecord, branch: Optional[BranchCharge] = None):
+        # 集計には外れたブランチの分も含める（予算の判定だけから外す）
+        with self._lock:
+            self.records.append(record)
+            self.turn.add(record)
+            self.session.add(record)
+            self._charge(branch, 0, record.total_tokens)
+
+    def settle(self, branch: BranchCharge):
+        # ブランチの採否が決まったら、仮計上分を本計上するか捨てる
+        with self._lock:
+            calls, tokens = self._pending.pop(branch, (0, 0))
+            if branch.state == "committed":
+                self._charged_calls += calls
+                self._charged_tokens += tokens
+
+
+# ========== LLM呼び出しごとの記録（コールバック） ==========
+class UsageCallbackHandler(BaseCallbackHandler):
+    # 予算超過の例外を握りつぶさずに呼び出し元へ伝える
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, tracker: UsageTracker, role: str = "other", agent: Optional[str] = None, enforce_budget: bool = True):
+        self.tracker = tracker
+        self.role = role
+        self.agent = agent
+        # 履歴要約のような裏方の呼び出しは集計だけして予算判定の対象外にする
+        self.enforce_budget = enforce_budget
+        self._runs: dict[Any, dict] = {}
+
+    def _start(self, run_id, prompt_tokens: int, metadata: Optional[dict], serialized: Optional[dict]):
+        metadata = metadata or {}
+        branch = current_branch_charge()
+        if self.enforce_budget:
+            # ターンの期限を過ぎていれば、次のLLM呼び出し（ファシリテータ・脳ツールなど）を始めない
+            check_deadline(metadata.get("agent") or self.agent or self.role)
+            self.tracker.reserve(prompt_tokens, branch)
+        kwargs = (serialized or {}).get("kwargs", {})
+        self._runs[run_id] = {
+            "start": time.perf_counter(),
+            "prompt_tokens": prompt_tokens,
+            "role": metadata.get("role", self.role),
+            "agent": metadata.get("agent", self.agent),
+            "model": kwargs.get("deployment_name") or kwargs.get("model_name"),
+            "branch": branch,
+        }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        prompt_tokens = sum(estimate_message_tokens(batch) for batch in messages)
+        self._start(run_id, prompt_tokens, metadata, serialized)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        prompt_tokens = sum(estimate_tokens(p) for p in prompts)
+        self._start(run_id, prompt_tokens, metadata, serialized)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if prompt_tokens is None:
+            # ストリーミング時などは応答メッセージのusage_metadataを見る
+            for generations in response.generations:
+                for g in generations:
+                    meta = getattr(getattr(g, "message", None), "usage_metadata", None)
+                    if meta:
+                        prompt_tokens = meta.get("input_tokens")
+                        completion_tokens = meta.get("output_tokens")
+        estimated = prompt_tokens is None or completion_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = run["prompt_tokens"]
+        if completion_tokens is None:
+            completion_tokens = sum(estimate_tokens(g.text) for generations in response.generations for g in generations)
+        self.tracker.record(LLMCallRecord(
+            role=run["role"],
+            agent=run["agent"],
+            model=run["model"],
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency=time.perf_counter() - run["start"],
+            estimated=estimated,
+        ), run["branch"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        self.tracker.record(LLMCallRecord(
+            role=run["role"],
+            agent=run["agent"],
+            model=run["model"],
+            prompt_tokens=run["prompt_tokens"],
+            completion_tokens=0,
+            latency=time.perf_counter() - run["start"],
+            estimated=True,
+            error=str(error),
+        ), run["branch"])
@@ -0,0 +1,80 @@
+import asyncio
+import contextvars
+import queue
+import concurrent.futures
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+# ========== プロセス共有のバックグラウンドイベントループ ==========
+# 同期コード（CLIループやStreamlitのスクリプト）から非同期処理を呼ぶための入口。
+# 非同期HTTPクライアントはループに紐づくため、毎回asyncio.runせず常駐ループを使い回す。
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def _submit(coro) -> "concurrent.futures.Future":
+    # 呼び出し元のcontextvars（レートリミットのキーなど）を引き継いでループ上で実行する
+    context = contextvars.copy_context()
+
+    async def wrapper():
+        return await asyncio.create_task(coro, context=context)
+
+    return asyncio.run_coroutine_threadsafe(wrapper(), get_background_loop())
+
+
+def submit_coroutine(coro: Awaitable[T]) -> "concurrent.futures.Future[T]":
+    # 結果を待たずにFutureを返す（呼び出し側でキャンセルできるようにする）
+    return _submit(coro)
+
+
+def run_coroutine(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    future = _submit(coro)
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+_DONE = object()
+
+
+def iterate_async(agen: AsyncIterator[T]) -> Iterator[T]:
+    # 非同期ジェネレータを同期イテレータとして、要素が届き次第返す
+    items: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((_DONE, e))
+            return
+        items.put((_DONE, None))
+
+    future = _submit(pump())
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None and not isinstance(error, asyncio.CancelledError):
+                    raise error
+                return
+            yield item
+    finally:
+        # 途中で抜けた場合（Ctrl-Cなど）は残りの処理をキャンセルする
+        future.cancel()
@@ -0,0 +1,268 @@
+import os
+import re
+import sys
+import json
+import time
+import runpy
+import argparse
+import builtins
+import tempfile
+import subprocess
+import urllib.request
+from typing import Optional
+
+from fake_llm_server import FakeLLMServer, FakeLLMConfig
+
+# ========== オフラインのエンドツーエンド・ベンチマーク ==========
+# フェイクサーバを立ち上げ、各スクリプトをサブプロセスで実行して1ターンごとの
+# 所要時間・LLM呼び出し回数・送信トークン数を測る。input()を差し替えて質問を流し込み、
+# input()が次に呼ばれるまでを1ターンとして計測する。
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_QUESTIONS = [
+    "新しい社員研修制度を設計する際の重要な注意点は何ですか？",
+    "リモートワーク中心のチームで信頼関係を作るにはどうすればいい？",
+    "AIを業務に導入するときのリスクと対策を教えて",
+]
+
+FLOWS = {
+    "discussion": {"script": "discussion_agent.py", "interactive": True},
+    "multi": {"script": "multi_zero_shot_agent.py", "interactive": True},
+    "multi_panel": {"script": "multi_zero_shot_agent.py", "interactive": True, "env": {"MULTI_AGENT_MODE": "panel"}},
+    # 専門エージェントをReActから関数呼び出し（並列ツール実行）に切り替えた場合
+    "multi_tools": {"script": "multi_zero_shot_agent.py", "interactive": True, "env": {"SPECIALIST_AGENT_TYPE": "tool_calling"}},
+    "multi_panel_tools": {"script": "multi_zero_shot_agent.py", "interactive": True,
+                          "env": {"MULTI_AGENT_MODE": "panel", "SPECIALIST_AGENT_TYPE": "tool_calling"}},
+    # 脳ツールを固定のDAGで実行する場合（計画役のLLM呼び出しが無い）
+    "multi_pipeline": {"script": "multi_zero_shot_agent.py", "interactive": True, "env": {"SPECIALIST_AGENT_TYPE": "pipeline"}},
+    "zero_shot": {"script": "zero_shot_agent.py", "interactive": False},
+    "lang": {"script": "lang_agent.py", "interactive": True},
+}
+
+METRICS = ["p50", "p95", "p99", "calls", "prompt_tokens", "completion_tokens"]
+
+# スクリプトは例外を捕まえて「⚠️ ...エラー」と表示し、終了コード0で続行するので出力から失敗を見つける
+ERROR_MARKER_RE = re.compile(r"⚠️[^\n]*エラー")
+# 回答の生成に当たらない呼び出し（これしか無いターンは、回答役が何もしていない）
+OVERHEAD_KINDS = {"facilitator", "facilitator_tool", "summary"}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _server_stats(url: str) -> dict:
+    with urllib.request.urlopen(f"{url}/stats") as r:
+        return json.loads(r.read())
+
+
+def _reset_stats(url: str):
+    req = urllib.request.Request(f"{url}/stats/reset", data=b"{}", headers={"Content-Type": "application/json"})
+    urllib.request.urlopen(req).read()
+
+
+# ========== サブプロセス側：スクリプトを実行して計測する ==========
+def run_child(script: str, questions: list[str], server_url: str, result_path: str):
+    sys.path.insert(0, SCRIPT_DIR)
+    # ライブラリのimport時間はターンの計測に含めない
+    import langchain_openai  # noqa: F401
+    import langchain.agents  # noqa: F401
+
+    turns: list[dict] = []
+    pending = list(questions)
+    state = {"start": None, "stats": None}
+
+    def close_turn():
+        if state["start"] is None:
+            return
+        stats = _server_stats(server_url)
+        before = state["stats"]
+        by_kind = {kind: n - before["by_kind"].get(kind, 0) for kind, n in stats["by_kind"].items()}
+        turns.append({
+            "elapsed": time.perf_counter() - state["start"],
+            "calls": stats["calls"] - before["calls"],
+            "answer_calls": sum(n for kind, n in by_kind.items() if kind not in OVERHEAD_KINDS),
+            "prompt_tokens": stats["prompt_tokens"] - before["prompt_tokens"],
+            "completion_tokens": stats["completion_tokens"] - before["completion_tokens"],
+        })
+        state["start"] = None
+
+    def fake_input(prompt: str = "") -> str:
+        close_turn()
+        if not pending:
+            return "exit"
+        state["stats"] = _server_stats(server_url)
+        state["start"] = time.perf_counter()
+        return pending.pop(0)
+
+    builtins.input = fake_input
+    if not questions:
+        # 入力ループを持たないスクリプトは実行全体を1ターンとする
+        state["stats"] = _server_stats(server_url)
+        state["start"] = time.perf_counter()
+    # 対話型のスクリプトは最初の入力待ちから計測する（import・起動時間をターンに含めない）
+    try:
+        runpy.run_path(os.path.join(SCRIPT_DIR, script), run_name="__main__")
+    finally:
+        close_turn()
+        with open(result_path, "w", encoding="utf-8") as f:
+            json.dump(turns, f)
+
+
+# ========== 親プロセス側：フローごとに実行して集計する ==========
+def run_flow(name: str, flow: dict, server: FakeLLMServer, questions: list[str], repeat: int,
+             extra_env: dict, verbose: bool) -> dict:
+    turns: list[dict] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(repeat):
+            _reset_stats(server.url)
+            result_path = os.path.join(workdir, f"{name}_{i}.json")
+            env = {
+                **os.environ,
+                "AZURE_OPENAI_ENDPOINT": server.url,
+                "AZURE_OPENAI_API_KEY": "fake-key",
+                "SEARCH_API_URL": f"{server.url}/faiss/deep_test/search",
+                "LLM_CACHE": os.environ.get("LLM_CACHE", "0"),
+                "PYTHONPATH": SCRIPT_DIR,
+                **flow.get("env", {}),
+                **extra_env,
+            }
+            cmd = [sys.executable, os.path.abspath(__file__), "--child", flow["script"],
+                   "--server-url", server.url, "--result", result_path,
+                   "--questions", json.dumps(questions if flow["interactive"] else [], ensure_ascii=False)]
+            # チャットログやキャッシュは一時ディレクトリに出す
+            proc = subprocess.run(cmd, cwd=workdir, env=env, stdout=subprocess.PIPE,
+                                  stderr=None if verbose else subprocess.PIPE)
+            out = proc.stdout.decode("utf-8", "replace")
+            if verbose:
+                sys.stdout.write(out)
+            if proc.returncode != 0:
+                err = proc.stderr.decode("utf-8", "replace")[-2000:] if proc.stderr else ""
+                raise RuntimeError(f"{name} failed (exit {proc.returncode})\n{err}")
+            errors = ERROR_MARKER_RE.findall(out)
+            if errors:
+                raise RuntimeError(f"{name} reported errors\n" + "\n".join(errors[:10]))
+            with open(result_path, encoding="utf-8") as f:
+                run_turns = json.load(f)
+            idle = [i for i, t in enumerate(run_turns) if t["answer_calls"] == 0]
+            if idle:
+                raise RuntimeError(f"{name}: turns {idle} made no answering LLM calls (only facilitator/summary)")
+            turns.extend(run_turns)
+
+    elapsed = [t["elapsed"] for t in turns]
+    return {
+        "turns": len(turns),
+        "p50": percentile(elapsed, 50),
+        "p95": percentile(elapsed, 95),
+        "p99": percentile(elapsed, 99),
+        "calls": sum(t["calls"] for t in turns) / max(1, len(turns)),
+        "prompt_tokens": sum(t["prompt_tokens"] for t in turns) / max(1, len(turns)),
+        "completion_tokens": sum(t["completion_tokens"] for t in turns) / max(1, len(turns)),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # ベースラインより tolerance を超えて悪化した指標を返す
+    regressions = []
+    for flow, metrics in results.items():
+        base = baseline.get(flow)
+        if not base:
+            continue
+        for key in METRICS:
+            if key in base and base[key] > 0 and metrics[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{flow}.{key}: {base[key]:.3f} -> {metrics[key]:.3f} (+{(metrics[key] / base[key] - 1) * 100:.1f}%)")
+    return regressions
+
+
+def format_report(results: dict, baseline: Optional[dict] = None) -> str:
+    lines = [f"{'flow':<12} {'turns':>5} {'p50':>7} {'p95':>7} {'p99':>7} {'calls/turn':>10} {'prompt tok':>10} {'compl tok':>10}"]
+    for flow, m in results.items():
+        lines.append(
+            f"{flow:<12} {m['turns']:>5} {m['p50']:>6.2f}s {m['p95']:>6.2f}s {m['p99']:>6.2f}s"
+            f" {m['calls']:>10.1f} {m['prompt_tokens']:>10.0f} {m['completion_tokens']:>10.0f}"
+        )
+        base = (baseline or {}).get(flow)
+        if base:
+            delta = " ".join(
+                f"{key} {(m[key] / base[key] - 1) * 100:+.1f}%" for key in METRICS if base.get(key)
+            )
+            lines.append(f"{'':<12} vs baseline: {delta}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="フェイクLLMサーバを使ったエンドツーエンドのレイテンシ計測")
+    parser.add_argument("--flows", default=",".join(FLOWS), help=f"カンマ区切り（{', '.join(FLOWS)}）")
+    parser.add_argument("--questions-file", help="1行1質問のテキストファイル")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE（比較したい設定を渡す）")
+    parser.add_argument("--baseline", help="比較対象のベースラインJSON")
+    parser.add_argument("--save-baseline", help="結果をベースラインとして保存するパス")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="悪化とみなす割合（0.1 = 10%%）")
+    parser.add_argument("--latency-median", type=float, default=0.3)
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--token-rate", type=float, default=80.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--react-steps", type=int, default=1,
+                        help="専門エージェントが1回答で使うツール数（ReActは1つずつ、tool_callingはまとめて呼ぶ）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    # サブプロセス用
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--server-url", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--questions", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, json.loads(args.questions), args.server_url, args.result)
+        return 0
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+
+    server = FakeLLMServer(FakeLLMConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        react_steps=args.react_steps,
+        seed=args.seed,
+    )).start()
+    results = {}
+    try:
+        for name in args.flows.split(","):
+            print(f"▶ {name} ...", file=sys.stderr)
+            results[name] = run_flow(name, FLOWS[name], server, questions, args.repeat, extra_env, args.verbose)
+    finally:
+        server.stop()
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print(format_report(results, baseline))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n⚠️ ベースラインからの悪化:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
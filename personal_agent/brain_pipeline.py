@@ -0,0 +1,122 @@
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+from async_runtime import run_coroutine
+
+logger = logging.getLogger(__name__)
+
+# 最終段のLLM呼び出しに付けるタグ（最終回答のトークンだけを流すために使う）
+FINAL_ANSWER_TAG = "final_answer"
+
+
+@dataclass
+class BrainStage:
+    name: str
+    # このステージに結果を渡すステージ（空なら質問だけを受け取る）
+    inputs: list[str] = field(default_factory=list)
+
+
+@dataclass
+class StageTiming:
+    name: str
+    start: float
+    elapsed: float
+
+    @property
+    def end(self) -> float:
+        return self.start + self.elapsed
+
+
+def default_brain_stages(domain_tools: list[str]) -> list[BrainStage]:
+    """意図推論 → (課題分解 / 背景知識整理 / 専門ツール) → ステップ計画 → 自己評価 → 最終出力整形。"""
+    return [
+        BrainStage("意図推論ツール"),
+        BrainStage("課題分解ツール", ["意図推論ツール"]),
+        BrainStage("背景知識整理ツール", ["意図推論ツール"]),
+        *[BrainStage(name, ["意図推論ツール"]) for name in domain_tools],
+        BrainStage("ステップ計画ツール", ["課題分解ツール", "背景知識整理ツール", *domain_tools]),
+        BrainStage("自己評価・矛盾検出ツール", ["ステップ計画ツール", "背景知識整理ツール"]),
+        BrainStage("最終出力整形ツール", ["ステップ計画ツール", "自己評価・矛盾検出ツール"]),
+    ]
+
+
+def format_stage_timings(timings: list[StageTiming]) -> str:
+    return "\n".join(
+        f"{t.name}: {t.start:.2f}s → {t.end:.2f}s ({t.elapsed:.2f}s)"
+        for t in sorted(timings, key=lambda t: t.start)
+    )
+
+
+# ========== 固定パイプライン（Plan-and-Execute） ==========
+class BrainPipeline:
+    """脳ツールを依存関係のDAGどおりに実行する。計画役のLLMを挟まず、前段の結果をそのまま後段へ渡す。
+
+    依存の無いステージは同時に実行し、最後のステージの出力を回答とする。
+    AgentExecutorと同じく {"input": ...} を受け取り {"output": ...} を返す（"stages"に各段の所要時間）。
+    """
+
+    def __init__(self, tools: list, stages: list[BrainStage], system_msg: str = ""):
+        self.tools = {tool.name: tool for tool in tools}
+        self.stages = stages
+        self.system_msg = system_msg
+        self.metadata = {"agent_type": "pipeline"}
+        self._validate()
+
+    def _validate(self):
+        seen = set()
+        for stage in self.stages:
+            if stage.name not in self.tools:
+                raise ValueError(f"unknown brain tool: {stage.name}")
+            # 並び順がそのままトポロジカル順になっていること（循環も弾ける）
+            missing = [name for name in stage.inputs if name not in seen]
+            if missing:
+                raise ValueError(f"stage {stage.name} depends on later or unknown stages: {missing}")
+            seen.add(stage.name)
+        if not self.stages:
+            raise ValueError("pipeline has no stages")
+
+    def _stage_input(self, question: str, stage: BrainStage, outputs: dict[str, str]) -> str:
+        parts = [self.system_msg] if self.system_msg else []
+        parts.append(f"# 依頼\n{question}")
+        parts += [f"# {name}の結果\n{outputs[name]}" for name in stage.inputs]
+        return "\n\n".join(parts)
+
+    async def ainvoke(self, input: Union[str, dict], config: Optional[dict] = None) -> dict:
+        question = input["input"] if isinstance(input, dict) else input
+        config = config or {}
+        final = self.stages[-1].name
+        outputs: dict[str, str] = {}
+        timings: list[StageTiming] = []
+        tasks: dict[str, asyncio.Task] = {}
+        origin = time.perf_counter()
+
+        async def run(stage: BrainStage) -> str:
+            if stage.inputs:
+                await asyncio.gather(*(tasks[name] for name in stage.inputs))
+            stage_config = {**config, "run_name": stage.name}
+            if stage.name == final:
+                stage_config["tags"] = [*config.get("tags", []), FINAL_ANSWER_TAG]
+            start = time.perf_counter()
+            output = await self.tools[stage.name].ainvoke(self._stage_input(question, stage, outputs), config=stage_config)
+            timings.append(StageTiming(stage.name, start - origin, time.perf_counter() - start))
+            outputs[stage.name] = output
+            return output
+
+        for stage in self.stages:
+            tasks[stage.name] = asyncio.create_task(run(stage))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            # 1段でも失敗（またはキャンセル）したら、残りのステージも止める
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        logger.info("brain pipeline finished in %.2fs\n%s", time.perf_counter() - origin, format_stage_timings(timings))
+        return {"input": question, "output": outputs[final], "stages": timings}
+
+    def invoke(self, input: Union[str, dict], config: Optional[dict] = None) -> dict:
+        return run_coroutine(self.ainvoke(input, config))
@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import base64
+import atexit
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# ========== 記録・再生（カセット） ==========
+# CASSETTE_MODE=record: LLM・検索APIへのリクエストと応答（ストリーミングの到着時刻を含む）をJSON Linesに書き出す
+# CASSETTE_MODE=replay: 記録した応答を、記録時の待ち時間（CASSETTE_LATENCY_SCALE倍）でローカルに返す
+# 最下層のhttpxトランスポートを差し替えるので、レートリミッタ・リトライ・ターンの期限はそのまま動く
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/cassette.jsonl")
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1"))
+
+CASSETTE_MODES = ["record", "replay"]
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def _endpoint(method: str, target: str) -> tuple:
+    # 代替の応答はクエリ（?api-version=...）を除いたパスで探す（記録側と再生側で同じ形にそろえる）
+    return method, target.split("?", 1)[0]
+
+
+def request_key(request: httpx.Request) -> str:
+    # ホスト名は含めない（記録時と別のエンドポイント設定でも再生できる）。JSONはキー順をそろえて比較する
+    content = request.read()
+    try:
+        body = json.dumps(json.loads(content), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        body = content.decode("utf-8", "replace")
+    target = request.url.raw_path.decode("ascii")
+    return hashlib.sha256(f"{request.method} {target}\n{body}".encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class Interaction:
+    key: str
+    method: str
+    path: str
+    # リクエスト送信から応答ヘッダ受信までの秒数
+    latency: float
+    status: int = 0
+    headers: list = field(default_factory=list)
+    body: bytes = b""
+    # ストリームの各チャンクの (ヘッダ受信からの秒数, bodyの終端位置)
+    chunks: list = field(default_factory=list)
+    # 通信エラーで終わった場合の (httpxの例外名, メッセージ)
+    error: Optional[tuple] = None
+
+    def to_json(self) -> dict:
+        data = {"key": self.key, "method": self.method, "path": self.path, "latency": round(self.latency, 4)}
+        if self.error is not None:
+            data["error"] = list(self.error)
+            return data
+        data.update(status=self.status, headers=self.headers, chunks=[[round(t, 4), end] for t, end in self.chunks])
+        try:
+            data["body"] = self.body.decode("utf-8")
+        except UnicodeDecodeError:
+            # 圧縮された応答などはbase64で持つ
+            data["body_b64"] = base64.b64encode(self.body).decode("ascii")
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Interaction":
+        body = base64.b64decode(data["body_b64"]) if "body_b64" in data else data.get("body", "").encode("utf-8")
+        return cls(
+            key=data["key"],
+            method=data["method"],
+            path=data["path"],
+            latency=data["latency"],
+            status=data.get("status", 0),
+            headers=[tuple(h) for h in data.get("headers", [])],
+            body=body,
+            chunks=[tuple(c) for c in data.get("chunks", [])],
+            error=tuple(data["error"]) if data.get("error") else None,
+        )
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._file = None
+        self._by_key: dict[str, deque] = {}
+        self._last: dict[str, Interaction] = {}
+        self._by_path: dict[tuple, list] = {}
+        self._path_cursor: dict[tuple, int] = {}
+        self.hits = 0
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction = Interaction.from_json(json.loads(line))
+                self._by_key.setdefault(interaction.key, deque()).append(interaction)
+                self._by_path.setdefault(_endpoint(interaction.method, interaction.path), []).append(interaction)
+        logger.info(f"cassette loaded: {sum(len(q) for q in self._by_key.values())} interactions from {self.path}")
+
+    # ---------- 記録 ----------
+    def record(self, interaction: Interaction):
+        line = json.dumps(interaction.to_json(), ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                # プロセスごとに新しいカセットを書く（同時に動く呼び出しは完了順に並ぶ）
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, "w", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    # ---------- 再生 ----------
+    def match(self, request: httpx.Request) -> Interaction:
+        key = request_key(request)
+        with self._lock:
+            queue = self._by_key.get(key)
+            if queue:
+                # 同じリクエストは記録した順に返し、使い切ったら最後の応答を繰り返す
+                self._last[key] = queue.popleft()
+                self.hits += 1
+                return self._last[key]
+            if key in self._last:
+                self.hits += 1
+                return self._last[key]
+            # プロンプトが変わった呼び出しは、同じエンドポイントの記録を順に使い回す
+            self.misses += 1
+            target = _endpoint(request.method, request.url.raw_path.decode("ascii"))
+            candidates = self._by_path.get(target)
+            if not candidates:
+                raise CassetteMiss(f"no recorded response for {request.method} {request.url.path}")
+            cursor = self._path_cursor.get(target, 0)
+            self._path_cursor[target] = cursor + 1
+            logger.warning(f"cassette miss for {request.method} {request.url.path}, falling back to a recorded response")
+            return candidates[cursor % len(candidates)]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self.mode == "replay" and self.misses:
+            logger.warning(f"cassette replay: {self.hits} hits, {self.misses} misses ({self.path})")
+
+
+def _read_timeout(request: httpx.Request) -> Optional[float]:
+    return (request.extensions.get("timeout") or {}).get("read")
+
+
+def _replay_error(interaction: Interaction, request: httpx.Request) -> httpx.TransportError:
+    name, message = interaction.error
+    cls = getattr(httpx, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, httpx.TransportError)):
+        cls = httpx.TransportError
+    return cls(message, request=request)
+
+
+def _replay_waits(interaction: Interaction, scale: float, timeout: Optional[float]):
+    # 記録時の到着間隔で (待ち秒数, チャンク) を返す。読み取りタイムアウトを超える間隔ならタイムアウトさせる
+    previous, start = 0.0, 0
+    for offset, end in interaction.chunks:
+        gap = (offset - previous) * scale
+        if timeout is not None and gap > timeout:
+            yield timeout, None
+            return
+        yield gap, interaction.body[start:end]
+        previous, start = offset, end
+
+
+def _recorded(request: httpx.Request, key: str, latency: float, response: httpx.Response = None, **kwargs) -> Interaction:
+    return Interaction(
+        key=key,
+        method=request.method,
+        path=request.url.raw_path.decode("ascii"),
+        latency=latency,
+        status=response.status_code if response is not None else 0,
+        headers=[(k.decode("latin-1"), v.decode("latin-1")) for k, v in response.headers.raw] if response is not None else [],
+        **kwargs,
+    )
+
+
+# ========== 同期トランスポート ==========
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, inner: httpx.SyncByteStream, on_done):
+        self.inner = inner
+        self.on_done = on_done
+        self.body = bytearray()
+        self.chunks: list = []
+        self._done = False
+
+    def __iter__(self):
+        origin = time.perf_counter()
+        for chunk in self.inner:
+            self.body += chunk
+            self.chunks.append((time.perf_counter() - origin, len(self.body)))
+            yield chunk
+
+    def close(self):
+        try:
+            self.inner.close()
+        finally:
+            if not self._done:
+                self._done = True
+                self.on_done(bytes(self.body), self.chunks)
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, interaction: Interaction, scale: float, request: httpx.Request):
+        self.interaction = interaction
+        self.scale = scale
+        self.request = request
+
+    def __iter__(self):
+        for wait, chunk in _replay_waits(self.interaction, self.scale, _read_timeout(self.request)):
+            time.sleep(wait)
+            if chunk is None:
+                raise httpx.ReadTimeout("cassette replay read timed out", request=self.request)
+            yield chunk
+
+
+class CassetteTransport(httpx.BaseTransport):
+    def __init__(self, inner: httpx.BaseTransport, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if self.cassette.mode == "replay":
+            return self._replay(request)
+        return self._record(request)
+
+    def _record(self, request: httpx.Request) -> httpx.Response:
+        key = request_key(request)
+        start = time.perf_counter()
+        try:
+            response = self.inner.handle_request(request)
+        except httpx.TransportError as e:
+            self.cassette.record(_recorded(request, key, time.perf_counter() - start, error=(type(e).__name__, str(e))))
+            raise
+        latency = time.perf_counter() - start
+
+        def on_done(body: bytes, chunks: list):
+            self.cassette.record(_recorded(request, key, latency, response, body=body, chunks=chunks))
+
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_RecordingStream(response.stream, on_done), extensions=response.extensions)
+
+    def _replay(self, request: httpx.Request) -> httpx.Response:
+        interaction = self.cassette.match(request)
+        wait = interaction.latency * self.cassette.latency_scale
+        timeout = _read_timeout(request)
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            raise httpx.ReadTimeout("cassette replay read timed out", request=request)
+        time.sleep(wait)
+        if interaction.error is not None:
+            raise _replay_error(interaction, request)
+        return httpx.Response(interaction.status, headers=interaction.headers,
+                              stream=_ReplayStream(interaction, self.cassette.latency_scale, request))
+
+    def close(self):
+        self.inner.close()
+
+
+# ========== 非同期トランスポート ==========
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, inner: httpx.AsyncByteStream, on_done):
+        self.inner = inner
+        self.on_done = on_done
+        self.body = bytearray()
+        self.chunks: list = []
+        self._done = False
+
+    async def __aiter__(self):
+        origin = time.perf_counter()
+        async for chunk in self.inner:
+            self.body += chunk
+            self.chunks.append((time.perf_counter() - origin, len(self.body)))
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.inner.aclose()
+        finally:
+            if not self._done:
+                self._done = True
+                self.on_done(bytes(self.body), self.chunks)
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, interaction: Interaction, scale: float, request: httpx.Request):
+        self.interaction = interaction
+        self.scale = scale
+        self.request = request
+
+    async def __aiter__(self):
+        for wait, chunk in _replay_waits(self.interaction, self.scale, _read_timeout(self.request)):
+            await asyncio.sleep(wait)
+            if chunk is None:
+                raise httpx.ReadTimeout("cassette replay read timed out", request=self.request)
+            yield chunk
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.cassette.mode == "replay":
+            return await self._replay(request)
+        return await self._record(request)
+
+    async def _record(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        key = request_key(request)
+        start = time.perf_counter()
+        try:
+            response = await self.inner.handle_async_request(request)
+        except httpx.TransportError as e:
+            self.cassette.record(_recorded(request, key, time.perf_counter() - start, error=(type(e).__name__, str(e))))
+            raise
+        latency = time.perf_counter() - start
+
+        def on_done(body: bytes, chunks: list):
+            self.cassette.record(_recorded(request, key, latency, response, body=body, chunks=chunks))
+
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_AsyncRecordingStream(response.stream, on_done), extensions=response.extensions)
+
+    async def _replay(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        interaction = self.cassette.match(request)
+        wait = interaction.latency * self.cassette.latency_scale
+        timeout = _read_timeout(request)
+        if timeout is not None and wait > timeout:
+            await asyncio.sleep(timeout)
+            raise httpx.ReadTimeout("cassette replay read timed out", request=request)
+        await asyncio.sleep(wait)
+        if interaction.error is not None:
+            raise _replay_error(interaction, request)
+        return httpx.Response(interaction.status, headers=interaction.headers,
+                              stream=_AsyncReplayStream(interaction, self.cassette.latency_scale, request))
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+# ========== 共有カセット ==========
+_cassette: Optional[Cassette] = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Optional[Cassette]:
+    global _cassette
+    if not CASSETTE_MODE:
+        return None
+    if _cassette is None:
+        with _cassette_lock:
+            if _cassette is None:
+                _cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_LATENCY_SCALE)
+                atexit.register(_cassette.close)
+    return _cassette
+
+
+def replaying() -> bool:
+    return CASSETTE_MODE == "replay"
+
+
+def wrap_transport(inner: httpx.BaseTransport) -> httpx.BaseTransport:
+    cassette = get_cassette()
+    return inner if cassette is None else CassetteTransport(inner, cassette)
+
+
+def wrap_async_transport(inner: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    cassette = get_cassette()
+    return inner if cassette is None else AsyncCassetteTransport(inner, cassette)
@@ -1,8 +1,12 @@
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.prompts import HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
-from langchain.chains import LLMChain
+from langchain_core.output_parsers import StrOutputParser
+from streaming import print_stream
+from history import HistoryManager
+from discussion_agent import create_summary_agent_chain
+from model_registry import get_llm
 import os
 
 # キャラ設定
@@ -12,13 +16,8 @@ character_defs = {
     "エージェントC": "真面目で知識豊富なメガネキャラ。何事にも理屈で答える。",
 }
 
-# モデル定義
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# モデル定義（役割ごとのデプロイメントとパラメータは models.json で切り替える）
+llm = get_llm("persona")
 
 # 各キャラのエージェントチェーン生成
 agents = {}
@@ -28,10 +27,10 @@ for name, persona in character_defs.items():
         MessagesPlaceholder(variable_name="chat_history"),
         HumanMessagePromptTemplate.from_template("{input}"),
     ])
-    agents[name] = LLMChain(llm=llm, prompt=prompt, verbose=False)
+    agents[name] = prompt | llm | StrOutputParser()
 
-# 履歴初期化
-chat_history = []
+# 履歴初期化（直近の発言は原文、古い発言は要約に畳み込んでトークン予算内に収める）
+history = HistoryManager(create_summary_agent_chain(get_llm("summary")))
 
 print("🎙️ キャラエージェントたちと会話しましょう！'exit'で終了します。")
 
@@ -41,7 +40,7 @@ while True:
         print("👋 終了します。")
         break
 
-    chat_history.append({"role": "user", "content": user_input})
+    history.append({"role": "user", "content": user_input})
 
     # エージェントたちの最大発言数（例: 3）
     max_agent_turns = 3
@@ -53,13 +52,12 @@ while True:
 
         try:
             # 履歴を渡して発言させる
-            result = agent_chain.invoke({
+            result_text = print_stream(f"🤖 {name}> ", agent_chain.stream({
                 "input": f"最新の会話に返答してください。",
-                "chat_history": chat_history
-            })
+                "chat_history": history.for_prompt()
+            }))
 
-            print(f"🤖 {name}> {result['text']}")
-            chat_history.append({"role": "assistant", "name": name, "content": result["text"]})
+            history.append({"role": "assistant", "name": name, "content": result_text})
 
         except Exception as e:
             print(f"⚠️ {name}の発言エラー: {e}")
@@ -1,45 +1,201 @@
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
-import requests
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.output_parsers.openai_tools import make_invalid_tool_call, parse_tool_call
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import ConfigDict, Field
+from typing import Any, AsyncIterator, Iterator, Optional
+import json
+from transport import HTTPTransport, get_default_transport
 import os
 
+
+def bind_openai_tools(model: BaseChatModel, tools, tool_choice=None, **kwargs):
+    # 関数定義をOpenAI形式にそろえて tools / tool_choice として呼び出し時に渡す
+    formatted = [convert_to_openai_tool(t) for t in tools]
+    if tool_choice == "any":
+        tool_choice = "required"
+    if isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required"):
+        tool_choice = {"type": "function", "function": {"name": tool_choice}}
+    if tool_choice is not None:
+        kwargs["tool_choice"] = tool_choice
+    return model.bind(tools=formatted, **kwargs)
+
+
 class OpenAIChatCustom(BaseChatModel):
-    def __init__(self, deployment_name, api_key, endpoint, api_version="2023-05-15"):
-        self.deployment_name = deployment_name
-        self.api_key = api_key
-        self.endpoint = endpoint
-        self.api_version = api_version
+    deployment_name: str
+    api_key: str
+    endpoint: str
+    api_version: str = "2023-05-15"
+    temperature: float = 0.7
+    max_tokens: int = 500
+    request_timeout: Optional[float] = None
+    # Trueの場合はinvoke時もSSEで受信し、コールバックにトークンを流す
+    streaming: bool = False
+    # Noneの場合はプロセス共有のトランスポートを使う
+    transport: Optional[HTTPTransport] = Field(default=None, exclude=True)
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def __init__(self, deployment_name, api_key, endpoint, api_version="2023-05-15", warmup=False, **kwargs):
+        super().__init__(
+            deployment_name=deployment_name,
+            api_key=api_key,
+            endpoint=endpoint,
+            api_version=api_version,
+            **kwargs,
+        )
+        if warmup:
+            self.warmup()
+
+    def _get_transport(self) -> HTTPTransport:
+        return self.transport or get_default_transport()
+
+    def warmup(self, connections: int = 1):
+        self._get_transport().warmup(self.endpoint, connections=connections)
+
+    async def awarmup(self, connections: int = 1):
+        await self._get_transport().awarmup(self.endpoint, connections=connections)
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        return bind_openai_tools(self, tools, tool_choice, **kwargs)
 
     def _convert_messages(self, messages):
         converted = []
         for m in messages:
             if isinstance(m, HumanMessage):
-                role = "user"
+                converted.append({"role": "user", "content": m.content})
             elif isinstance(m, AIMessage):
-                role = "assistant"
+                item = {"role": "assistant", "content": m.content or None}
+                if m.tool_calls:
+                    # ツール要求の応答は、次の呼び出しで結果（ToolMessage）と対応付けられるようそのまま送り返す
+                    item["tool_calls"] = [
+                        {"id": c["id"], "type": "function",
+                         "function": {"name": c["name"], "arguments": json.dumps(c["args"], ensure_ascii=False)}}
+                        for c in m.tool_calls
+                    ]
+                converted.append(item)
+            elif isinstance(m, ToolMessage):
+                converted.append({"role": "tool", "tool_call_id": m.tool_call_id, "content": m.content})
             elif isinstance(m, SystemMessage):
-                role = "system"
-            else:
-                continue
-            converted.append({"role": role, "content": m.content})
+                converted.append({"role": "system", "content": m.content})
         return converted
 
-    def _call(self, messages, stop=None):
-        url = f"{self.endpoint}/openai/deployments/{self.deployment_name}/chat/completions?api-version={self.api_version}"
-        headers = {
+    @property
+    def _url(self) -> str:
+        return f"{self.endpoint}/openai/deployments/{self.deployment_name}/chat/completions?api-version={self.api_version}"
+
+    @property
+    def _headers(self) -> dict:
+        return {
             "Content-Type": "application/json",
             "api-key": self.api_key
         }
+
+    def _payload(self, messages, stop=None, **kwargs) -> dict:
         data = {
             "messages": self._convert_messages(messages),
-            "temperature": 0.7,
-            "max_tokens": 500
+            "temperature": kwargs.get("temperature", self.temperature),
+            "max_tokens": kwargs.get("max_tokens", self.max_tokens)
+        }
+        if stop:
+            data["stop"] = stop
+        for key in ("tools", "tool_choice"):
+            if kwargs.get(key) is not None:
+                data[key] = kwargs[key]
+        return data
+
+    def _create_chat_result(self, response_json: dict) -> ChatResult:
+        choice = response_json["choices"][0]
+        message = choice["message"]
+        tool_calls, invalid_tool_calls = [], []
+        for raw in message.get("tool_calls") or []:
+            try:
+                tool_calls.append(parse_tool_call(raw, return_id=True))
+            except Exception as e:
+                invalid_tool_calls.append(make_invalid_tool_call(raw, str(e)))
+        generation = ChatGeneration(
+            message=AIMessage(content=message.get("content") or "", tool_calls=tool_calls,
+                              invalid_tool_calls=invalid_tool_calls),
+            generation_info={"finish_reason": choice.get("finish_reason")},
+        )
+        llm_output = {
+            "token_usage": response_json.get("usage", {}),
+            "model_name": self.deployment_name,
+        }
+        return ChatResult(generations=[generation], llm_output=llm_output)
+
+    # Azureのstream=trueレスポンス（data: {...} 行）を1チャンクずつ解釈する
+    def _parse_sse_line(self, line: str) -> Optional[ChatGenerationChunk]:
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if not data or data == "[DONE]":
+            return None
+        event = json.loads(data)
+        if not event.get("choices"):
+            return None
+        choice = event["choices"][0]
+        delta = choice.get("delta") or {}
+        content = delta.get("content") or ""
+        # 関数呼び出しは名前・IDと引数が分割されて届くので、indexごとに連結できる形で返す
+        tool_call_chunks = [
+            {"name": (c.get("function") or {}).get("name"), "args": (c.get("function") or {}).get("arguments"),
+             "id": c.get("id"), "index": c.get("index")}
+            for c in delta.get("tool_calls") or []
+        ]
+        finish_reason = choice.get("finish_reason")
+        if not content and not tool_call_chunks and not finish_reason:
+            return None
+        return ChatGenerationChunk(
+            message=AIMessageChunk(content=content, tool_call_chunks=tool_call_chunks),
+            generation_info={"finish_reason": finish_reason} if finish_reason else None,
+        )
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        payload = {**self._payload(messages, stop, **kwargs), "stream": True}
+        for line in self._get_transport().stream_lines(self._url, self._headers, payload, timeout=self.request_timeout):
+            chunk = self._parse_sse_line(line)
+            if chunk is None:
+                continue
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        payload = {**self._payload(messages, stop, **kwargs), "stream": True}
+        async for line in self._get_transport().astream_lines(self._url, self._headers, payload, timeout=self.request_timeout):
+            chunk = self._parse_sse_line(line)
+            if chunk is None:
+                continue
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.streaming:
+            return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+        response = self._get_transport().post_json(
+            self._url, self._headers, self._payload(messages, stop, **kwargs), timeout=self.request_timeout
+        )
+        return self._create_chat_result(response.json())
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.streaming:
+            return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+        response = await self._get_transport().apost_json(
+            self._url, self._headers, self._payload(messages, stop, **kwargs), timeout=self.request_timeout
+        )
+        return self._create_chat_result(response.json())
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {
+            "deployment_name": self.deployment_name,
+            "api_version": self.api_version,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
         }
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        result_text = response.json()["choices"][0]["message"]["content"]
-        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=result_text))])
 
     @property
     def _llm_type(self) -> str:
@@ -0,0 +1,115 @@
+import os
+import time
+import asyncio
+import contextvars
+from typing import AsyncIterator, Awaitable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# 1ターン（ユーザーの1発言への応答全体）の制限時間（秒）。0で無効
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "180"))
+# AgentExecutor 1回あたりのステップ数と実行時間の上限（ReActが書式エラーの再試行を繰り返しても止まる）
+AGENT_MAX_ITERATIONS = int(os.getenv("AGENT_MAX_ITERATIONS", "15"))
+AGENT_MAX_EXECUTION_TIME = float(os.getenv("AGENT_MAX_EXECUTION_TIME", "120"))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, what: str = ""):
+        if self.expired:
+            raise DeadlineExceeded(f"1ターンの制限時間（{self.seconds:g}秒）を超えました" + (f"（{what}）" if what else ""))
+
+
+# ターンの期限はcontextvarで持つ。常駐ループ（run_coroutine）・ワーカースレッド・asyncio.to_thread・
+# LangChainのexecutorはいずれも呼び出し元のコンテキストを引き継ぐので、下位の呼び出しまで自動で届く
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("turn_deadline", default=None)
+
+
+def executor_limits() -> dict:
+    # initialize_agent / AgentExecutor に渡す上限。打ち切った場合はそれまでの内容で回答を返す
+    return {
+        "max_iterations": AGENT_MAX_ITERATIONS,
+        "max_execution_time": AGENT_MAX_EXECUTION_TIME or None,
+        "early_stopping_method": "force",
+    }
+
+
+def start_deadline(seconds: Optional[float] = None) -> Optional[Deadline]:
+    # 呼び出し元のコンテキストに新しい期限を設定する（ターンの開始時に呼ぶ）
+    seconds = TURN_DEADLINE if seconds is None else seconds
+    deadline = Deadline(seconds) if seconds and seconds > 0 else None
+    _current.set(deadline)
+    return deadline
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+def check_deadline(what: str = ""):
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check(what)
+
+
+def clamp_timeout(timeout: Optional[float]) -> Optional[float]:
+    # 個々の呼び出しのタイムアウトを、ターンの残り時間以下に切り詰める
+    deadline = _current.get()
+    if deadline is None:
+        return timeout
+    deadline.check()
+    remaining = deadline.remaining()
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+async def within_deadline(aw: Awaitable[T], what: str = "") -> T:
+    # 残り時間で打ち切る（中の処理はキャンセルされ、HTTPリクエストも閉じられる）
+    deadline = _current.get()
+    if deadline is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"1ターンの制限時間（{deadline.seconds:g}秒）を超えました" + (f"（{what}）" if what else "")) from None
+
+
+def deadline_iter(chunks: Iterable[T], what: str = "") -> Iterator[T]:
+    # ストリーミング出力をチャンクごとに期限と照らし合わせ、超えたら生成元を閉じる
+    iterator = iter(chunks)
+    try:
+        for chunk in iterator:
+            check_deadline(what)
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+async def adeadline_iter(chunks: AsyncIterator[T], what: str = "") -> AsyncIterator[T]:
+    # 非同期版：次のチャンクを残り時間だけ待つ
+    try:
+        while True:
+            try:
+                chunk = await within_deadline(chunks.__anext__(), what)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
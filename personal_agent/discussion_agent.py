@@ -1,9 +1,26 @@
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.prompts import HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
 from langchain.chains.llm import LLMChain
+from streaming import print_stream, StreamPrinter
+from llm_cache import with_cache
+from scheduler import create_scheduler
+from facilitator import create_constrained_decide
+from speculative import SpeculativeTurnRunner, BranchError
+from async_runtime import run_coroutine
+from history import HistoryManager
+from session_store import get_session_store, named_prompt_message, format_resumed
+from log_writer import open_session_log, log_chat
+from memory_index import MemoryIndex, format_memories
+from accounting import UsageTracker, UsageCallbackHandler, TurnBudget, BudgetExceeded
+from deadline import start_deadline, within_deadline, deadline_iter, DeadlineExceeded
+from model_registry import get_llm
+from engine_client import EngineClient, EngineClientError
 import os
+import uuid
+import asyncio
 from datetime import datetime
 
 # キャラ設定
@@ -14,13 +31,25 @@ character_defs = {
     "エージェントD": "あなたは自由な発想と独創的なアイデアを重視するエージェントです。常識にとらわれず、突拍子もない意見でも恐れずに提案します。議論では『こういう考え方もできるかも！』といったスタンスで、雰囲気を明るくし、流れを変える役割も担います。口調は軽やかで楽しげ、ややマイペースでも構いません。"
 }
 
-# モデル定義
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# キーワード親和性ルーティング用（ユーザー発言に含まれると優先的に指名される）
+agent_affinities = {
+    "エージェントA": ["データ", "根拠", "論理", "統計", "数字", "事実"],
+    "エージェントB": ["気持ち", "感情", "心", "幸せ", "人間関係", "不安"],
+    "エージェントC": ["本当", "疑問", "問題", "リスク", "欠点", "反対"],
+    "エージェントD": ["アイデア", "新しい", "発想", "面白", "未来", "自由"],
+}
+
+# ファシリテータ方式（llm / round_robin / least_recent / weighted_random / keyword）
+FACILITATOR_STRATEGY = os.getenv("FACILITATOR_STRATEGY", "llm")
+# ファシリテータ判断中に先行生成させるエージェント数（0で無効、llm方式のときのみ有効）
+SPECULATIVE_BRANCHES = int(os.getenv("SPECULATIVE_BRANCHES", "0"))
+# 過去のセッションから思い出す発言数（0で無効）
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+
+# モデル定義（役割ごとのデプロイメントとパラメータは models.json で切り替える）
+llm = get_llm("persona")
+facilitator_llm = get_llm("facilitator")
+summary_llm = get_llm("summary")
 
 # 各子エージェントチェーン生成
 def create_child_agent_chain(llm, character_defs):
@@ -31,7 +60,8 @@ def create_child_agent_chain(llm, character_defs):
             MessagesPlaceholder(variable_name="chat_history"),
             # HumanMessagePromptTemplate.from_template("{input}"),
         ])
-        agents[name] = LLMChain(llm=llm, prompt=prompt, verbose=False)
+        # トークン単位でストリーミングできるようLCELで組み立てる
+        agents[name] = prompt | llm | StrOutputParser()
     return agents
 
 # ファシリテータ（議長）エージェントを定義
@@ -54,69 +84,181 @@ def create_summary_agent_chain(llm):
     summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
     return summary_chain
 
-# ログファイルに履歴を出力
-def log_chat(log_path, role, name, content):
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(f"{role.upper()} ({name}): {content}\n")
-        f.write("-" * 50 + "\n")
+# 投機実行用：エージェントの発言をバッファへ流しながら生成する
+async def astream_agent(agent_chain, chat_history, out, config=None):
+    async for chunk in agent_chain.astream({"chat_history": chat_history}, config=config):
+        out.write(chunk)
+    return out.text
+
+
+# 議論エンジン（engine_server.py）の薄いクライアントとして動かす：表示だけを行い、議論はサーバ側で進める
+def run_engine_client(url):
+    client = EngineClient(url)
+    session_id = client.create_session()
+    print(f"🎙️ キャラエージェントたちと会話しましょう！'exit'で終了します。（エンジン: {client.base_url}）")
+
+    while True:
+        user_input = input("🧑 あなた> ")
+        if user_input.lower() == "exit":
+            client.close_session(session_id)
+            print("👋 終了します。")
+            break
+
+        try:
+            for event in client.send(session_id, user_input):
+                kind = event["type"]
+                if kind == "speaker":
+                    print(f"🗣️ ファシリテーター> {event['name']}")
+                    print(f"🤖 {event['name']}> ", end="", flush=True)
+                elif kind == "token":
+                    print(event["content"], end="", flush=True)
+                elif kind == "message":
+                    print()
+                elif kind == "warning":
+                    print(event["content"])
+                elif kind == "turn_end":
+                    print(f"📊 {event['usage']}")
+                elif kind in ("error", "cancelled", "closed"):
+                    print(f"⚠️ ターンが中断されました: {event.get('content', kind)}")
+        except KeyboardInterrupt:
+            # Ctrl-Cでサーバ側の生成も止める
+            client.cancel(session_id)
+            print("\n⏹️ ターンを停止しました")
+        except EngineClientError as e:
+            print(f"⚠️ エンジンエラー（{e.status}）: {e}")
 
 
-if __name__ == "__main__":
-    # ログファイルのパスを指定
-    log_dir = "chat_logs"
-    log_path = f"chat_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    os.makedirs(log_dir, exist_ok=True)
-    log_path = os.path.join(log_dir, log_path)
+if __name__ == "__main__" and os.getenv("DISCUSSION_ENGINE_URL"):
+    run_engine_client(os.getenv("DISCUSSION_ENGINE_URL"))
+elif __name__ == "__main__":
+    # ログはJSON Linesでバックグラウンドスレッドがまとめて書き出す（終了時にfsync）
+    chat_log = open_session_log("chat_logs")
 
     # チェーン生成
     agents = create_child_agent_chain(llm, character_defs)
-    facilitator_chain = create_facilitator_agent_chain(llm, list(character_defs.keys()))
-    summary_chain = create_summary_agent_chain(llm)
+    # ファシリテータの判断は決定的なのでキャッシュを有効にする（ペルソナの発言はキャッシュしない）
+    facilitator_chain = create_facilitator_agent_chain(with_cache(facilitator_llm), list(character_defs.keys()))
+    summary_chain = create_summary_agent_chain(summary_llm)
+    # LLM呼び出しごとのトークン数・レイテンシ集計と、1ターンあたりの予算（TURN_MAX_TOKENS / TURN_MAX_CALLS）
+    usage = UsageTracker(TurnBudget.from_env())
+    scheduler = create_scheduler(
+        FACILITATOR_STRATEGY,
+        list(agents.keys()),
+        decide=lambda user_input, chat_history: facilitator_chain.invoke({
+            "input": f"ユーザーの質問: {user_input}",
+            "chat_history": chat_history
+        }, config={"callbacks": [UsageCallbackHandler(usage, "facilitator")]})["text"],
+        # FACILITATOR_STRATEGY=constrained: 履歴の代わりに発言状況の要約を渡し、名前の列挙型から選ばせる
+        # （関数呼び出しに対応したモデルが必要なので、この方式のときだけ組み立てる）
+        constrained_decide=create_constrained_decide(with_cache(facilitator_llm), list(agents.keys()),
+                                                     callbacks=[UsageCallbackHandler(usage, "facilitator")])
+        if FACILITATOR_STRATEGY == "constrained" else None,
+        affinities=agent_affinities,
+    )
 
-    # 履歴初期化
-    chat_history = []
+    # 投機実行の準備（非同期処理は常駐ループで実行し、クライアントを使い回す）
+    speculative = SPECULATIVE_BRANCHES > 0 and FACILITATOR_STRATEGY in ("llm", "constrained")
+    runner = SpeculativeTurnRunner(SPECULATIVE_BRANCHES)
+
+    # 履歴初期化（直近の発言は原文、古い発言は要約に畳み込んでトークン予算内に収める）
+    # 発言はSQLiteに追記保存し、RESUME_SESSION=<セッションID> で続きから再開できる
+    session_id = os.getenv("RESUME_SESSION") or uuid.uuid4().hex
+    store = get_session_store()
+    resumed = not store.create_session(session_id, app="discussion")
+    history = HistoryManager(summary_chain, callbacks=[UsageCallbackHandler(usage, "summary", enforce_budget=False)],
+                             store=store, session_id=session_id, prompt_view=named_prompt_message)
+    # 過去のセッションのログを長期記憶として索引化する（今回のログは次回以降に取り込まれる）
+    memory = MemoryIndex() if MEMORY_TOP_K > 0 else None
+    if memory is not None:
+        memory.start_ingest("chat_logs", exclude=[chat_log.path])
 
     print("🎙️ キャラエージェントたちと会話しましょう！'exit'で終了します。")
+    if resumed:
+        print(f"🔁 セッション {session_id} を再開します。直近の会話:\n{format_resumed(store.recent(session_id, 4))}")
 
     while True:
         user_input = input("🧑 あなた> ")
         if user_input.lower() == "exit":
+            print(f"📊 セッション合計: {usage.session.format()}")
+            print(f"💾 セッションID: {session_id}（RESUME_SESSION={session_id} で再開できます）")
             print("👋 終了します。")
+            chat_log.close()
             break
 
-        chat_history.append({"role": "user", "content": user_input})
-        log_chat(log_path, "user", "ユーザー", user_input)
+        history.append({"role": "user", "content": user_input})
+        log_chat(chat_log, "user", "ユーザー", user_input)
+        scheduler.start_turn(user_input)
+        usage.start_turn()
+        # TURN_DEADLINE秒を過ぎたら打ち切り、それまでの発言をこのターンの結果とする
+        start_deadline()
+        recalled = format_memories(memory.search(user_input, k=MEMORY_TOP_K)) if memory is not None else ""
+        memory_messages = [{"role": "system", "content": f"関連する過去の会話（以前のセッション）:\n{recalled}"}] if recalled else []
 
         # 会話ターン数
         num_turns = len(character_defs) *1  # 各エージェントが2回発言する場合
         for turn in range(num_turns):
-            # 次に誰が話すかを決める
-            try:
-                decision = facilitator_chain.invoke({
-                    "input": f"ユーザーの質問: {user_input}",
-                    "chat_history": chat_history
-                })
-                print(f"🗣️ ファシリテーター> {decision['text']}")
-                next_agent_name = decision["text"].strip()
-                if next_agent_name not in agents:
+            chat_history = memory_messages + history.for_prompt()
+            if speculative:
+                # ファシリテータの判断中に、まだ発言していないエージェントの生成を先行させる
+                printer = StreamPrinter()
+                try:
+                    next_agent_name, result_text = run_coroutine(within_deadline(runner.arun(
+                        decide=lambda: asyncio.to_thread(scheduler.next_speaker, user_input, chat_history),
+                        run_agent=lambda name, out: astream_agent(agents[name], chat_history, out, config={"callbacks": [UsageCallbackHandler(usage, "persona", name)]}),
+                        candidates=scheduler.ranked_candidates(user_input),
+                        is_valid=lambda name: name in agents,
+                        on_decision=lambda name: print(f"🗣️ ファシリテーター> {name}"),
+                        sink_for=lambda name: printer.start(f"🤖 {name}> "),
+                    ), "投機実行"))
+                except BranchError as e:
+                    print(f"⚠️ {e.name}の発言エラー: {e.error}")
+                    break
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"\n⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ ファシリテータエラー: {e}")
+                    break
+                if result_text is None:
                     print(f"⚠️ 無効なエージェント指定: {next_agent_name}")
                     break
-            except Exception as e:
-                print(f"⚠️ ファシリテータエラー: {e}")
-                break
-
-            # 選ばれたエージェントに発言させる
-            try:
-                result = agents[next_agent_name].invoke({
-                    # "input": user_input,
-                    "chat_history": chat_history
-                })
-                print(f"🤖 {next_agent_name}> {result['text']}")
-                chat_history.append({"role": "assistant", "name": next_agent_name, "content": next_agent_name+": "+result["text"]})
-                log_chat(log_path, "assistant", next_agent_name, result["text"])
-            except Exception as e:
-                print(f"⚠️ {next_agent_name}の発言エラー: {e}")
-                break
+                printer.finish(result_text)
+            else:
+                # 次に誰が話すかを決める
+                try:
+                    next_agent_name = scheduler.next_speaker(user_input, chat_history)
+                    print(f"🗣️ ファシリテーター> {next_agent_name}")
+                    if next_agent_name not in agents:
+                        print(f"⚠️ 無効なエージェント指定: {next_agent_name}")
+                        break
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ ファシリテータエラー: {e}")
+                    break
+
+                # 選ばれたエージェントに発言させる
+                try:
+                    result_text = print_stream(f"🤖 {next_agent_name}> ", deadline_iter(agents[next_agent_name].stream({
+                        # "input": user_input,
+                        "chat_history": chat_history
+                    }, config={"callbacks": [UsageCallbackHandler(usage, "persona", next_agent_name)]}), next_agent_name))
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"\n⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ {next_agent_name}の発言エラー: {e}")
+                    break
+
+            history.append({"role": "assistant", "name": next_agent_name, "content": result_text})
+            scheduler.observe(next_agent_name)
+            log_chat(chat_log, "assistant", next_agent_name, result_text)
+
+        turn_usage = usage.end_turn()
+        print(f"📊 {turn_usage.format()}")
+        chat_log.write({"event": "turn_usage", "calls": turn_usage.calls, "prompt_tokens": turn_usage.prompt_tokens,
+                        "completion_tokens": turn_usage.completion_tokens, "latency": round(turn_usage.latency, 3)})
 
         # 最後にサマリー
         # try:
@@ -1,14 +1,32 @@
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.prompts import HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
 from langchain.chains.llm import LLMChain
+from streaming import JSONFieldStream
+from llm_cache import with_cache
+from scheduler import create_scheduler, SCHEDULER_STRATEGIES
+from facilitator import create_constrained_decide
+from history import HistoryManager
+from session_store import get_session_store, display_view, json_prompt_message
+from log_writer import open_session_log, log_chat
+from rate_limiter import rate_limit_key
+from model_registry import get_llm
+from runtime import cache_resource, RerunTimer, start_turn, render_chat
+from turn_worker import TurnWorker, TurnCancelled, call_in_turn
+from deadline import start_deadline, adeadline_iter, DeadlineExceeded
+from engine_client import EngineClient
 import os, json
 from datetime import datetime
 import streamlit as st
+import uuid
 import traceback
 import logging
 
+# 再実行ごとのオーバーヘッドを計測する
+rerun_timer = RerunTimer()
+
 # キャラ設定
 character_defs = {
     "エージェントA": "あなたは冷静で論理的な思考を得意とするエージェントです。あらゆる主張に対してデータや事実、因果関係に基づいた説明を心がけてください。感情的な主張や直感だけの意見には慎重で、理論的な裏付けがあるかを重視してください。口調はやや硬めで丁寧。議論では冷静かつ一貫性を持って振る舞ってください。",
@@ -17,13 +35,21 @@ character_defs = {
     "エージェントD": "あなたは自由な発想と独創的なアイデアを重視するエージェントです。常識にとらわれず、突拍子もない意見でも恐れずに提案します。議論では『こういう考え方もできるかも！』といったスタンスで、雰囲気を明るくし、流れを変える役割も担います。口調は軽やかで楽しげ、ややマイペースでも構いません。"
 }
 
-# モデル定義
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# キーワード親和性ルーティング用（ユーザー発言に含まれると優先的に指名される）
+agent_affinities = {
+    "エージェントA": ["データ", "根拠", "論理", "統計", "数字", "事実"],
+    "エージェントB": ["気持ち", "感情", "心", "幸せ", "人間関係", "不安"],
+    "エージェントC": ["本当", "疑問", "問題", "リスク", "欠点", "反対"],
+    "エージェントD": ["アイデア", "新しい", "発想", "面白", "未来", "自由"],
+}
+
+# モデル定義（再実行のたびに作り直さず、プロセス内の全セッションで共有する）
+@cache_resource
+def build_llms():
+    # 役割ごとのデプロイメントとパラメータは models.json で切り替える
+    return get_llm("persona"), get_llm("facilitator"), get_llm("summary")
+
+llm, facilitator_llm, summary_llm = build_llms()
 
 # 各子エージェントチェーン生成
 def create_child_agent_chain(llm, character_defs):
@@ -34,7 +60,8 @@ def create_child_agent_chain(llm, character_defs):
             MessagesPlaceholder(variable_name="chat_history"),
             # HumanMessagePromptTemplate.from_template("{input}"),
         ])
-        agents[name] = LLMChain(llm=llm, prompt=prompt, verbose=False)
+        # トークン単位でストリーミングできるようLCELで組み立てる
+        agents[name] = prompt | llm | StrOutputParser()
     return agents
 
 # ファシリテータ（議長）エージェントを定義
@@ -56,84 +83,181 @@ def create_summary_agent_chain(llm):
     summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
     return summary_chain
 
-# ログファイルに履歴を出力
-def log_chat(log_path, role, name, content):
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(f"{role.upper()} ({name}): {content}\n")
-        f.write("-" * 50 + "\n")
+# チェーンは状態を持たないので、全セッションで同じものを使う
+@cache_resource
+def build_chains():
+    return {
+        "agents": create_child_agent_chain(llm, character_defs),
+        "facilitator": create_facilitator_agent_chain(with_cache(facilitator_llm), list(character_defs.keys())),
+        "summary": create_summary_agent_chain(summary_llm),
+    }
 
-# --- Streamlit UI ---
-st.set_page_config(page_title="マルチキャラエージェントチャット", layout="wide")
-st.title("🎭 マルチキャラクターチャット")
 
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "agent_history" not in st.session_state:
-    st.session_state.agent_history = []
-if "display_chat_history" not in st.session_state:
-    st.session_state.display_chat_history = []
-if "agents" not in st.session_state:
-    st.session_state.agents = create_child_agent_chain(llm, character_defs)
-if "facilitator" not in st.session_state:
-    st.session_state.facilitator = create_facilitator_agent_chain(llm, list(character_defs.keys()))
+# 列挙型の指名は関数呼び出しに対応したモデルが必要なので、constrained方式を選んだときだけ組み立てる
+@cache_resource
+def build_constrained_decide():
+    return create_constrained_decide(with_cache(facilitator_llm), list(character_defs.keys()), call=call_in_turn)
 
-# 入力欄
-user_input = st.chat_input("あなたの質問を入力...")
-
-# 過去の会話を表示
-for msg in st.session_state.display_chat_history:
-    with st.chat_message(msg.get("name", msg["role"])):
-        st.markdown(msg["content"])
-
-if user_input:
-    st.session_state.chat_history.append({"role": "user", "content": user_input})
-    st.session_state.display_chat_history.append({"role": "user", "content": user_input})
-    with st.chat_message("user"):
-        st.markdown(user_input)
+chains = build_chains()
 
-    st.session_state.agent_history = []  # エージェントの発言履歴を初期化
+# 1ターン分の議論（ワーカースレッドで実行するため、st.session_stateには触れない）
+def run_discussion_turn(turn, user_input, history, scheduler, agent_history, chat_log):
+    agent_history.clear()  # エージェントの発言履歴を初期化
+    scheduler.start_turn(user_input)
+    # TURN_DEADLINE秒を過ぎたら打ち切り、それまでの発言をこのターンの結果とする（ワーカースレッドのコンテキストに設定）
+    start_deadline()
 
     # エージェントの発言ターン数
     for _ in range(len(character_defs)):
+        next_agent_name = None
         try:
-            decision = st.session_state.facilitator.invoke({
-                "input": f"{user_input}",
-                "agent_history": st.session_state.agent_history
-            })
-            next_agent_name = decision["text"].strip()
-            if next_agent_name not in st.session_state.agents:
-                st.warning(f"⚠️ 無効なエージェント指定: {next_agent_name}")
+            turn.check()
+            next_agent_name = scheduler.next_speaker(user_input, history.for_prompt())
+            turn.check()
+            if next_agent_name not in chains["agents"]:
+                turn.emit("warning", content=f"⚠️ 無効なエージェント指定: {next_agent_name}")
                 break
 
-            st.session_state.agent_history.append(next_agent_name)
-            
-            result = st.session_state.agents[next_agent_name].invoke({
-                "chat_history": st.session_state.chat_history
-            })
+            agent_history.append(next_agent_name)
+            scheduler.observe(next_agent_name)
+
+            # JSON出力のcontent部分だけを生成され次第送る（停止ボタンで生成中のリクエストも打ち切る）
+            turn.emit("speaker", next_agent_name[-1])
+            stream = JSONFieldStream(turn.stream(adeadline_iter(chains["agents"][next_agent_name].astream({
+                "chat_history": history.for_prompt()
+            }), next_agent_name)))
+            for token in stream:
+                turn.emit("token", next_agent_name[-1], token)
 
-            response = json.loads(result["text"].replace("'", "\""))
+            response = json.loads(stream.raw.replace("'", "\""))
             name = response.get("name")
             content = response.get("content", "無効なレスポンス")
 
             if content != "無効なレスポンス":
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "name": next_agent_name[-1],
-                    "content": f"{{'name': '{name}', 'content': '{content}'}}"
-                })
-            st.session_state.display_chat_history.append({
-                "role": "assistant",
-                "name": next_agent_name[-1],
-                "content": content
-            })
-            with st.chat_message(next_agent_name[-1]):
-                st.markdown(content)
+                # 保存するのは発言そのもの。プロンプト用の {'name': ..., 'content': ...} 形式はビューで作る
+                history.append({"role": "assistant", "name": next_agent_name, "content": content})
+            turn.emit("message", next_agent_name[-1], content)
+            log_chat(chat_log, "assistant", next_agent_name, content)
 
+        except TurnCancelled:
+            raise
+        except DeadlineExceeded as e:
+            turn.emit("warning", content=f"⛔ {e}")
+            break
         except Exception as e:
-            # st.error(f"エラー: {e}")
-            # break
             error_message = traceback.format_exc()
+            turn.emit("warning", content=f"⚠️ {next_agent_name}の発言エラー: {error_message}")
+
+# 再開時に表示する発言数
+DISPLAY_HISTORY_LIMIT = int(os.getenv("DISPLAY_HISTORY_LIMIT", "200"))
+
+# 議論エンジン（engine_server.py）が設定されていれば、議論はサーバ側で進めて表示だけを行う
+engine_client = EngineClient() if os.getenv("DISCUSSION_ENGINE_URL") else None
 
-            st.warning(f"⚠️ {next_agent_name}の発言エラー: {error_message}")
+def run_remote_turn(turn, client, session_id, user_input):
+    try:
+        for event in turn.stream(client.asend(session_id, user_input)):
+            kind = event["type"]
+            if kind in ("speaker", "token", "message"):
+                turn.emit(kind, event["name"][-1], event.get("content", ""))
+            elif kind == "warning":
+                turn.emit("warning", content=event["content"])
+            elif kind in ("error", "closed"):
+                turn.emit("warning", content=f"⚠️ ターンが中断されました: {event.get('content', kind)}")
+    except TurnCancelled:
+        # サーバ側で実行中の生成も止める
+        client.cancel(session_id)
+        raise
+
+def display_extra(message):
+    # 画面では発言者をアルファベット1文字のアイコンで表示する
+    return {"name": message["name"][-1]} if message["role"] == "assistant" and message.get("name") else {}
+
+def render_message(msg):
+    with st.chat_message(msg.get("name", msg["role"])):
+        st.markdown(msg["content"])
+
+# --- Streamlit UI ---
+st.set_page_config(page_title="マルチキャラエージェントチャット", layout="wide")
+st.title("🎭 マルチキャラクターチャット")
+
+# 発言はSQLiteに追記保存し、URLの ?session=<セッションID> で続きから再開できる
+store = get_session_store()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = st.query_params.get("session") or uuid.uuid4().hex
+    st.query_params["session"] = st.session_state.session_id
+    if engine_client is None:
+        store.create_session(st.session_state.session_id, app="discussion_streamlit")
+# 複数セッションが同じデプロイメントを使うため、レートリミッタの待ち行列はセッション単位で公平に回す
+rate_limit_key.set(st.session_state.session_id)
+st.sidebar.caption(f"セッションID: {st.session_state.session_id}")
+
+if "history" not in st.session_state:
+    # 直近の発言は原文、古い発言は要約に畳み込んでトークン予算内に収める（メモリ上には直近分だけを持つ）
+    st.session_state.history = HistoryManager(chains["summary"], store=store, session_id=st.session_state.session_id,
+                                              prompt_view=json_prompt_message)
+if "chat_log" not in st.session_state:
+    # セッションごとのJSON Linesログ（書き込みはバックグラウンドスレッドで行う）
+    st.session_state.chat_log = open_session_log("chat_logs")
+if "agent_history" not in st.session_state:
+    st.session_state.agent_history = []
+if "display_chat_history" not in st.session_state:
+    # 再開時は保存済みの直近の発言から表示用の履歴を作る
+    if engine_client is not None:
+        saved = engine_client.recent(st.session_state.session_id, DISPLAY_HISTORY_LIMIT)
+    else:
+        saved = store.recent(st.session_state.session_id, DISPLAY_HISTORY_LIMIT)
+    st.session_state.display_chat_history = display_view(saved, display_extra)
+if "turn_worker" not in st.session_state:
+    st.session_state.turn_worker = TurnWorker()
+worker = st.session_state.turn_worker
+
+# ファシリテータ方式の選択（llm以外はLLMを呼ばずにローカルで決定する）
+strategy = st.sidebar.selectbox(
+    "ファシリテーター方式",
+    SCHEDULER_STRATEGIES,
+    index=SCHEDULER_STRATEGIES.index(os.getenv("FACILITATOR_STRATEGY", "llm")),
+)
+if st.session_state.get("scheduler_strategy") != strategy:
+    st.session_state.scheduler_strategy = strategy
+    st.session_state.scheduler = create_scheduler(
+        strategy,
+        list(character_defs.keys()),
+        # ワーカースレッドから呼ばれるため、session_stateではなくリストを直接束縛する
+        # 指名の呼び出しもターンのcall経由で待ち、停止ボタンで打ち切れるようにする
+        decide=lambda user_input, chat_history, agent_history=st.session_state.agent_history: call_in_turn(chains["facilitator"].ainvoke({
+            "input": f"{user_input}",
+            "agent_history": agent_history
+        }))["text"],
+        constrained_decide=build_constrained_decide() if strategy == "constrained" else None,
+        affinities=agent_affinities,
+    )
+
+# 入力欄
+user_input = st.chat_input("あなたの質問を入力...", disabled=worker.running)
+rerun_timer.mark("セットアップ")
+
+if user_input:
+    st.session_state.display_chat_history.append({"role": "user", "content": user_input})
+    # ターンはワーカースレッドで実行し、発言は届いた順に逐次表示する
+    if engine_client is not None:
+        # 履歴の保存もエンジン側で行う（同じセッションIDで再開する）
+        if "engine_session_id" not in st.session_state:
+            st.session_state.engine_session_id = engine_client.create_session(st.session_state.session_id)
+        start_turn(worker, run_remote_turn, engine_client, st.session_state.engine_session_id, user_input)
+    else:
+        st.session_state.history.append({"role": "user", "content": user_input})
+        log_chat(st.session_state.chat_log, "user", "ユーザー", user_input)
+        start_turn(
+            worker,
+            run_discussion_turn,
+            user_input,
+            st.session_state.history,
+            st.session_state.scheduler,
+            st.session_state.agent_history,
+            st.session_state.chat_log,
+        )
 
+render_chat(worker, render_message)
 
+rerun_timer.render()
@@ -0,0 +1,377 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+from discussion_agent import (
+    character_defs,
+    agent_affinities,
+    llm,
+    facilitator_llm,
+    summary_llm,
+    create_child_agent_chain,
+    create_facilitator_agent_chain,
+    create_summary_agent_chain,
+)
+from llm_cache import with_cache
+from scheduler import create_scheduler
+from facilitator import create_constrained_decide
+from history import HistoryManager
+from session_store import get_session_store, named_prompt_message, display_view
+from log_writer import open_session_log, log_chat
+from memory_index import MemoryIndex, format_memories
+from accounting import UsageTracker, UsageCallbackHandler, TurnBudget, BudgetExceeded
+from deadline import start_deadline, adeadline_iter, DeadlineExceeded
+from rate_limiter import rate_limit_key
+
+logger = logging.getLogger(__name__)
+
+# 1つのストリームを終わらせるイベント
+TERMINAL_EVENTS = ("turn_end", "cancelled", "error", "closed")
+
+
+class EngineError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class EngineConfig:
+    max_sessions: int = 100
+    # 同時に進行できるターン数と、その空きを待てるターン数（超えたら429）
+    max_concurrent_turns: int = 8
+    max_queued_turns: int = 32
+    # セッションごとのイベントバッファ。満杯になると生成側が待つ（バックプレッシャ）
+    event_buffer: int = 256
+    # 読み手がいないまま止まったターンを打ち切るまでの秒数
+    stall_timeout: float = 60.0
+    max_input_chars: int = 4000
+    # 操作のないセッションは履歴をメモリから捨て（evict_after）、さらに放置されたらセッションごと外す（session_ttl）。
+    # どちらもSQLiteに残っているので、同じIDでアクセスされれば読み直す
+    evict_after: float = 300.0
+    session_ttl: float = 1800.0
+    shutdown_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "EngineConfig":
+        return cls(
+            max_sessions=int(os.getenv("ENGINE_MAX_SESSIONS", "100")),
+            max_concurrent_turns=int(os.getenv("ENGINE_MAX_CONCURRENT_TURNS", "8")),
+            max_queued_turns=int(os.getenv("ENGINE_MAX_QUEUED_TURNS", "32")),
+            event_buffer=int(os.getenv("ENGINE_EVENT_BUFFER", "256")),
+            stall_timeout=float(os.getenv("ENGINE_STALL_TIMEOUT", "60")),
+            max_input_chars=int(os.getenv("ENGINE_MAX_INPUT_CHARS", "4000")),
+            evict_after=float(os.getenv("ENGINE_EVICT_AFTER", "300")),
+            session_ttl=float(os.getenv("ENGINE_SESSION_TTL", "1800")),
+            shutdown_timeout=float(os.getenv("ENGINE_SHUTDOWN_TIMEOUT", "30")),
+        )
+
+
+# ========== セッション ==========
+class DiscussionSession:
+    def __init__(self, session_id: str, history: HistoryManager, scheduler, usage: UsageTracker, event_buffer: int):
+        self.id = session_id
+        self.history = history
+        self.scheduler = scheduler
+        self.usage = usage
+        self.events: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=event_buffer)
+        self.turn: Optional[asyncio.Task] = None
+        self.turn_count = 0
+        self.streaming = False
+        self.closed = False
+        self.last_active = time.monotonic()
+
+    @property
+    def busy(self) -> bool:
+        return self.turn is not None and not self.turn.done()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+
+# ========== 議論エンジン ==========
+class DiscussionEngine:
+    """複数セッションの議論を1つのイベントループ上で進める。
+
+    チェーン・LLMクライアント・長期記憶は全セッションで共有し、
+    会話履歴・スケジューラ・トークン集計だけをセッションごとに持つ。
+    """
+
+    def __init__(self, config: Optional[EngineConfig] = None, strategy: Optional[str] = None,
+                 memory_top_k: Optional[int] = None, log_dir: str = "chat_logs"):
+        self.config = config or EngineConfig.from_env()
+        self.strategy = strategy or os.getenv("FACILITATOR_STRATEGY", "llm")
+        self.memory_top_k = memory_top_k if memory_top_k is not None else int(os.getenv("MEMORY_TOP_K", "3"))
+        self.agents = create_child_agent_chain(llm, character_defs)
+        # ファシリテータの判断は決定的なのでキャッシュを有効にする（ペルソナの発言はキャッシュしない）
+        self.cached_llm = with_cache(facilitator_llm)
+        self.facilitator_chain = create_facilitator_agent_chain(self.cached_llm, list(character_defs.keys()))
+        self.summary_chain = create_summary_agent_chain(summary_llm)
+        # 全セッションの発言を1つのログにまとめ、session_idで区別する
+        self.chat_log = open_session_log(log_dir, prefix="engine")
+        self.store = get_session_store()
+        self.memory = MemoryIndex() if self.memory_top_k > 0 else None
+        if self.memory is not None:
+            self.memory.start_ingest(log_dir, exclude=[self.chat_log.path])
+        self.sessions: dict[str, DiscussionSession] = {}
+        self._turn_slots = asyncio.Semaphore(self.config.max_concurrent_turns)
+        self._pending_turns = 0
+        self._closing = False
+        self._reaper: Optional[asyncio.Task] = None
+
+    # ---------- セッション管理 ----------
+    def create_session(self, session_id: Optional[str] = None) -> DiscussionSession:
+        # session_id を渡すと、保存済みのセッションを再開する（無ければそのIDで新規作成）
+        if session_id is not None and session_id in self.sessions:
+            return self.get_session(session_id)
+        if self._closing:
+            raise EngineError(503, "シャットダウン中です")
+        if len(self.sessions) >= self.config.max_sessions:
+            raise EngineError(429, f"セッション数が上限（{self.config.max_sessions}）に達しています")
+        session_id = session_id or uuid.uuid4().hex
+        self.store.create_session(session_id, app="engine")
+        usage = UsageTracker(TurnBudget.from_env())
+        history = HistoryManager(self.summary_chain, callbacks=[UsageCallbackHandler(usage, "summary", enforce_budget=False)],
+                                 store=self.store, session_id=session_id, prompt_view=named_prompt_message)
+        scheduler = create_scheduler(
+            self.strategy,
+            list(self.agents.keys()),
+            decide=lambda user_input, chat_history: self.facilitator_chain.invoke({
+                "input": f"ユーザーの質問: {user_input}",
+                "chat_history": chat_history
+            }, config={"callbacks": [UsageCallbackHandler(usage, "facilitator")]})["text"],
+            constrained_decide=create_constrained_decide(self.cached_llm, list(self.agents.keys()),
+                                                         callbacks=[UsageCallbackHandler(usage, "facilitator")])
+            if self.strategy == "constrained" else None,
+            affinities=agent_affinities,
+        )
+        session = DiscussionSession(session_id, history, scheduler, usage, self.config.event_buffer)
+        self.sessions[session_id] = session
+        if self._reaper is None:
+            self._reaper = asyncio.ensure_future(self._reap_idle())
+        return session
+
+    def get_session(self, session_id: str) -> DiscussionSession:
+        session = self.sessions.get(session_id)
+        if session is None:
+            # メモリから外れたセッションは、保存済みなら読み直す
+            if not self.store.exists(session_id):
+                raise EngineError(404, f"セッションが見つかりません: {session_id}")
+            session = self.create_session(session_id)
+        session.touch()
+        return session
+
+    def recent(self, session_id: str, limit: int = 50) -> list[dict]:
+        self.get_session(session_id)
+        return display_view(self.store.recent(session_id, limit))
+
+    async def close_session(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        session.closed = True
+        if session.busy:
+            session.turn.cancel()
+            await asyncio.gather(session.turn, return_exceptions=True)
+        self._publish_nowait(session, {"type": "closed"})
+
+    async def _reap_idle(self):
+        # 一定時間操作のないセッションのメモリを解放する（履歴はSQLiteに残る）
+        while not self._closing:
+            await asyncio.sleep(min(60.0, self.config.evict_after, self.config.session_ttl))
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if session.busy or session.streaming:
+                    continue
+                idle = now - session.last_active
+                if idle > self.config.session_ttl:
+                    await self.close_session(session_id)
+                elif idle > self.config.evict_after:
+                    session.history.evict()
+
+    # ---------- ターンの開始・停止 ----------
+    def send(self, session_id: str, user_input: str) -> int:
+        session = self.get_session(session_id)
+        if self._closing:
+            raise EngineError(503, "シャットダウン中です")
+        if not user_input.strip():
+            raise EngineError(400, "発言が空です")
+        if len(user_input) > self.config.max_input_chars:
+            raise EngineError(413, f"発言が長すぎます（上限{self.config.max_input_chars}文字）")
+        if session.busy:
+            raise EngineError(409, "前のターンがまだ実行中です")
+        if self._pending_turns >= self.config.max_concurrent_turns + self.config.max_queued_turns:
+            raise EngineError(429, "混雑しています。しばらくしてから再度お試しください")
+        if not session.streaming:
+            # 誰にも読まれなかった前のターンのイベントは捨てる
+            while not session.events.empty():
+                session.events.get_nowait()
+        session.turn_count += 1
+        self._pending_turns += 1
+        session.turn = asyncio.ensure_future(self._run_turn(session, user_input, session.turn_count))
+        return session.turn_count
+
+    def cancel(self, session_id: str) -> bool:
+        session = self.get_session(session_id)
+        if not session.busy:
+            return False
+        session.turn.cancel()
+        return True
+
+    # ---------- イベントの配信 ----------
+    async def _publish(self, session: DiscussionSession, event: dict):
+        # 読み手が追いつくまで待つ。読み手がいないまま止まったら打ち切る
+        try:
+            await asyncio.wait_for(session.events.put(event), self.config.stall_timeout)
+        except asyncio.TimeoutError:
+            raise EngineError(504, "イベントの読み手がいないためターンを打ち切りました")
+
+    def _publish_nowait(self, session: DiscussionSession, event: dict):
+        # 終了通知などは待たずに入れる（満杯なら古いイベントを捨てる）
+        while True:
+            try:
+                session.events.put_nowait(event)
+                return
+            except asyncio.QueueFull:
+                session.events.get_nowait()
+
+    def stream(self, session_id: str, heartbeat: float = 15.0) -> AsyncIterator[Optional[dict]]:
+        """1ターン分のイベントを返す。Noneはハートビート（接続維持用）。"""
+        # セッションの存在と多重接続は、レスポンスを返し始める前にここで確認する
+        session = self.get_session(session_id)
+        if session.streaming:
+            raise EngineError(409, "このセッションは別の接続がストリーム中です")
+        return self._iter_events(session, heartbeat)
+
+    async def _iter_events(self, session: DiscussionSession, heartbeat: float) -> AsyncIterator[Optional[dict]]:
+        session.streaming = True
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(session.events.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    if session.closed:
+                        return
+                    yield None
+                    continue
+                session.touch()
+                yield event
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            session.streaming = False
+
+    # ---------- 1ターン分の議論 ----------
+    async def _run_turn(self, session: DiscussionSession, user_input: str, turn_id: int):
+        # レートリミッタの待ち行列をセッション単位で公平に回す（タスクごとのコンテキストに設定される）
+        rate_limit_key.set(session.id)
+        try:
+            async with self._turn_slots:
+                # 空きを待った時間は含めず、実行を始めてから TURN_DEADLINE 秒で打ち切る
+                start_deadline()
+                await self._publish(session, {"type": "turn_start", "turn_id": turn_id})
+                await self._discuss(session, user_input, turn_id)
+                turn_usage = session.usage.end_turn()
+                self.chat_log.write({"event": "turn_usage", "session_id": session.id, "calls": turn_usage.calls,
+                                     "prompt_tokens": turn_usage.prompt_tokens, "completion_tokens": turn_usage.completion_tokens,
+                                     "latency": round(turn_usage.latency, 3)})
+                await self._publish(session, {"type": "turn_end", "turn_id": turn_id, "usage": turn_usage.format()})
+        except asyncio.CancelledError:
+            self._publish_nowait(session, {"type": "cancelled", "turn_id": turn_id})
+        except EngineError as e:
+            logger.warning(f"session {session.id}: {e}")
+            self._publish_nowait(session, {"type": "error", "turn_id": turn_id, "content": str(e)})
+        except Exception as e:
+            logger.exception(f"session {session.id}: turn failed")
+            self._publish_nowait(session, {"type": "error", "turn_id": turn_id, "content": str(e)})
+        finally:
+            self._pending_turns -= 1
+            session.touch()
+
+    async def _discuss(self, session: DiscussionSession, user_input: str, turn_id: int):
+        history, scheduler = session.history, session.scheduler
+        history.append({"role": "user", "content": user_input})
+        log_chat(self.chat_log, "user", "ユーザー", user_input, session_id=session.id)
+        scheduler.start_turn(user_input)
+        session.usage.start_turn()
+        recalled = ""
+        if self.memory is not None:
+            hits = await asyncio.to_thread(self.memory.search, user_input, self.memory_top_k)
+            recalled = format_memories(hits)
+        memory_messages = [{"role": "system", "content": f"関連する過去の会話（以前のセッション）:\n{recalled}"}] if recalled else []
+
+        for _ in range(len(self.agents)):
+            chat_history = memory_messages + history.for_prompt()
+            # 次に誰が話すかを決める（LLMファシリテータは同期APIなのでスレッドで待つ）
+            try:
+                name = await asyncio.to_thread(scheduler.next_speaker, user_input, chat_history)
+            except (BudgetExceeded, DeadlineExceeded) as e:
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⛔ {e}"})
+                break
+            except Exception as e:
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⚠️ ファシリテータエラー: {e}"})
+                break
+            if name not in self.agents:
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⚠️ 無効なエージェント指定: {name}"})
+                break
+
+            await self._publish(session, {"type": "speaker", "turn_id": turn_id, "name": name})
+            text = ""
+            try:
+                stream = self.agents[name].astream({"chat_history": chat_history},
+                                                   config={"callbacks": [UsageCallbackHandler(session.usage, "persona", name)]})
+                async for chunk in adeadline_iter(stream, name):
+                    text += chunk
+                    await self._publish(session, {"type": "token", "turn_id": turn_id, "name": name, "content": chunk})
+            except DeadlineExceeded as e:
+                # 時間切れ。途中まで流した発言はそのまま残してターンを終える
+                if text:
+                    history.append({"role": "assistant", "name": name, "content": text, "partial": True})
+                    scheduler.observe(name)
+                    await self._publish(session, {"type": "message", "turn_id": turn_id, "name": name, "content": text, "partial": True})
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⛔ {e}"})
+                break
+            except BudgetExceeded as e:
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⛔ {e}"})
+                break
+            except EngineError:
+                raise
+            except Exception as e:
+                await self._publish(session, {"type": "warning", "turn_id": turn_id, "content": f"⚠️ {name}の発言エラー: {e}"})
+                break
+
+            history.append({"role": "assistant", "name": name, "content": text})
+            scheduler.observe(name)
+            log_chat(self.chat_log, "assistant", name, text, session_id=session.id)
+            await self._publish(session, {"type": "message", "turn_id": turn_id, "name": name, "content": text})
+
+    # ---------- 終了処理 ----------
+    async def shutdown(self, timeout: Optional[float] = None):
+        """新しいターンを受け付けず、実行中のターンの完了を待ってから閉じる。"""
+        self._closing = True
+        timeout = self.config.shutdown_timeout if timeout is None else timeout
+        running = [s.turn for s in self.sessions.values() if s.busy]
+        if running:
+            _, pending = await asyncio.wait(running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for session_id in list(self.sessions):
+            await self.close_session(session_id)
+        if self._reaper is not None:
+            self._reaper.cancel()
+        self.chat_log.close()
+        if self.memory is not None:
+            self.memory.close()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "running_turns": sum(1 for s in self.sessions.values() if s.busy),
+            "pending_turns": self._pending_turns,
+            "closing": self._closing,
+        }
@@ -0,0 +1,93 @@
+import os
+import json
+from typing import AsyncIterator, Iterator, Optional
+
+import httpx
+
+
+class EngineClientError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _check(response: httpx.Response):
+    if response.status_code >= 400:
+        try:
+            message = response.json().get("error", response.text)
+        except ValueError:
+            message = response.text
+        raise EngineClientError(response.status_code, message)
+
+
+class _SSEParser:
+    # 1行ずつ渡し、イベントの区切り（空行）で data をJSONとして返す。コメント行（ハートビート）は無視する
+    def __init__(self):
+        self._data: list[str] = []
+
+    def feed(self, line: str) -> Optional[dict]:
+        if line.startswith("data:"):
+            self._data.append(line[5:].strip())
+        elif not line and self._data:
+            event = json.loads("\n".join(self._data))
+            self._data = []
+            return event
+        return None
+
+
+# ========== 議論エンジンのクライアント ==========
+class EngineClient:
+    """engine_server.py のHTTPサービスに発言を送り、イベントを受け取る薄いクライアント。"""
+
+    def __init__(self, base_url: Optional[str] = None, timeout: float = 30.0):
+        self.base_url = (base_url or os.getenv("DISCUSSION_ENGINE_URL", "http://127.0.0.1:8100")).rstrip("/")
+        # ストリームは長く開いたままになるので、読み取りタイムアウトはハートビート間隔より長くする
+        self.timeout = httpx.Timeout(timeout, read=60.0)
+
+    def create_session(self, session_id: Optional[str] = None) -> str:
+        # session_id を渡すと保存済みのセッションを再開する
+        body = {"session_id": session_id} if session_id else {}
+        response = httpx.post(f"{self.base_url}/sessions", json=body, timeout=self.timeout)
+        _check(response)
+        return response.json()["session_id"]
+
+    def recent(self, session_id: str, limit: int = 50) -> list[dict]:
+        response = httpx.get(f"{self.base_url}/sessions/{session_id}/messages", params={"limit": limit}, timeout=self.timeout)
+        if response.status_code == 404:
+            return []
+        _check(response)
+        return response.json()["messages"]
+
+    def close_session(self, session_id: str):
+        _check(httpx.delete(f"{self.base_url}/sessions/{session_id}", timeout=self.timeout))
+
+    def cancel(self, session_id: str) -> bool:
+        response = httpx.post(f"{self.base_url}/sessions/{session_id}/cancel", timeout=self.timeout)
+        _check(response)
+        return response.json()["cancelled"]
+
+    def send(self, session_id: str, content: str) -> Iterator[dict]:
+        # 発言を送り、そのターンのイベントを終わりまで返す
+        with httpx.stream("POST", f"{self.base_url}/sessions/{session_id}/messages",
+                          json={"content": content, "stream": True}, timeout=self.timeout) as response:
+            if response.status_code >= 400:
+                response.read()
+                _check(response)
+            parser = _SSEParser()
+            for line in response.iter_lines():
+                event = parser.feed(line)
+                if event is not None:
+                    yield event
+
+    async def asend(self, session_id: str, content: str) -> AsyncIterator[dict]:
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            async with client.stream("POST", f"{self.base_url}/sessions/{session_id}/messages",
+                                     json={"content": content, "stream": True}) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    _check(response)
+                parser = _SSEParser()
+                async for line in response.aiter_lines():
+                    event = parser.feed(line)
+                    if event is not None:
+                        yield event
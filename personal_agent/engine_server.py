@@ -0,0 +1,220 @@
+import re
+import json
+import signal
+import asyncio
+import logging
+import argparse
+from typing import Optional
+from urllib.parse import parse_qs
+
+from discussion_engine import DiscussionEngine, EngineConfig, EngineError
+
+logger = logging.getLogger(__name__)
+
+# ========== 議論エンジンのHTTPサービス ==========
+# 依存を増やさないよう、asyncioのストリーム上に最小限のHTTP/1.1を実装する（1リクエスト1接続）。
+#   POST   /sessions                        セッション作成 → {"session_id"}（{"session_id": ID} を渡すと再開）
+#   GET    /sessions/{id}/messages?limit=N  保存済みの直近N件の発言
+#   POST   /sessions/{id}/messages          発言を送ってターン開始 → 202 {"turn_id"}
+#                                           {"stream": true} ならそのままSSEでターンの終わりまで返す
+#   GET    /sessions/{id}/stream            実行中（または次）のターンのイベントをSSEで返す
+#   POST   /sessions/{id}/cancel            実行中のターンを止める
+#   DELETE /sessions/{id}                   セッションを閉じる
+#   GET    /healthz                         エンジンの状態
+
+MAX_BODY_BYTES = 1024 * 1024
+_SESSION_ID_RE = re.compile(r"^[0-9a-f]{1,64}$")
+_SESSION_RE = re.compile(r"^/sessions/([0-9a-f]{1,64})(?:/(messages|stream|cancel))?$")
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+            503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class HTTPRequest:
+    def __init__(self, method: str, path: str, headers: dict, body: bytes, query: Optional[dict] = None):
+        self.method = method
+        self.path = path
+        self.query = query or {}
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> dict:
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise EngineError(400, "JSONとして読めません")
+        if not isinstance(data, dict):
+            raise EngineError(400, "JSONオブジェクトを送ってください")
+        return data
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[HTTPRequest]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise EngineError(400, "不正なリクエスト行です")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0") or 0)
+    if length > MAX_BODY_BYTES:
+        raise EngineError(413, "リクエストが大きすぎます")
+    body = await reader.readexactly(length) if length else b""
+    path, _, query = target.partition("?")
+    return HTTPRequest(method.upper(), path, headers, body, {k: v[-1] for k, v in parse_qs(query).items()})
+
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        f"Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+
+async def _send_sse(writer: asyncio.StreamWriter, engine: DiscussionEngine, session_id: str):
+    # ヘッダを送る前にセッションの存在や多重接続を確認する（エラーならJSONで返る）
+    events = engine.stream(session_id)
+    writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+        b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+    )
+    try:
+        async for event in events:
+            if event is None:
+                writer.write(b": keep-alive\n\n")
+            else:
+                data = json.dumps(event, ensure_ascii=False)
+                writer.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+            # 送信バッファが捌けるまで待つ（遅い読み手に合わせてエンジン側のキューが詰まる）
+            await writer.drain()
+    finally:
+        await events.aclose()
+
+
+class EngineServer:
+    def __init__(self, engine: DiscussionEngine, host: str = "127.0.0.1", port: int = 8100):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set[asyncio.Task] = set()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = await _read_request(reader)
+            if request is not None:
+                await self._dispatch(request, writer)
+        except EngineError as e:
+            await _send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception("request failed")
+            await _send_json(writer, 500, {"error": str(e)})
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _dispatch(self, request: HTTPRequest, writer: asyncio.StreamWriter):
+        engine = self.engine
+        if request.path == "/healthz" and request.method == "GET":
+            return await _send_json(writer, 200, engine.stats())
+        if request.path == "/sessions" and request.method == "POST":
+            session_id = request.json().get("session_id")
+            if session_id is not None and not _SESSION_ID_RE.match(str(session_id)):
+                raise EngineError(400, "セッションIDは英小文字の16進数で指定してください")
+            session = engine.create_session(session_id)
+            return await _send_json(writer, 200, {"session_id": session.id})
+        match = _SESSION_RE.match(request.path)
+        if not match:
+            raise EngineError(404, f"not found: {request.path}")
+        session_id, action = match.groups()
+        if action is None and request.method == "DELETE":
+            engine.get_session(session_id)
+            await engine.close_session(session_id)
+            return await _send_json(writer, 200, {"closed": session_id})
+        if action == "messages" and request.method == "GET":
+            try:
+                limit = min(int(request.query.get("limit", "50")), 1000)
+            except ValueError:
+                raise EngineError(400, "limitは整数で指定してください")
+            return await _send_json(writer, 200, {"messages": engine.recent(session_id, limit)})
+        if action == "messages" and request.method == "POST":
+            body = request.json()
+            turn_id = engine.send(session_id, str(body.get("content", "")))
+            if body.get("stream"):
+                return await _send_sse(writer, engine, session_id)
+            return await _send_json(writer, 202, {"turn_id": turn_id})
+        if action == "stream" and request.method == "GET":
+            return await _send_sse(writer, engine, session_id)
+        if action == "cancel" and request.method == "POST":
+            return await _send_json(writer, 200, {"cancelled": engine.cancel(session_id)})
+        raise EngineError(405, f"{request.method} {request.path} は使えません")
+
+    async def start(self) -> "EngineServer":
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def shutdown(self):
+        # 新しい接続を止め、実行中のターンを待ってから、残ったストリームを閉じる
+        if self._server is not None:
+            self._server.close()
+        await self.engine.shutdown()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=5)
+        for task in list(self._connections):
+            task.cancel()
+
+
+async def serve(host: str, port: int):
+    engine = DiscussionEngine(EngineConfig.from_env())
+    server = await EngineServer(engine, host, port).start()
+    print(f"🎙️ discussion engine listening on {server.url}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windowsではシグナルハンドラを登録できないのでCtrl-Cの例外で止める
+            pass
+    try:
+        await stop.wait()
+    finally:
+        print("👋 シャットダウンします（実行中のターンの完了を待っています）")
+        await server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="議論エンジンのHTTPサービス")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+from typing import Any, Awaitable, Callable, Optional
+
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+
+# 指名は関数呼び出しの引数（{"name": "..."}）だけなので、出力トークンはごく少なくてよい
+FACILITATOR_MAX_TOKENS = int(os.getenv("FACILITATOR_MAX_TOKENS", "24"))
+
+CHOOSE_SPEAKER = "choose_speaker"
+
+
+def speaker_tool(agent_names: list[str]) -> dict:
+    # エージェント名の列挙型しか受け付けない関数スキーマ
+    return {
+        "type": "function",
+        "function": {
+            "name": CHOOSE_SPEAKER,
+            "description": "次に発言するエージェントを1人選ぶ",
+            "parameters": {
+                "type": "object",
+                "properties": {"name": {"type": "string", "enum": list(agent_names)}},
+                "required": ["name"],
+            },
+        },
+    }
+
+
+# ========== 列挙型で指名させるファシリテータ ==========
+def create_constrained_facilitator(llm, agent_names: list[str], max_tokens: Optional[int] = None):
+    prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content=f"あなたはファシリテーターです。発言状況をもとに、次に発言すべきエージェント（{'/'.join(agent_names)}）を{CHOOSE_SPEAKER}で1人選んでください。今回まだ発言していないエージェントと、質問の内容に詳しいエージェントを優先してください。"),
+        HumanMessagePromptTemplate.from_template("{summary}"),
+    ])
+    bound = llm.bind_tools([speaker_tool(agent_names)], tool_choice=CHOOSE_SPEAKER).bind(
+        max_tokens=max_tokens or FACILITATOR_MAX_TOKENS,
+        temperature=0,
+    )
+    return prompt | bound
+
+
+def parse_choice(message) -> str:
+    # 関数呼び出しの引数を優先し、無ければ本文を返す（補正はスケジューラ側で行う）
+    for call in getattr(message, "tool_calls", None) or []:
+        name = (call.get("args") or {}).get("name")
+        if name:
+            return name
+    return getattr(message, "content", "") or ""
+
+
+def create_constrained_decide(llm, agent_names: list[str], callbacks: Optional[list] = None,
+                              max_tokens: Optional[int] = None,
+                              call: Optional[Callable[[Awaitable], Any]] = None) -> Callable[[str, str], str]:
+    """ConstrainedFacilitatorScheduler に渡す decide(user_input, summary) を作る。
+
+    call を渡すと、同期のinvokeの代わりにainvokeのコルーチンをcallに渡して待つ（停止ボタンで打ち切れるようにする）。
+    """
+    chain = create_constrained_facilitator(llm, agent_names, max_tokens)
+    config = {"callbacks": callbacks, "metadata": {"role": "facilitator"}}
+
+    def decide(user_input: str, summary: str) -> str:
+        if call is not None:
+            return parse_choice(call(chain.ainvoke({"summary": summary}, config=config)))
+        return parse_choice(chain.invoke({"summary": summary}, config=config))
+
+    return decide
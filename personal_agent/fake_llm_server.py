@@ -0,0 +1,356 @@
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+from token_utils import estimate_message_tokens, estimate_tokens
+
+# ========== オフライン用のAzure chat-completions互換サーバ ==========
+# AZURE_OPENAI_ENDPOINT=http://127.0.0.1:<port> を指定すると、AzureChatOpenAI /
+# OpenAIChatCustom のどちらも実エンドポイントの代わりにこのサーバを呼ぶ。
+
+
+@dataclass
+class FakeLLMConfig:
+    # 最初のトークンまでの待ち時間（対数正規分布の中央値と広がり）
+    latency_median: float = 0.3
+    latency_sigma: float = 0.4
+    # 生成速度（トークン/秒）と1応答あたりの出力トークン数
+    token_rate: float = 80.0
+    completion_tokens: int = 120
+    # ReActエージェントが最終回答までに呼ぶツールの回数
+    react_steps: int = 1
+    # ファシリテータの指名を固定したい場合（順番に返す）
+    facilitator_script: list[str] = field(default_factory=list)
+    # 0より大きい場合は1分あたりのリクエスト数を超えると429を返す
+    rpm_limit: int = 0
+    # デプロイメントごとの速度倍率（待ち時間を割り、生成速度を掛ける）。例: {"gpt-4o-mini": 3.0}
+    deployment_speed: dict[str, float] = field(default_factory=dict)
+    seed: Optional[int] = None
+
+
+FILLER = "この論点については前提条件を整理したうえで、具体的な事例と根拠を示しながら段階的に検討することが重要です。"
+_NAMES_RE = re.compile(r"次に発言すべきエージェント（([^）]+)）")
+_PERSONA_RE = re.compile(r"あなたは(.+?)という名前の")
+_REACT_TOOLS_RE = re.compile(r"Action: the action to take, should be one of \[(.+?)\]")
+
+
+class FakeLLMState:
+    def __init__(self, config: FakeLLMConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._facilitator_turn = 0
+        self._recent = deque()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stats = {"calls": 0, "stream_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                          "rate_limited": 0, "search_calls": 0, "by_kind": {}}
+            self._facilitator_turn = 0
+
+    def record(self, kind: str, prompt_tokens: int, completion_tokens: int, stream: bool):
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["stream_calls"] += int(stream)
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            self.stats["by_kind"][kind] = self.stats["by_kind"].get(kind, 0) + 1
+
+    def rate_limited(self) -> Optional[float]:
+        # 直近60秒のリクエスト数がrpm_limitを超えたら、空くまでの秒数を返す
+        if self.config.rpm_limit <= 0:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.config.rpm_limit:
+                self.stats["rate_limited"] += 1
+                return 60 - (now - self._recent[0])
+            self._recent.append(now)
+            return None
+
+    def first_token_latency(self) -> float:
+        with self._lock:
+            return self.random.lognormvariate(0, self.config.latency_sigma) * self.config.latency_median
+
+    def filler(self, tokens: int) -> str:
+        text = FILLER * (tokens // estimate_tokens(FILLER) + 1)
+        return text[:tokens]
+
+    def next_speaker(self, names: list[str]) -> str:
+        with self._lock:
+            script = self.config.facilitator_script or names or ["エージェント"]
+            name = script[self._facilitator_turn % len(script)]
+            self._facilitator_turn += 1
+        return name
+
+    def respond_tools(self, messages: list[dict], body: dict) -> tuple[Optional[str], list[tuple[str, str]]]:
+        # 関数呼び出しを返す場合は (種類, [(関数名, 引数のJSON), ...])。返さない場合は (None, [])
+        functions = [t["function"] for t in body.get("tools") or [] if t.get("type") == "function"]
+        if not functions or any(m.get("role") == "tool" for m in messages):
+            return None, []
+        properties = functions[0].get("parameters", {}).get("properties", {})
+        enum = properties.get("name", {}).get("enum")
+        if enum:
+            # ファシリテータの指名（列挙型から選ぶ）
+            return "facilitator_tool", [(functions[0]["name"], json.dumps({"name": self.next_speaker(enum)}, ensure_ascii=False))]
+        # 専門エージェント：ReActで react_steps 回に分けて呼ぶツールを、1回の応答でまとめて要求する
+        calls = []
+        for i in range(max(1, self.config.react_steps)):
+            function = functions[i % len(functions)]
+            arg = next(iter(function.get("parameters", {}).get("properties", {})), "__arg1")
+            calls.append((function["name"], json.dumps({arg: self.filler(20)}, ensure_ascii=False)))
+        return "tool_calls", calls
+
+    def respond(self, messages: list[dict], body: dict) -> tuple[str, str]:
+        # プロンプトの内容からどの役割の呼び出しかを推定して、それらしい応答を返す
+        system = "\n".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+        prompt = "\n".join(m.get("content") or "" for m in messages if isinstance(m.get("content"), str))
+        max_tokens = min(body.get("max_tokens") or self.config.completion_tokens, self.config.completion_tokens)
+
+        # 関数呼び出し型のエージェントが、ツールの結果を受け取った後の最終回答
+        if body.get("tools") and any(m.get("role") == "tool" for m in messages):
+            return "tool_final", self.filler(max_tokens)
+
+        m = _NAMES_RE.search(system)
+        if m:
+            names = [n.strip() for n in m.group(1).split("/") if n.strip()]
+            return "facilitator", self.next_speaker(names)
+
+        m = _REACT_TOOLS_RE.search(prompt)
+        if m:
+            tools = [t.strip() for t in m.group(1).split(",") if t.strip()]
+            steps = len(re.findall(r"^Observation:", prompt, re.MULTILINE)) - 1
+            if tools and steps < self.config.react_steps:
+                tool = tools[steps % len(tools)]
+                return "react_action", f"{tool}を使って確認します。\nAction: {tool}\nAction Input: {self.filler(20)}"
+            return "react_final", f"十分な情報が集まりました。\nFinal Answer: {self.filler(max_tokens)}"
+
+        persona = _PERSONA_RE.search(system)
+        if "JSON" in system:
+            name = persona.group(1) if persona else "エージェント"
+            return "persona_json", json.dumps({"name": name, "content": self.filler(max_tokens)}, ensure_ascii=False)
+        if persona:
+            return "persona", self.filler(max_tokens)
+        if "要約" in system:
+            return "summary", self.filler(max_tokens)
+        return "chat", self.filler(max_tokens)
+
+
+# ========== HTTPハンドラ ==========
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeAzureOpenAI/1.0"
+    state: FakeLLMState
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_HEAD(self):
+        # ウォームアップ用
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            with self.state._lock:
+                stats = json.loads(json.dumps(self.state.stats))
+            return self._send_json(200, stats)
+        self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/stats/reset":
+            self._read_json()
+            self.state.reset()
+            return self._send_json(200, {"ok": True})
+        if re.fullmatch(r"/faiss/[^/]+/search", path):
+            return self._search(self._read_json())
+        m = re.fullmatch(r"/openai/deployments/([^/]+)/chat/completions", path)
+        if m:
+            return self._chat(m.group(1), self._read_json())
+        self._send_json(404, {"error": "not found"})
+
+    def _search(self, body: dict):
+        with self.state._lock:
+            self.state.stats["search_calls"] += 1
+        top_k = int(body.get("top_k", 5))
+        query = body.get("query", "")
+        results = [
+            {"id": f"doc-{i}", "score": round(1.0 - i * 0.1, 3),
+             "text": f"{query}に関する事例{i + 1}: {self.state.filler(80)}", "metadata": {"source": f"case_{i + 1}.md"}}
+            for i in range(top_k)
+        ]
+        time.sleep(self.state.first_token_latency() / 4)
+        self._send_json(200, {"query": query, "results": results})
+
+    def _chat(self, deployment: str, body: dict):
+        retry_after = self.state.rate_limited()
+        if retry_after is not None:
+            return self._send_json(
+                429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                headers={"Retry-After": str(max(1, int(retry_after + 0.5)))},
+            )
+        messages = body.get("messages", [])
+        kind, calls = self.state.respond_tools(messages, body)
+        if kind is None:
+            kind, text = self.state.respond(messages, body)
+        else:
+            text = "".join(arguments for _, arguments in calls)
+        prompt_tokens = estimate_message_tokens(messages)
+        completion_tokens = estimate_tokens(text)
+        stream = bool(body.get("stream"))
+        self.state.record(kind, prompt_tokens, completion_tokens, stream)
+
+        speed = self.state.config.deployment_speed.get(deployment, 1.0)
+        token_rate = self.state.config.token_rate * speed
+        time.sleep(self.state.first_token_latency() / speed)
+        created = int(time.time())
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        tool_calls = [
+            {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": {"name": name, "arguments": arguments}}
+            for name, arguments in calls
+        ]
+        if not stream:
+            time.sleep(completion_tokens / token_rate)
+            if tool_calls:
+                message, finish_reason = {"role": "assistant", "content": None, "tool_calls": tool_calls}, "tool_calls"
+            else:
+                message, finish_reason = {"role": "assistant", "content": text}, "stop"
+            return self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": deployment,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: dict, finish_reason=None, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            if tool_calls:
+                # 呼び出しごとに関数名とIDを先に送り、引数を続けて送る（OpenAIのストリーミング形式）
+                event({"role": "assistant", "content": None})
+                for i, call in enumerate(tool_calls):
+                    arguments = call["function"]["arguments"]
+                    event({"tool_calls": [{"index": i, "id": call["id"], "type": "function",
+                                           "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                    time.sleep(estimate_tokens(arguments) / token_rate)
+                    event({"tool_calls": [{"index": i, "function": {"arguments": arguments}}]})
+                event({}, "tool_calls", usage=usage)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                return
+            event({"role": "assistant", "content": ""})
+            chunk_size = 4
+            for i in range(0, len(text), chunk_size):
+                piece = text[i:i + chunk_size]
+                time.sleep(estimate_tokens(piece) / token_rate)
+                event({"content": piece})
+            event({}, "stop", usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 投機実行のキャンセルなどでクライアントが切断した場合
+            pass
+
+
+class FakeLLMServer:
+    def __init__(self, config: Optional[FakeLLMConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.state = FakeLLMState(config or FakeLLMConfig())
+        handler = type("BoundFakeLLMHandler", (FakeLLMHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-llm-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Azure chat-completions互換のオフライン用サーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=0.3)
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--token-rate", type=float, default=80.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--react-steps", type=int, default=1)
+    parser.add_argument("--facilitator-script", default="", help="カンマ区切りで指名順を固定する")
+    parser.add_argument("--rpm-limit", type=int, default=0)
+    parser.add_argument("--deployment-speed", default="", help="gpt-4o-mini=3.0 のようにカンマ区切りで指定する")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config = FakeLLMConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        react_steps=args.react_steps,
+        facilitator_script=[s for s in args.facilitator_script.split(",") if s],
+        rpm_limit=args.rpm_limit,
+        deployment_speed={k.strip(): float(v) for k, _, v in (s.partition("=") for s in args.deployment_speed.split(",")) if v},
+        seed=args.seed,
+    )
+    server = FakeLLMServer(config, args.host, args.port)
+    print(f"fake LLM server listening on {server.url}", file=sys.stderr)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from token_utils import estimate_message_tokens
+from session_store import SessionStore, prompt_message
+
+logger = logging.getLogger(__name__)
+
+
+# ========== トークン予算付きの会話履歴マネージャ ==========
+class HistoryManager:
+    """直近N件は原文のまま保持し、それより古い発言はローリング要約に畳み込む。"""
+
+    def __init__(
+        self,
+        summary_chain=None,
+        max_tokens: Optional[int] = None,
+        keep_last: Optional[int] = None,
+        fold_batch: int = 4,
+        background: bool = True,
+        callbacks: Optional[list] = None,
+        store: Optional[SessionStore] = None,
+        session_id: Optional[str] = None,
+        prompt_view: Optional[Callable[[dict], dict]] = None,
+    ):
+        # summary_chain は create_summary_agent_chain で作ったチェーン（Noneなら古い発言は捨てる）
+        self.summary_chain = summary_chain
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.getenv("HISTORY_MAX_TOKENS", "3000"))
+        self.keep_last = keep_last if keep_last is not None else int(os.getenv("HISTORY_KEEP_LAST", "8"))
+        self.fold_batch = fold_batch
+        # 要約呼び出しに渡すコールバック（トークン集計など）
+        self.callbacks = callbacks
+        # store を渡すと発言を追記保存し、メモリ上の履歴は evict() で捨てて必要になったら読み直す
+        self.store = store
+        self.session_id = session_id
+        # 保存された発言（role/name/content/付帯情報）からプロンプト用のメッセージを作る
+        self.prompt_view = prompt_view or (prompt_message if store is not None else None)
+        self.summary = ""
+        # 要約に畳み込み済みの最後の発言番号（store使用時）
+        self._summary_seq = 0
+        self._recent: list[dict] = []
+        self._pending: list[dict] = []
+        self._lock = threading.RLock()
+        self._loaded = store is None
+        # 要約更新は発言生成の邪魔をしないよう別スレッドで順番に行う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary") if background else None
+
+    def _ensure_loaded(self):
+        # 要約と、要約に畳み込まれていない直近の発言だけを読む（古い発言は要約に含まれている）
+        with self._lock:
+            if self._loaded:
+                return
+            self.summary, self._summary_seq = self.store.get_summary(self.session_id)
+            self._recent = self.store.recent(self.session_id, self.keep_last + self.fold_batch, after_seq=self._summary_seq)
+            self._pending = []
+            self._loaded = True
+
+    def evict(self) -> bool:
+        # 放置されたセッションのメモリを解放する。要約の更新待ちがある間は捨てない
+        with self._lock:
+            if self.store is None or not self._loaded or self._pending:
+                return False
+            self.summary = ""
+            self._recent = []
+            self._loaded = False
+            return True
+
+    def append(self, message: dict):
+        self._ensure_loaded()
+        with self._lock:
+            if self.store is not None:
+                message = {**message, "seq": self.store.append(self.session_id, message)}
+            self._recent.append(message)
+            # 毎回要約せず、fold_batch件たまってからまとめて畳み込む
+            if len(self._recent) <= self.keep_last + self.fold_batch:
+                return
+            overflow = self._recent[:-self.keep_last]
+            self._recent = self._recent[-self.keep_last:]
+            if self.summary_chain is None:
+                return
+            self._pending.extend(overflow)
+        if self._executor is not None:
+            self._executor.submit(self._fold)
+        else:
+            self._fold()
+
+    def extend(self, messages: list[dict]):
+        for m in messages:
+            self.append(m)
+
+    def _summarize(self, summary: str, messages: list[dict]) -> str:
+        history = []
+        if summary:
+            history.append({"role": "system", "content": f"これまでの会話の要約:\n{summary}"})
+        history.extend(messages)
+        result = self.summary_chain.invoke({
+            "input": "これまでの要約に上記の新しい会話の内容を反映し、要約を更新してください。発言者ごとの主張と結論を簡潔に残してください。",
+            "chat_history": history
+        }, config={"callbacks": self.callbacks, "metadata": {"role": "summary"}})
+        if isinstance(result, dict):
+            return result.get("text", "")
+        return getattr(result, "content", result)
+
+    def _fold(self):
+        with self._lock:
+            snapshot = list(self._pending)
+            summary = self.summary
+        if not snapshot:
+            return
+        try:
+            new_summary = self._summarize(summary, snapshot)
+        except Exception as e:
+            # 失敗した場合は未要約のまま残し、次回の畳み込みで再試行する
+            logger.warning(f"history summarization failed: {e}")
+            return
+        with self._lock:
+            self.summary = new_summary
+            self._pending = self._pending[len(snapshot):]
+            if self.store is not None:
+                self._summary_seq = snapshot[-1].get("seq", self._summary_seq)
+                self.store.set_summary(self.session_id, new_summary, self._summary_seq)
+
+    def _summary_message(self, summary: str) -> list[dict]:
+        if not summary:
+            return []
+        return [{"role": "system", "content": f"これまでの会話の要約:\n{summary}"}]
+
+    def for_prompt(self, max_tokens: Optional[int] = None) -> list[dict]:
+        # 要約 + 直近の発言を、トークン予算に収まる範囲で返す（最新の発言は必ず含める）
+        return self._budgeted(max_tokens, self.prompt_view)
+
+    def _budgeted(self, max_tokens: Optional[int], view: Optional[Callable[[dict], dict]]) -> list[dict]:
+        budget = max_tokens if max_tokens is not None else self.max_tokens
+        self._ensure_loaded()
+        with self._lock:
+            summary_messages = self._summary_message(self.summary)
+            messages = self._pending + self._recent
+        if view is not None:
+            messages = [view(m) for m in messages]
+        budget -= estimate_message_tokens(summary_messages)
+        kept: list[dict] = []
+        used = 0
+        for m in reversed(messages):
+            cost = estimate_message_tokens([m])
+            if kept and used + cost > budget:
+                break
+            kept.append(m)
+            used += cost
+        kept.reverse()
+        return summary_messages + kept
+
+    def as_text(self, max_tokens: Optional[int] = None) -> str:
+        # 文字列としてプロンプトに埋め込む場合の形式。名前はここで付けるので、
+        # prompt_view（「名前: 本文」などに整形済み）を通さない原文から組み立てる
+        lines = []
+        for m in self._budgeted(max_tokens, None):
+            speaker = m.get("name") or {"user": "ユーザー", "system": "要約"}.get(m["role"], m["role"])
+            lines.append(f"{speaker}: {m['content']}")
+        return "\n".join(lines)
+
+    def messages(self) -> list[dict]:
+        # 要約に畳み込まれていない原文の発言
+        self._ensure_loaded()
+        with self._lock:
+            return self._pending + self._recent
+
+    def token_count(self) -> int:
+        return estimate_message_tokens(self.for_prompt())
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self._recent = []
+            self._pending = []
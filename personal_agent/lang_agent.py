@@ -1,19 +1,19 @@
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.agents import Tool, AgentExecutor, create_openai_functions_agent
 from langchain.tools import tool
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.prompts import HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
+from streaming import TokenStreamHandler
+from history import HistoryManager
+from discussion_agent import create_summary_agent_chain
+from model_registry import get_llm
+from deadline import executor_limits, start_deadline
 import os
 
 # 1. モデル定義
 # llm = ChatOpenAI(model="gpt-4", temperature=0)
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+llm = get_llm("specialist")
 
 # 2. Tool定義（デコレータ方式）
 @tool
@@ -39,7 +39,8 @@ agent = create_openai_functions_agent(
 )
 
 # 5. 実行器
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+# ステップ数と実行時間の上限（AGENT_MAX_ITERATIONS / AGENT_MAX_EXECUTION_TIME）
+agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, **executor_limits())
 
 # # 6. 実行
 # response = agent_executor.invoke({
@@ -48,8 +49,8 @@ agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
 # })
 # print(response["output"])
 
-# === チャット履歴を保持 ===
-chat_history = []
+# === チャット履歴を保持（古い発言は要約に畳み込んでトークン予算内に収める） ===
+history = HistoryManager(create_summary_agent_chain(get_llm("summary")))
 
 # === コンソールチャットループ ===
 print("💬 エージェントと会話できます。'exit'で終了。")
@@ -61,16 +62,26 @@ while True:
         break
 
     try:
+        # TURN_DEADLINE秒を過ぎたら、以降のHTTPリクエストを送らずに打ち切る
+        start_deadline()
+        # 最終回答のトークンを生成され次第表示する
+        stream_handler = TokenStreamHandler(
+            on_token=lambda t: print(t, end="", flush=True),
+            on_start=lambda: print("🤖 エージェント> ", end="", flush=True),
+        )
         result = agent_executor.invoke({
             "input": user_input,
-            "chat_history": chat_history
-        })
+            "chat_history": history.for_prompt()
+        }, config={"callbacks": [stream_handler]})
         response = result["output"]
-        print(f"🤖 エージェント> {response}")
+        if stream_handler.streamed:
+            print()
+        else:
+            print(f"🤖 エージェント> {response}")
 
         # 会話履歴に追加
-        chat_history.append({"role": "user", "content": user_input})
-        chat_history.append({"role": "assistant", "content": response})
+        history.append({"role": "user", "content": user_input})
+        history.append({"role": "assistant", "content": response})
 
     except Exception as e:
         print(f"⚠️ エラー: {e}")
\ No newline at end of file
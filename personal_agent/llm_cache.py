@@ -0,0 +1,276 @@
+import os
+import ast
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+from cassette import CASSETTE_MODE
+
+# 実行時のカレントディレクトリによらず、モジュールの隣（.gitignore対象）に置く
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache", "llm_cache.sqlite3")
+
+
+# ========== キャッシュキー生成 ==========
+def _normalize_text(text: str) -> str:
+    # 全角/半角の揺れと前後・連続空白を吸収する
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def _normalize_messages(prompt: str) -> Any:
+    # チャットモデルのpromptはメッセージ列をdumpsしたJSON文字列
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return _normalize_text(prompt)
+    if not isinstance(messages, list):
+        return _normalize_text(prompt)
+    normalized = []
+    for m in messages:
+        kwargs = m.get("kwargs", {}) if isinstance(m, dict) else {}
+        content = kwargs.get("content", "")
+        if isinstance(content, str):
+            content = _normalize_text(content)
+        normalized.append([kwargs.get("type") or m.get("id", [""])[-1], kwargs.get("name"), content])
+    return normalized
+
+
+def _parse_llm_string(llm_string: str) -> dict:
+    # llm_stringからモデル名・temperature・max_tokensと呼び出しパラメータを取り出す
+    model_params: dict = {}
+    call_params: Any = None
+    head, sep, tail = llm_string.partition("---")
+    try:
+        if sep:
+            model_params = json.loads(head).get("kwargs", {})
+            call_params = ast.literal_eval(tail)
+        else:
+            model_params = dict(ast.literal_eval(llm_string))
+    except (ValueError, SyntaxError, AttributeError):
+        return {"raw": llm_string}
+    model = (
+        model_params.get("deployment_name")
+        or model_params.get("azure_deployment")
+        or model_params.get("model_name")
+        or model_params.get("model")
+    )
+    known = {"deployment_name", "azure_deployment", "model_name", "model", "temperature", "max_tokens"}
+    return {
+        "model": model,
+        "temperature": model_params.get("temperature"),
+        "max_tokens": model_params.get("max_tokens"),
+        "params": repr(call_params) if call_params is not None else repr(sorted((k, repr(v)) for k, v in model_params.items() if k not in known)),
+    }
+
+
+def effective_temperature(llm_string: str) -> Optional[float]:
+    # 呼び出し時のパラメータ（bindした値を含む）を優先し、無ければモデルの設定値を使う
+    head, sep, tail = llm_string.partition("---")
+    if sep:
+        try:
+            call_params = dict(ast.literal_eval(tail))
+        except (ValueError, SyntaxError, TypeError):
+            call_params = {}
+        if call_params.get("temperature") is not None:
+            return call_params["temperature"]
+    return _parse_llm_string(llm_string).get("temperature")
+
+
+def make_cache_key(prompt: str, llm_string: str) -> str:
+    payload = {"messages": _normalize_messages(prompt), "llm": _parse_llm_string(llm_string)}
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# ========== メモリLRU + SQLite の2段キャッシュ ==========
+class LLMResponseCache(BaseCache):
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        memory_size: int = 256,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = 10000,
+        max_bytes: Optional[int] = None,
+    ):
+        self.path = path
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, tuple[float, list]]" = OrderedDict()
+        # メモリでヒットしたキーの最終利用時刻（SQLiteへは追い出しの直前にまとめて反映する）
+        self._touched: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0, "skipped": 0}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)")
+        self._conn.commit()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _remember(self, key: str, created_at: float, generations: list):
+        self._memory[key] = (created_at, generations)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _cacheable(self, llm_string: str) -> bool:
+        # サンプリングする呼び出し（temperature > 0 や未指定）は毎回違う応答が期待されるのでキャッシュしない
+        return effective_temperature(llm_string) == 0
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        if not self._cacheable(llm_string):
+            with self._lock:
+                self._stats["skipped"] += 1
+            return None
+        key = make_cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self._touched[key] = now
+                    self._stats["memory_hits"] += 1
+                    return entry[1]
+                del self._memory[key]
+
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            value, created_at = row
+            if self._expired(created_at, now):
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._stats["evictions"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            generations = [loads(g) for g in json.loads(value)]
+            self._remember(key, created_at, generations)
+            self._stats["disk_hits"] += 1
+            return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        if not self._cacheable(llm_string):
+            return
+        key = make_cache_key(prompt, llm_string)
+        value = json.dumps([dumps(g) for g in return_val], ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._stats["writes"] += 1
+            self._evict(now)
+            self._conn.commit()
+            self._remember(key, now, list(return_val))
+
+    def _evict(self, now: float):
+        cur = self._conn
+        if self._touched:
+            # メモリでのヒットもLRUの順序に入れてから追い出す
+            cur.executemany("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+        # SQLiteから消したキーはメモリLRUからも消す（残っているとメモリ上でヒットし続ける）
+        if self.ttl is not None:
+            expired = [k for (k,) in cur.execute("SELECT key FROM llm_cache WHERE created_at < ?", (now - self.ttl,))]
+            self._delete(expired)
+        if self.max_entries is not None:
+            count = cur.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.max_entries:
+                # 最近使われていないものから削除（LRU）
+                oldest = [k for (k,) in cur.execute(
+                    "SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?", (count - self.max_entries,)
+                )]
+                self._delete(oldest)
+        if self.max_bytes is not None:
+            total = cur.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            while total > self.max_bytes:
+                row = cur.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at ASC LIMIT 1").fetchone()
+                if row is None:
+                    break
+                cur.execute("DELETE FROM llm_cache WHERE key = ?", (row[0],))
+                self._memory.pop(row[0], None)
+                total -= row[1]
+                self._stats["evictions"] += 1
+
+    def _delete(self, keys: list[str]):
+        if not keys:
+            return
+        self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", [(k,) for k in keys])
+        for k in keys:
+            self._memory.pop(k, None)
+            self._touched.pop(k, None)
+        self._stats["evictions"] += len(keys)
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache: Optional[LLMResponseCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> LLMResponseCache:
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                ttl = os.getenv("LLM_CACHE_TTL")
+                max_bytes = os.getenv("LLM_CACHE_MAX_BYTES")
+                _default_cache = LLMResponseCache(
+                    path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                    memory_size=int(os.getenv("LLM_CACHE_MEMORY_SIZE", "256")),
+                    ttl=float(ttl) if ttl else None,
+                    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+                    max_bytes=int(max_bytes) if max_bytes else None,
+                )
+    return _default_cache
+
+
+# ========== チェーン単位のオプトイン ==========
+def with_cache(llm, cache: Optional[BaseCache] = None):
+    # 決定的な呼び出し（ファシリテータ・脳ツール・検索要約など）にだけ使う
+    # 実際に保存・再利用するのは temperature=0 の呼び出しだけ。LLM_CACHE=0 で全体を無効化できる
+    # カセットの記録・再生中は使わない（キャッシュにヒットした呼び出しは記録されず、再生時は記録した待ち時間も飛ばしてしまう）
+    if os.getenv("LLM_CACHE", "1") == "0" or CASSETTE_MODE:
+        return llm
+    return llm.model_copy(update={"cache": cache or get_default_cache()})
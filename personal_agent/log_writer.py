@@ -0,0 +1,158 @@
+import os
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+# ========== バックグラウンドスレッドで書き込むJSON Linesロガー ==========
+class JSONLLogWriter:
+    """write()はキューに積むだけで返り、ファイルI/Oは専用スレッドでまとめて行う。"""
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        backup_count: Optional[int] = None,
+        compress: Optional[bool] = None,
+        queue_size: int = 10000,
+    ):
+        self.path = path
+        # 件数か経過時間のどちらかがしきい値を超えたらまとめて書き出す
+        self.batch_size = batch_size if batch_size is not None else int(os.getenv("LOG_BATCH_SIZE", "64"))
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+        # サイズによるローテーション（0で無効）と、ローテーション済みファイルのgzip圧縮
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+        self.backup_count = backup_count if backup_count is not None else int(os.getenv("LOG_BACKUP_COUNT", "5"))
+        self.compress = compress if compress is not None else os.getenv("LOG_COMPRESS", "0") == "1"
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="jsonl-log-writer", daemon=True)
+        self._thread.start()
+        # exitやCtrl-Cで抜けた場合も、残っている記録を書き出してから終了する
+        atexit.register(self.close)
+
+    def write(self, record: dict):
+        if self._closed:
+            return
+        record.setdefault("ts", datetime.now().isoformat(timespec="milliseconds"))
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # エージェントのターンを止めないよう、あふれた分は捨てて数だけ数える
+            self.dropped += 1
+
+    def flush(self, fsync: bool = False, timeout: Optional[float] = None):
+        # キューに積まれた分の書き出し完了を待つ（fsync=Trueならディスクまで同期する）
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, fsync, done))
+        done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_CLOSE, True, None))
+        self._thread.join(timeout)
+        try:
+            atexit.unregister(self.close)
+        except Exception:
+            pass
+
+    def _open(self):
+        return open(self.path, "a", encoding="utf-8")
+
+    def _rotate(self, f):
+        f.close()
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}{suffix}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}{suffix}")
+        if self.backup_count > 0:
+            if self.compress:
+                with open(self.path, "rb") as src, gzip.open(f"{self.path}.1.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return self._open()
+
+    def _write_batch(self, f, batch: list[dict]):
+        if not batch:
+            return f
+        f.write("".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch))
+        f.flush()
+        if self.max_bytes > 0 and f.tell() >= self.max_bytes:
+            f = self._rotate(f)
+        return f
+
+    def _run(self):
+        f = self._open()
+        batch: list[dict] = []
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = None
+
+                if isinstance(item, dict):
+                    batch.append(item)
+                    if len(batch) < self.batch_size and time.monotonic() < deadline:
+                        continue
+                    control = None
+                else:
+                    control = item
+
+                try:
+                    f = self._write_batch(f, batch)
+                except Exception as e:
+                    logger.warning(f"log write failed: {e}")
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+                if control is None:
+                    continue
+                kind, fsync, done = control
+                if fsync:
+                    try:
+                        os.fsync(f.fileno())
+                    except OSError as e:
+                        logger.warning(f"log fsync failed: {e}")
+                if done is not None:
+                    done.set()
+                if kind is _CLOSE:
+                    return
+        finally:
+            f.close()
+
+
+# ========== セッションごとのログファイル ==========
+def open_session_log(log_dir: str = "chat_logs", prefix: str = "chat_log") -> JSONLLogWriter:
+    path = os.path.join(log_dir, f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    return JSONLLogWriter(path)
+
+
+def log_chat(writer: JSONLLogWriter, role: str, name: str, content: Any, **fields):
+    writer.write({"event": "chat", "role": role, "name": name, "content": content, **fields})
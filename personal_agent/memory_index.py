@@ -0,0 +1,392 @@
+import os
+import re
+import gzip
+import json
+import math
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+from search_rerank import char_ngrams
+from token_utils import estimate_tokens
+
+try:
+    import numpy as np
+except ImportError:  # ベクトル索引は任意機能
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MemoryHit:
+    id: int
+    session: str
+    role: str
+    name: str
+    content: str
+    ts: Optional[str]
+    score: float
+    context: Optional[str] = None
+
+    def format(self) -> str:
+        lines = [self.context] if self.context else []
+        lines.append(f"{self.name}: {self.content}")
+        return "\n".join(lines)
+
+
+# ========== 文字n-gramのハッシュ埋め込み（ローカル計算） ==========
+def hashing_embedding(text: str, dim: int = 128) -> "np.ndarray":
+    vec = np.zeros(dim, dtype=np.float32)
+    for gram, tf in Counter(char_ngrams(text)).items():
+        h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+        vec[h % dim] += (1.0 if (h >> 63) & 1 else -1.0) * (1 + math.log(tf))
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    ts TEXT,
+    role TEXT,
+    name TEXT,
+    content TEXT NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_session ON turns(session, id);
+CREATE TABLE IF NOT EXISTS postings (
+    gram TEXT NOT NULL,
+    turn_id INTEGER NOT NULL,
+    weight REAL NOT NULL,
+    PRIMARY KEY (gram, turn_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_weight ON postings(gram, weight DESC, turn_id);
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vectors (
+    turn_id INTEGER PRIMARY KEY,
+    vec BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingest_state (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingest_files (
+    file_id TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+"""
+
+# ローテーション後のファイル名（chat.jsonl.1 / chat.jsonl.2.gz）
+_ROTATED_RE = re.compile(r"^(.*\.(?:jsonl|txt))\.(\d+)(\.gz)?$")
+
+
+# ========== 過去の会話の長期記憶インデックス ==========
+class MemoryIndex:
+    """過去の発言をSQLiteの転置索引（文字2-gram）に追記し、関連する発言を検索する。
+
+    BM25の文書長正規化は追加時点の平均長で計算して重みとして保存するので、
+    追加のたびに全体を作り直す必要がない。
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        use_vectors: Optional[bool] = None,
+        embed: Optional[Callable[[str], "np.ndarray"]] = None,
+        vector_dim: int = 128,
+        max_query_grams: int = 24,
+        max_df_ratio: float = 0.05,
+        max_postings: int = 1000,
+    ):
+        self.path = path or os.getenv("MEMORY_INDEX_PATH", "chat_logs/memory_index.sqlite3")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if use_vectors is None:
+            use_vectors = os.getenv("MEMORY_VECTORS", "0") == "1"
+        # numpyが無い環境では転置索引のみで動かす
+        self.use_vectors = use_vectors and np is not None
+        self.embed = embed or (lambda text: hashing_embedding(text, vector_dim))
+        self.max_query_grams = max_query_grams
+        self.max_df_ratio = max_df_ratio
+        self.max_postings = max_postings
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._matrix_ids = None
+
+    # ---------- 追加 ----------
+    def _meta(self, key: str, default: float = 0.0) -> float:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return float(row[0]) if row else default
+
+    def _set_meta(self, key: str, value: float):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def add_many(self, records: Iterable[dict], ingest_state: Optional[tuple[str, int]] = None) -> int:
+        # ingest_state=(file_id, offset) を渡すと、取り込み位置も同じトランザクションで記録する
+        added = 0
+        with self._lock, self._conn:
+            count = self._meta("count")
+            total_length = self._meta("total_length")
+            new_vectors = []
+            for r in records:
+                content = (r.get("content") or "").strip()
+                if not content:
+                    continue
+                grams = Counter(char_ngrams(content))
+                length = sum(grams.values())
+                cur = self._conn.execute(
+                    "INSERT INTO turns (session, ts, role, name, content, length) VALUES (?, ?, ?, ?, ?, ?)",
+                    (r.get("session", ""), r.get("ts"), r.get("role"), r.get("name"), content, length),
+                )
+                turn_id = cur.lastrowid
+                count += 1
+                total_length += length
+                avg = total_length / count
+                norm = self.K1 * (1 - self.B + self.B * length / (avg or 1))
+                self._conn.executemany(
+                    "INSERT INTO postings (gram, turn_id, weight) VALUES (?, ?, ?)",
+                    [(g, turn_id, tf * (self.K1 + 1) / (tf + norm)) for g, tf in grams.items()],
+                )
+                self._conn.executemany(
+                    "INSERT INTO grams (gram, df) VALUES (?, 1) ON CONFLICT(gram) DO UPDATE SET df = df + 1",
+                    [(g,) for g in grams],
+                )
+                if self.use_vectors:
+                    vec = np.asarray(self.embed(content), dtype=np.float32)
+                    self._conn.execute("INSERT INTO vectors (turn_id, vec) VALUES (?, ?)", (turn_id, vec.tobytes()))
+                    new_vectors.append((turn_id, vec))
+                added += 1
+            self._set_meta("count", count)
+            self._set_meta("total_length", total_length)
+            if ingest_state is not None:
+                self._conn.execute("INSERT OR REPLACE INTO ingest_files (file_id, offset) VALUES (?, ?)", ingest_state)
+            if new_vectors and self._matrix is not None:
+                # 読み込み済みの行列には差分だけ追記する
+                self._matrix = np.vstack([self._matrix, np.stack([v for _, v in new_vectors])])
+                self._matrix_ids = np.concatenate([self._matrix_ids, np.array([i for i, _ in new_vectors])])
+        return added
+
+    def add(self, role: str, name: str, content: str, session: str = "", ts: Optional[str] = None) -> int:
+        return self.add_many([{"role": role, "name": name, "content": content, "session": session, "ts": ts}])
+
+    # ---------- ログファイルからの増分取り込み ----------
+    def _ingest_offset(self, file_id: str, path: str) -> int:
+        row = self._conn.execute("SELECT offset FROM ingest_files WHERE file_id = ?", (file_id,)).fetchone()
+        if row:
+            return row[0]
+        # 旧版はパスごとに位置を記録していた（ローテーション前の生ファイルにだけ引き継ぐ）
+        row = self._conn.execute("SELECT offset FROM ingest_state WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else 0
+
+    def ingest_file(self, path: str, chunk_size: int = 500) -> int:
+        # 前回読んだ位置から続きだけを取り込む
+        path = os.path.abspath(path)
+        session = _session_name(path)
+        with (gzip.open if path.endswith(".gz") else open)(path, "rb") as f:
+            data = f.read()
+        # 取り込み位置は「ローテーション前のファイル名 + 先頭行」で識別する
+        # （chat.jsonl → chat.jsonl.1 → chat.jsonl.2.gz と名前が変わっても続きから読め、
+        #   先頭行が同じ別のログ（同じ挨拶で始まる旧形式の.txtなど）とは混ざらない）
+        first = data.find(b"\n") + 1
+        if first == 0:
+            return 0
+        file_id = hashlib.sha1(_live_name(path).encode("utf-8") + b"\n" + data[:first]).hexdigest()
+        offset = self._ingest_offset(file_id, path)
+        if len(data) < offset:
+            # 記録より短い＝別の内容で書き直されたので最初から読み直す
+            offset = 0
+        data = data[offset:]
+        # 書きかけの最終行は次回に回す
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return 0
+        if ".jsonl" not in os.path.basename(path):
+            text = data[:end].decode("utf-8", "replace")
+            return self.add_many(_parse_text_log(text, session), ingest_state=(file_id, offset + end))
+        # 検索を長時間待たせないよう、chunk_size件ずつ別トランザクションで取り込む
+        added, records, pos = 0, [], 0
+        for line in data[:end].splitlines(keepends=True):
+            pos += len(line)
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            if r.get("event") == "chat":
+                records.append({**r, "session": session})
+            if len(records) >= chunk_size:
+                added += self.add_many(records, ingest_state=(file_id, offset + pos))
+                records = []
+        added += self.add_many(records, ingest_state=(file_id, offset + end))
+        return added
+
+    def ingest_dir(self, log_dir: str = "chat_logs", exclude: Iterable[str] = ()) -> int:
+        if not os.path.isdir(log_dir):
+            return 0
+        exclude = {os.path.abspath(p) for p in exclude}
+        paths = []
+        for name in os.listdir(log_dir):
+            path = os.path.abspath(os.path.join(log_dir, name))
+            m = _ROTATED_RE.match(path)
+            live, generation = (m.group(1), int(m.group(2))) if m else (path, 0)
+            # 実行中のログはローテーション済みの分も含めて除外する
+            if live in exclude or not (live.endswith(".jsonl") or live.endswith(".txt")):
+                continue
+            paths.append((live, -generation, path))
+        added = 0
+        # 同じログの中では古いローテーション済みファイルから順に、最後に生ファイルを読む
+        for _, _, path in sorted(paths):
+            try:
+                added += self.ingest_file(path)
+            except Exception as e:
+                logger.warning(f"memory ingest failed for {path}: {e}")
+        return added
+
+    def start_ingest(self, log_dir: str = "chat_logs", exclude: Iterable[str] = ()) -> threading.Thread:
+        # 起動を待たせないよう、過去ログの取り込みは裏で行う（取り込み済みの分から検索に使える）
+        thread = threading.Thread(target=self.ingest_dir, args=(log_dir, list(exclude)), name="memory-ingest", daemon=True)
+        thread.start()
+        return thread
+
+    # ---------- 検索 ----------
+    def _lexical_scores(self, query: str) -> dict[int, float]:
+        grams = set(char_ngrams(query))
+        if not grams:
+            return {}
+        count = self._meta("count")
+        placeholders = ",".join("?" * len(grams))
+        df = dict(self._conn.execute(f"SELECT gram, df FROM grams WHERE gram IN ({placeholders})", list(grams)).fetchall())
+        # ありふれた2-gramは投稿リストが長いだけで効かないので捨て、珍しいものから使う
+        ordered = sorted((d, g) for g, d in df.items())
+        usable = [(d, g) for d, g in ordered if d <= max(1, count * self.max_df_ratio)] or ordered[:4]
+        scores: dict[int, float] = defaultdict(float)
+        for d, g in usable[:self.max_query_grams]:
+            idf = math.log(1 + (count - d + 0.5) / (d + 0.5))
+            # 各2-gramでは重みの大きい投稿だけを見る（索引順に読むので全件は走査しない）
+            for turn_id, weight in self._conn.execute(
+                "SELECT turn_id, weight FROM postings WHERE gram = ? ORDER BY weight DESC LIMIT ?",
+                (g, self.max_postings),
+            ):
+                scores[turn_id] += idf * weight
+        return scores
+
+    def _load_matrix(self):
+        if self._matrix is None:
+            rows = self._conn.execute("SELECT turn_id, vec FROM vectors ORDER BY turn_id").fetchall()
+            if rows:
+                self._matrix_ids = np.array([r[0] for r in rows])
+                self._matrix = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            else:
+                self._matrix_ids = np.zeros(0, dtype=np.int64)
+                self._matrix = np.zeros((0, len(self.embed(""))), dtype=np.float32)
+        return self._matrix, self._matrix_ids
+
+    def _vector_ranking(self, query: str, limit: int) -> list[int]:
+        matrix, ids = self._load_matrix()
+        if not len(ids):
+            return []
+        sims = matrix @ np.asarray(self.embed(query), dtype=np.float32)
+        limit = min(limit, len(ids))
+        top = np.argpartition(-sims, limit - 1)[:limit]
+        return [int(ids[i]) for i in top[np.argsort(-sims[top])] if sims[i] > 0]
+
+    def search(self, query: str, k: int = 3, exclude_session: Optional[str] = None,
+               with_context: bool = True) -> list[MemoryHit]:
+        with self._lock:
+            lexical = self._lexical_scores(query)
+            ranked = sorted(lexical, key=lambda i: -lexical[i])[:k * 10]
+            if self.use_vectors:
+                # 転置索引とベクトル検索の順位をReciprocal Rank Fusionで統合する
+                fused: dict[int, float] = defaultdict(float)
+                for rank, turn_id in enumerate(ranked):
+                    fused[turn_id] += 1 / (60 + rank)
+                for rank, turn_id in enumerate(self._vector_ranking(query, k * 10)):
+                    fused[turn_id] += 1 / (60 + rank)
+                scores = dict(fused)
+                ranked = sorted(fused, key=lambda i: -fused[i])
+            else:
+                scores = lexical
+            hits: list[MemoryHit] = []
+            seen: set[int] = set()
+            for turn_id in ranked:
+                if turn_id in seen:
+                    continue
+                row = self._conn.execute(
+                    "SELECT id, session, role, name, content, ts FROM turns WHERE id = ?", (turn_id,)
+                ).fetchone()
+                if row is None or (exclude_session is not None and row[1] == exclude_session):
+                    continue
+                hit = MemoryHit(*row, score=scores[turn_id])
+                if with_context and hit.role != "user":
+                    # 発言の直前のユーザー質問を添えて、やり取りとして返す
+                    prev = self._conn.execute(
+                        "SELECT id, content FROM turns WHERE session = ? AND id < ? AND role = 'user' ORDER BY id DESC LIMIT 1",
+                        (hit.session, hit.id),
+                    ).fetchone()
+                    if prev:
+                        hit.context = f"ユーザー: {prev[1]}"
+                        seen.add(prev[0])
+                seen.add(turn_id)
+                hits.append(hit)
+                if len(hits) >= k:
+                    break
+            return hits
+
+    def count(self) -> int:
+        return int(self._meta("count"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_LEGACY_RE = re.compile(r"^(USER|ASSISTANT|SYSTEM) \((.*?)\): ", re.MULTILINE)
+
+
+def _live_name(path: str) -> str:
+    # ローテーション済みのファイルは元のファイル名に戻す（chat.jsonl.2.gz → chat.jsonl）
+    m = _ROTATED_RE.match(path)
+    return os.path.basename(m.group(1) if m else path)
+
+
+def _session_name(path: str) -> str:
+    # chat.jsonl / chat.jsonl.1 / chat.jsonl.2.gz はどれもセッション "chat"
+    return os.path.splitext(_live_name(path))[0]
+
+
+def _parse_text_log(text: str, session: str):
+    # 旧形式（ROLE (name): content + 区切り線）のテキストログ
+    for block in text.split("-" * 50 + "\n"):
+        m = _LEGACY_RE.match(block)
+        if m:
+            yield {"role": m.group(1).lower(), "name": m.group(2), "content": block[m.end():].strip(), "session": session}
+
+
+def format_memories(hits: list[MemoryHit], max_tokens: int = 600) -> str:
+    lines, used = [], 0
+    for hit in hits:
+        text = hit.format()
+        cost = estimate_tokens(text)
+        if lines and used + cost > max_tokens:
+            break
+        lines.append(text)
+        used += cost
+    return "\n---\n".join(lines)
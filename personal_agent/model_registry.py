@@ -0,0 +1,197 @@
+import os
+import json
+import logging
+import threading
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import AzureChatOpenAI
+from pydantic import ConfigDict
+
+from custom_llm import OpenAIChatCustom, bind_openai_tools
+from rate_limiter import rate_limited_client_kwargs
+from cassette import replaying
+from token_utils import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# 役割ごとにデプロイメントと生成パラメータを切り替える
+#   facilitator: 次の発言者の指名 / persona: キャラクターの発言 / specialist: 専門エージェント（とパネルの統合）
+#   brain_tool: 脳ツール・専門ツール / search_summary: 検索結果の要約 / summary: 会話履歴の要約
+ROLES = ["facilitator", "persona", "specialist", "brain_tool", "search_summary", "summary"]
+
+# 設定ファイルが無い場合：従来どおり全役割が gpt-4o を使う（設定例は models.example.json）
+DEFAULT_CONFIG = {
+    "default": "gpt-4o",
+    "deployments": {
+        "gpt-4o": {"provider": "azure", "deployment_name": "gpt-4o", "api_version": "2023-05-15"},
+    },
+    "roles": {
+        # 指名・脳ツール・検索要約は決定的に呼ぶ（temperature=0 の呼び出しだけがキャッシュされる）
+        "facilitator": {"temperature": 0},
+        "persona": {},
+        # 専門エージェントと脳ツールは最終回答のトークンを流すためストリーミングで呼ぶ
+        "specialist": {"streaming": True},
+        "brain_tool": {"streaming": True, "temperature": 0},
+        "search_summary": {"temperature": 0},
+        "summary": {"temperature": 0},
+    },
+    "rules": [],
+}
+
+_PARAM_KEYS = ("max_tokens", "temperature", "streaming", "request_timeout")
+
+
+# ========== プロンプトの大きさで振り分けるモデル ==========
+class RoutedChatModel(BaseChatModel):
+    """プロンプトのトークン数が上限以下なら小さいモデルへ、超えたら既定のモデルへ回す。"""
+
+    # (プロンプトの上限トークン数, モデル) を上限の小さい順に
+    routes: list[tuple[int, BaseChatModel]]
+    default: BaseChatModel
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def route(self, messages) -> BaseChatModel:
+        prompt_tokens = estimate_message_tokens(messages)
+        for max_prompt_tokens, model in self.routes:
+            if prompt_tokens <= max_prompt_tokens:
+                return model
+        return self.default
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return self.route(messages)._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return await self.route(messages)._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from self.route(messages)._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.route(messages)._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            yield chunk
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        # 関数定義はOpenAI形式でそのまま振り分け先に渡す（Azure・カスタムのどちらも tools を解釈する）
+        return bind_openai_tools(self, tools, tool_choice, **kwargs)
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {
+            "routes": [(limit, model._identifying_params) for limit, model in self.routes],
+            "default": self.default._identifying_params,
+        }
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed"
+
+
+# ========== モデルレジストリ ==========
+class ModelRegistry:
+    """models.json の役割→デプロイメント対応から、役割ごとのチャットモデルを組み立てて共有する。"""
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or DEFAULT_CONFIG
+        self._models: dict[tuple, BaseChatModel] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: Optional[str] = None) -> "ModelRegistry":
+        path = path or os.getenv("MODEL_CONFIG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.json"))
+        if not os.path.exists(path):
+            return cls()
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        logger.info(f"model config loaded from {path}")
+        # デプロイメントと役割はキー単位で既定値に上書きする
+        return cls({
+            **DEFAULT_CONFIG,
+            **config,
+            "deployments": {**DEFAULT_CONFIG["deployments"], **config.get("deployments", {})},
+            "roles": {**DEFAULT_CONFIG["roles"], **config.get("roles", {})},
+        })
+
+    def role_config(self, role: str) -> dict:
+        # 未定義の役割は既定のデプロイメントを素のパラメータで使う
+        return {"deployment": self.config.get("default"), **self.config.get("roles", {}).get(role, {})}
+
+    def _build(self, deployment: str, params: dict) -> BaseChatModel:
+        spec = self.config["deployments"][deployment]
+        params = {k: v for k, v in params.items() if v is not None}
+        endpoint = os.getenv(spec.get("endpoint_env", "AZURE_OPENAI_ENDPOINT"))
+        api_key = os.getenv(spec.get("api_key_env", "AZURE_OPENAI_API_KEY"))
+        api_version = spec.get("api_version", "2023-05-15")
+        if replaying():
+            # 再生時はネットワークに出ないので、接続先と鍵が未設定でも起動できるようにする
+            endpoint = endpoint or "http://cassette.invalid"
+            api_key = api_key or "cassette"
+        if spec.get("provider", "azure") == "custom":
+            return OpenAIChatCustom(
+                deployment_name=spec.get("deployment_name", deployment),
+                api_key=api_key,
+                endpoint=endpoint,
+                api_version=api_version,
+                **params,
+            )
+        return AzureChatOpenAI(
+            openai_api_version=api_version,
+            deployment_name=spec.get("deployment_name", deployment),
+            azure_endpoint=endpoint,
+            openai_api_key=api_key,
+            # 全エージェント共通のレートリミッタ（RPM/TPM）とリトライを通す
+            **rate_limited_client_kwargs(),
+            **params,
+        )
+
+    def _model(self, deployment: str, params: dict) -> BaseChatModel:
+        # 同じデプロイメント・同じパラメータのモデルは役割をまたいで使い回す
+        key = (deployment, tuple(sorted(params.items())))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = self._build(deployment, params)
+            return model
+
+    def get(self, role: str, **overrides) -> BaseChatModel:
+        role_config = {**self.role_config(role), **overrides}
+        params = {k: role_config[k] for k in _PARAM_KEYS if k in role_config}
+        default = self._model(role_config["deployment"], params)
+        # この役割に当てはまる振り分けルール（プロンプトが小さければ軽いデプロイメントへ）
+        routes = [
+            (rule["max_prompt_tokens"], self._model(rule["deployment"], {**params, **{k: rule[k] for k in _PARAM_KEYS if k in rule}}))
+            for rule in self.config.get("rules", [])
+            if role in rule.get("roles", ROLES) and "max_prompt_tokens" in rule
+        ]
+        if not routes:
+            return default
+        return RoutedChatModel(routes=sorted(routes, key=lambda r: r[0]), default=default)
+
+    def describe(self) -> str:
+        lines = []
+        for role in ROLES:
+            c = self.role_config(role)
+            params = ", ".join(f"{k}={c[k]}" for k in _PARAM_KEYS if k in c)
+            rules = [f"≤{r['max_prompt_tokens']}tok→{r['deployment']}" for r in self.config.get("rules", [])
+                     if role in r.get("roles", ROLES) and "max_prompt_tokens" in r]
+            lines.append(f"{role}: {c['deployment']}" + (f" ({params})" if params else "") + (f" [{', '.join(rules)}]" if rules else ""))
+        return "\n".join(lines)
+
+
+_default_registry: Optional[ModelRegistry] = None
+_default_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    global _default_registry
+    if _default_registry is None:
+        with _default_lock:
+            if _default_registry is None:
+                _default_registry = ModelRegistry.from_file()
+    return _default_registry
+
+
+def get_llm(role: str, **overrides) -> BaseChatModel:
+    return get_model_registry().get(role, **overrides)
@@ -1,21 +1,39 @@
 import os
+import uuid
+import asyncio
 import traceback
 import logging
 from datetime import datetime
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
 from langchain_core.messages import SystemMessage
-from langchain_openai import AzureChatOpenAI
-from langchain.agents import Tool, initialize_agent, AgentType
+from langchain.agents import Tool
 from langchain.chains.llm import LLMChain
 from dataclasses import dataclass
+from streaming import StreamPrinter, print_stream
+from specialist_agent import create_specialist_executor, answer_stream_handler
+from speculative import SpeculativeTurnRunner, BranchError
+from panel import arun_panel, create_panel_synthesis_chain, format_panel_answers
+from async_runtime import run_coroutine, iterate_async
+from history import HistoryManager
+from session_store import get_session_store, named_prompt_message, format_resumed
+from llm_cache import with_cache
+from tool_registry import ToolRegistry
+from scheduler import create_scheduler
+from facilitator import create_constrained_decide
+from log_writer import JSONLLogWriter, open_session_log, log_chat
+from memory_index import MemoryIndex, format_memories
+from accounting import UsageTracker, UsageCallbackHandler, TurnBudget, BudgetExceeded
+from deadline import start_deadline, within_deadline, deadline_iter, clamp_timeout, DeadlineExceeded
+from model_registry import get_llm
 
 # ========== LLM 初期化 ==========
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# 役割ごとのデプロイメントとパラメータは models.json で切り替える
+llm = get_llm("specialist")
+# 決定的な呼び出し（脳ツール・ファシリテータ）用のキャッシュ付きLLM
+cached_llm = with_cache(get_llm("brain_tool"))
+facilitator_llm = with_cache(get_llm("facilitator"))
+# ツールのプロンプトとrunnableは起動時に一度だけ組み立て、全専門エージェントで共有する
+tool_registry = ToolRegistry()
 
 # ========== 共通脳ツール群 ==========
 class LLMBrainTool:
@@ -28,15 +46,12 @@ class LLMBrainTool:
         self.description = description
         self.prompt = prompt
 
+    @property
+    def system_prompt(self) -> str:
+        return f"あなたは{self.name}です。{self.prompt}"
+
     def __call__(self, input_text: str) -> str:
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content=f"あなたは{self.name}です。{self.prompt}"),
-            HumanMessagePromptTemplate.from_template("{input}")
-        ])
-        chain = prompt | llm
-        content = chain.invoke({"input": input_text}).content
-        logging.info(f"Tool {self.name} invoked with input: {input_text}\nOutput: {content}")
-        return content
+        return tool_registry.invoke(self.name, input_text)
 
 brain_functions = {
     "意図推論ツール": LLMBrainTool(
@@ -70,70 +85,39 @@ brain_functions = {
         prompt="あなたの役割は自分が出した結論や提案を、相手が理解しやすい形にまとめ、明確に整形して伝えることです。"
     )
 }
-brain_tools = []
-for name, tool in brain_functions.items():
-    brain_tools.append(
-        Tool(
-            name=name,
-            func=lambda x: tool(x),
-            description=tool.description
-        )
-    )
+for tool in brain_functions.values():
+    tool_registry.register_prompt(tool.name, tool.description, tool.system_prompt, cached_llm, role="brain_tool")
+brain_tools = tool_registry.as_tools(brain_functions.keys())
 
 # ========== 各専門固有ツール ==========
 def create_legal_tools(llm):
     # 例：法律データベース検索
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたは法律専門家です。質問に関連する条文や判例を参照します。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="法律DB検索", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="法律の条文や判例を調べる"
-        )
-    ]
+    tool_registry.register_prompt(
+        "法律DB検索", "法律の条文や判例を調べる",
+        "あなたは法律専門家です。質問に関連する条文や判例を参照します。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["法律DB検索"])
 
 def create_engineer_tools(llm):
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたはエンジニアです。技術仕様を評価し、実装案を考えます。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="技術仕様評価", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="技術的実現性や工数を見積もる"
-        )
-    ]
+    tool_registry.register_prompt(
+        "技術仕様評価", "技術的実現性や工数を見積もる",
+        "あなたはエンジニアです。技術仕様を評価し、実装案を考えます。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["技術仕様評価"])
 
 def create_common_sense_tools(llm):
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたは一般常識に詳しい専門家です。世間的な感覚や常識を反映します。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="世間感覚分析", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="一般的な人々の受け止め方を予測する"
-        )
-    ]
+    tool_registry.register_prompt(
+        "世間感覚分析", "一般的な人々の受け止め方を予測する",
+        "あなたは一般常識に詳しい専門家です。世間的な感覚や常識を反映します。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["世間感覚分析"])
 
 # ========== 専門エージェント ==========
+# SPECIALIST_AGENT_TYPE=tool_calling（または SPECIALIST_AGENT_TYPES で個別指定）で、
+# ReActの代わりに関数呼び出しで複数ツールをまとめて要求・並列実行するエージェントにする
 def create_specialist_agent(name, system_msg, specific_tools):
     all_tools = brain_tools + specific_tools
-    return initialize_agent(
-        tools=all_tools,
-        llm=llm,
-        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-        verbose=True,
-        system_message=system_msg
-    )
+    return create_specialist_executor(name, system_msg, all_tools, llm)
 
 legal_agent = create_specialist_agent("法律エージェント", "あなたは法律の専門家です。", create_legal_tools(llm))
 engineer_agent = create_specialist_agent("エンジニアエージェント", "あなたは技術の専門家です。", create_engineer_tools(llm))
@@ -143,26 +127,20 @@ common_sense_agent = create_specialist_agent("一般常識エージェント", "
 from langchain.callbacks.base import BaseCallbackHandler
 
 class LogCallbackHandler(BaseCallbackHandler):
-    def __init__(self, log_path):
-        self.log_path = log_path
+    # 書き込みはJSONLLogWriterのキューに積むだけで、ターン中にディスクI/Oを待たない
+    def __init__(self, writer: JSONLLogWriter, agent: str = None):
+        self.writer = writer
+        self.agent = agent
 
-    def on_agent_action(self, action, **kwargs):
-        with open(self.log_path, "a", encoding="utf-8") as f:
-            f.write(f"<on_agent_action start> " + "=" * 20 + "\n")
-            f.write(f"[Thought] {action.log}\n")
-            f.write(f"[Action] {action.tool}\n")
-            f.write(f"[Action Input] {action.tool_input}\n")
-            f.write("-" * 40 + f" <on_agent_action end>" + "\n")
+    def on_agent_action(self, action, *, run_id=None, **kwargs):
+        self.writer.write({"event": "agent_action", "agent": self.agent, "run_id": str(run_id),
+                           "thought": action.log, "tool": action.tool, "tool_input": action.tool_input})
 
-    def on_tool_end(self, output, **kwargs):
-        with open(self.log_path, "a", encoding="utf-8") as f:
-            f.write(f"[Observation] {output}\n")
-            f.write("-" * 40 + "\n")
+    def on_tool_end(self, output, *, run_id=None, **kwargs):
+        self.writer.write({"event": "tool_end", "agent": self.agent, "run_id": str(run_id), "output": output})
 
-    def on_chain_end(self, outputs, **kwargs):
-        with open(self.log_path, "a", encoding="utf-8") as f:
-            f.write(f"[Final Output] {outputs}\n")
-            f.write("=" * 60 + "\n")
+    def on_chain_end(self, outputs, *, run_id=None, **kwargs):
+        self.writer.write({"event": "chain_end", "agent": self.agent, "run_id": str(run_id), "outputs": outputs})
 
 
 # ========== 専門エージェントの動作テスト ==========
@@ -174,7 +152,7 @@ class LogCallbackHandler(BaseCallbackHandler):
 
 # legal_result = legal_agent.invoke(input=user_question)
 # engineer_result = engineer_agent.invoke(input=user_question)
-# common_result = common_sense_agent.invoke(input=user_question,config={"callbacks": [LogCallbackHandler(f"{log_dir}/{datetime_str}_common_agent.txt")]})
+# common_result = common_sense_agent.invoke(input=user_question,config={"callbacks": [LogCallbackHandler(open_session_log(log_dir, "common_agent"))]})
 
 # print("\n=== 各専門家の回答 ===\n")
 # print("法律専門家の回答:", legal_result)
@@ -192,78 +170,237 @@ def create_facilitator_prompt(chilsd_agent_names: list[str]):
     return facilitator_prompt
 
 
+# ファシリテータ方式（llm / round_robin / least_recent / weighted_random / keyword）
+FACILITATOR_STRATEGY = os.getenv("FACILITATOR_STRATEGY", "llm")
+# ファシリテータ判断中に先行実行させる専門エージェント数（0で無効、llm方式のときのみ有効）
+SPECULATIVE_BRANCHES = int(os.getenv("SPECULATIVE_BRANCHES", "0"))
+# 応答モード（facilitator: ファシリテータが1人ずつ指名 / panel: 全専門エージェントに同時に問い合わせ）
+MULTI_AGENT_MODE = os.getenv("MULTI_AGENT_MODE", "facilitator")
+PANEL_MAX_CONCURRENCY = int(os.getenv("PANEL_MAX_CONCURRENCY", "3"))
+PANEL_TIMEOUT = float(os.getenv("PANEL_TIMEOUT", "120"))
+PANEL_SYNTHESIS = os.getenv("PANEL_SYNTHESIS", "1") == "1"
+# 過去のセッションから思い出す発言数（0で無効）
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+
+
+# 専門エージェントを非同期に実行する（outを渡すと最終回答をバッファへ流す）
+# 関数呼び出し型のエージェントは、非同期実行のときだけ1ステップ内のツールを同時に実行する
+# 入力は {"input": ...} で渡す（プロンプトから組み立てたAgentExecutorは文字列だけでは入力キーを決められない）
+async def ainvoke_specialist(agent, agent_input, out=None, callbacks=None):
+    callbacks = list(callbacks or [])
+    if out is not None:
+        callbacks.append(answer_stream_handler(agent, out.write))
+    result = await agent.ainvoke({"input": agent_input}, config={"callbacks": callbacks})
+    return result["output"]
+
+
+# ========== 会話履歴の要約エージェント ==========
+def create_summary_agent_chain(llm):
+    summary_prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content="以下の会話履歴を要約してください。必要なら結論を出してください。"),
+        MessagesPlaceholder(variable_name="chat_history"),
+        HumanMessagePromptTemplate.from_template("{input}")
+    ])
+    summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
+    return summary_chain
+
+
 # ========== シェルベースチャットボット ==========
 if __name__ == "__main__":
-    # ログファイルのパスを指定
-    log_dir = "chat_logs"
-    log_path = f"chat_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    os.makedirs(log_dir, exist_ok=True)
-    log_path = os.path.join(log_dir, log_path)
+    # ログはJSON Linesでバックグラウンドスレッドがまとめて書き出す（終了時にfsync）
+    chat_log = open_session_log("chat_logs")
 
     # チェーン生成
     agent_defs = {
         "法律エージェント": {
             "name": "法律エージェント",
             "description": "法律の専門家として、法律に関する質問に答えます。",
+            "keywords": ["法律", "法的", "契約", "規約", "違法", "権利", "条文", "判例", "責任"],
             "tool": legal_agent
         },
         "エンジニアエージェント": {
             "name": "エンジニアエージェント",
             "description": "技術の専門家として、技術的な質問に答えます。",
+            "keywords": ["技術", "システム", "実装", "開発", "コード", "AI", "ツール", "工数"],
             "tool": engineer_agent
         },
         "一般常識エージェント": {
             "name": "一般常識エージェント",
             "description": "一般常識の専門家として、世間的な感覚や常識を反映します。",
+            "keywords": ["一般", "常識", "世間", "生活", "マナー", "普通", "みんな"],
             "tool": common_sense_agent
         }
     }
     # facilitator_chain = create_facilitator_agent_chain(llm, list(agent_defs.values()))
     facilitator_prompt = create_facilitator_prompt(list(agent_defs.keys()))
+    # LLM呼び出しごとのトークン数・レイテンシ集計と、1ターンあたりの予算（TURN_MAX_TOKENS / TURN_MAX_CALLS）
+    usage = UsageTracker(TurnBudget.from_env())
+    scheduler = create_scheduler(
+        FACILITATOR_STRATEGY,
+        list(agent_defs.keys()),
+        decide=lambda user_input, chat_history: facilitator_llm.invoke(facilitator_prompt.invoke({
+            "input": "ユーザーの質問",
+            "chat_history": chat_history
+        }), config={"callbacks": [UsageCallbackHandler(usage, "facilitator")]}).content,
+        # FACILITATOR_STRATEGY=constrained: 履歴の代わりに発言状況の要約を渡し、名前の列挙型から選ばせる
+        # （関数呼び出しに対応したモデルが必要なので、この方式のときだけ組み立てる）
+        constrained_decide=create_constrained_decide(facilitator_llm, list(agent_defs.keys()),
+                                                     callbacks=[UsageCallbackHandler(usage, "facilitator")])
+        if FACILITATOR_STRATEGY == "constrained" else None,
+        affinities={name: d["keywords"] for name, d in agent_defs.items()},
+    )
 
-    # 履歴初期化
-    chat_history = []
+    # 投機実行の準備（非同期処理は常駐ループで実行し、クライアントを使い回す）
+    speculative = SPECULATIVE_BRANCHES > 0 and FACILITATOR_STRATEGY in ("llm", "constrained")
+    runner = SpeculativeTurnRunner(SPECULATIVE_BRANCHES)
+    synthesis_chain = create_panel_synthesis_chain(llm)
+
+    # 履歴初期化（直近の発言は原文、古い発言は要約に畳み込んでトークン予算内に収める）
+    # 発言はSQLiteに追記保存し、RESUME_SESSION=<セッションID> で続きから再開できる
+    session_id = os.getenv("RESUME_SESSION") or uuid.uuid4().hex
+    store = get_session_store()
+    resumed = not store.create_session(session_id, app="multi")
+    history = HistoryManager(create_summary_agent_chain(get_llm("summary")), callbacks=[UsageCallbackHandler(usage, "summary", enforce_budget=False)],
+                             store=store, session_id=session_id, prompt_view=named_prompt_message)
+    # 過去のセッションのログを長期記憶として索引化する（今回のログは次回以降に取り込まれる）
+    memory = MemoryIndex() if MEMORY_TOP_K > 0 else None
+    if memory is not None:
+        memory.start_ingest("chat_logs", exclude=[chat_log.path])
 
     print("🎙️ キャラエージェントたちと会話しましょう！'exit'で終了します。")
+    if resumed:
+        print(f"🔁 セッション {session_id} を再開します。直近の会話:\n{format_resumed(store.recent(session_id, 4))}")
 
     while True:
         user_input = input("🧑 あなた> ")
         if user_input.lower() == "exit":
+            print(f"📊 セッション合計: {usage.session.format()}")
+            print(f"💾 セッションID: {session_id}（RESUME_SESSION={session_id} で再開できます）")
+            if tool_registry.format_stats():
+                print(f"🧰 ツール呼び出し:\n{tool_registry.format_stats()}")
             print("👋 終了します。")
+            chat_log.close()
             break
 
-        chat_history.append({"role": "user", "content": user_input})
-        # log_chat(log_path, "user", "ユーザー", user_input)
+        history.append({"role": "user", "content": user_input})
+        log_chat(chat_log, "user", "ユーザー", user_input)
+        scheduler.start_turn(user_input)
+        usage.start_turn()
+        # TURN_DEADLINE秒を過ぎたら打ち切り、間に合わなかった専門エージェントは飛ばして、それまでの回答を結果とする
+        start_deadline()
+        recalled = format_memories(memory.search(user_input, k=MEMORY_TOP_K)) if memory is not None else ""
+        memory_text = f"\n関連する過去の会話（以前のセッション）:\n{recalled}" if recalled else ""
+
+        if MULTI_AGENT_MODE == "panel":
+            # 全専門エージェントに同時に問い合わせ、回答が終わった順に表示する
+            agent_input = f"ユーザー発言: {user_input}\n過去の会話履歴:\n{history.as_text()}{memory_text}"
+            specialists = {
+                name: (lambda q, name=name, agent=d["tool"]: ainvoke_specialist(
+                    agent, q, callbacks=[UsageCallbackHandler(usage, "specialist", name), LogCallbackHandler(chat_log, name)]))
+                for name, d in agent_defs.items()
+            }
+            results = []
+            # 各専門エージェントの待ち時間はターンの残り時間で頭打ちにする（間に合わなければタイムアウトとして飛ばす）
+            for r in iterate_async(arun_panel(specialists, agent_input, PANEL_MAX_CONCURRENCY, clamp_timeout(PANEL_TIMEOUT))):
+                if r.error is not None:
+                    print(f"⚠️ {r.name}の発言エラー: {r.error}")
+                    continue
+                print(f"🤖 {r.name}> {r.output}")
+                results.append(r)
+                log_chat(chat_log, "assistant", r.name, r.output, elapsed=round(r.elapsed, 3))
+                history.append({"role": "assistant", "name": r.name, "content": r.output})
+
+            if PANEL_SYNTHESIS and results:
+                try:
+                    synthesis = print_stream("🗣️ ファシリテーター> ", deadline_iter(synthesis_chain.stream({
+                        "input": user_input,
+                        "answers": format_panel_answers(results)
+                    }, config={"callbacks": [UsageCallbackHandler(usage, "synthesis")]}), "統合"))
+                    history.append({"role": "assistant", "name": "ファシリテーター", "content": synthesis})
+                    log_chat(chat_log, "assistant", "ファシリテーター", synthesis)
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"\n⛔ {e}")
+                except Exception as e:
+                    print(f"⚠️ 統合エラー: {e}")
+            print(f"📊 {usage.end_turn().format()}")
+            continue
 
         # 会話ターン数
         num_turns = len(agent_defs) *1  # 各エージェントが2回発言する場合
         for turn in range(num_turns):
-            # 次に誰が話すかを決める
-            try:
-                
-                prompt_value = facilitator_prompt.invoke({
-                    "input": "ユーザーの質問",
-                    "chat_history": chat_history
-                })
-
-                decision = llm.invoke(prompt_value)
-                print(f"🗣️ ファシリテーター> {decision.content}")
-                next_agent_name = decision.content.strip()
-                if next_agent_name not in agent_defs:
+            chat_history = history.for_prompt()
+            agent_input = f"ユーザー発言: {user_input}\n過去の会話履歴:\n{history.as_text()}{memory_text}"
+            if speculative:
+                # ファシリテータの判断中に、まだ発言していない専門エージェントを先行実行する
+                printer = StreamPrinter()
+                try:
+                    next_agent_name, output = run_coroutine(within_deadline(runner.arun(
+                        decide=lambda: asyncio.to_thread(scheduler.next_speaker, user_input, chat_history),
+                        run_agent=lambda name, out: ainvoke_specialist(
+                            agent_defs[name]["tool"], agent_input, out,
+                            callbacks=[UsageCallbackHandler(usage, "specialist", name), LogCallbackHandler(chat_log, name)]),
+                        candidates=scheduler.ranked_candidates(user_input),
+                        is_valid=lambda name: name in agent_defs,
+                        on_decision=lambda name: print(f"🗣️ ファシリテーター> {name}"),
+                        sink_for=lambda name: printer.start(f"🤖 {name}> "),
+                    ), "投機実行"))
+                except BranchError as e:
+                    print(f"⚠️ {e.name}の発言エラー: {e.error}")
+                    break
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"\n⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ ファシリテータエラー: {e}\n\n{traceback.format_exc()}")
+                    break
+                if output is None:
                     print(f"⚠️ 無効なエージェント指定: {next_agent_name}")
                     break
-            except Exception as e:
-                print(f"⚠️ ファシリテータエラー: {e}\n\n{traceback.format_exc()}")
-                break
-
-            # 選ばれたエージェントに発言させる
-            try:
-                result = agent_defs[next_agent_name]["tool"].invoke(
-                    f"ユーザー発言: {user_input}\n過去の会話履歴: {chat_history}",
-                )
-                print(f"🤖 {next_agent_name}> {result['output']}")
-                chat_history.append({"role": "assistant", "name": next_agent_name, "content": next_agent_name+": "+result["output"]})
-                # log_chat(log_path, "assistant", next_agent_name, result["text"])
-            except Exception as e:
-                print(f"⚠️ {next_agent_name}の発言エラー: {e}")
-                break
\ No newline at end of file
+                printer.finish(output)
+            else:
+                # 次に誰が話すかを決める
+                try:
+                    next_agent_name = scheduler.next_speaker(user_input, chat_history)
+                    print(f"🗣️ ファシリテーター> {next_agent_name}")
+                    if next_agent_name not in agent_defs:
+                        print(f"⚠️ 無効なエージェント指定: {next_agent_name}")
+                        break
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ ファシリテータエラー: {e}\n\n{traceback.format_exc()}")
+                    break
+
+                # 選ばれたエージェントに発言させる
+                try:
+                    # 最終回答を生成され次第表示する
+                    agent = agent_defs[next_agent_name]["tool"]
+                    stream_handler = answer_stream_handler(
+                        agent,
+                        on_token=lambda t: print(t, end="", flush=True),
+                        on_start=lambda: print(f"🤖 {next_agent_name}> ", end="", flush=True),
+                    )
+                    # 常駐ループで非同期に実行する（関数呼び出し型なら同じステップのツールが並列に走る）
+                    # ターンの残り時間で打ち切る（ReActのループやツール呼び出しもキャンセルされる）
+                    output = run_coroutine(within_deadline(ainvoke_specialist(agent, agent_input, callbacks=[
+                        stream_handler,
+                        UsageCallbackHandler(usage, "specialist", next_agent_name),
+                        LogCallbackHandler(chat_log, next_agent_name),
+                    ]), next_agent_name))
+                    if stream_handler.streamed:
+                        print()
+                    else:
+                        print(f"🤖 {next_agent_name}> {output}")
+                except (BudgetExceeded, DeadlineExceeded) as e:
+                    print(f"\n⛔ {e}")
+                    break
+                except Exception as e:
+                    print(f"⚠️ {next_agent_name}の発言エラー: {e}")
+                    break
+
+            history.append({"role": "assistant", "name": next_agent_name, "content": output})
+            scheduler.observe(next_agent_name)
+            log_chat(chat_log, "assistant", next_agent_name, output)
+
+        print(f"📊 {usage.end_turn().format()}")
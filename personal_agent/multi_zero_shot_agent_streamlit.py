@@ -4,20 +4,38 @@ import logging
 from datetime import datetime
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
 from langchain_core.messages import SystemMessage
-from langchain_openai import AzureChatOpenAI
-from langchain.agents import Tool, initialize_agent, AgentType
+from langchain.agents import Tool
 from langchain.chains.llm import LLMChain
 from dataclasses import dataclass
+from specialist_agent import create_specialist_executor, answer_stream_handler
+from llm_cache import with_cache
+from tool_registry import ToolRegistry
+from scheduler import create_scheduler, SCHEDULER_STRATEGIES
+from facilitator import create_constrained_decide
+from panel import arun_panel, create_panel_synthesis_chain, format_panel_answers
+from history import HistoryManager
+from session_store import get_session_store, display_view, json_prompt_message
+from rate_limiter import rate_limit_key
+from model_registry import get_llm
+from runtime import cache_resource, RerunTimer, start_turn, render_chat
+from turn_worker import TurnWorker, TurnCancelled, call_in_turn
+from deadline import start_deadline, within_deadline, adeadline_iter, clamp_timeout, DeadlineExceeded
 import json
 import streamlit as st
+import uuid
+
+# 再実行ごとのオーバーヘッドを計測する
+rerun_timer = RerunTimer()
 
 # ========== LLM 初期化 ==========
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# Streamlitは操作のたびにスクリプトを再実行するため、以下の構築物はプロセス内で共有する
+@cache_resource
+def build_llms():
+    # 役割ごとのデプロイメントとパラメータは models.json で切り替える
+    # 決定的な呼び出し（脳ツール・ファシリテータ）用はキャッシュ付きにする
+    return get_llm("specialist"), with_cache(get_llm("brain_tool")), with_cache(get_llm("facilitator")), get_llm("summary")
+
+llm, cached_llm, facilitator_llm, summary_llm = build_llms()
 
 # ========== 共通脳ツール群 ==========
 class LLMBrainTool:
@@ -30,15 +48,12 @@ class LLMBrainTool:
         self.description = description
         self.prompt = prompt
 
+    @property
+    def system_prompt(self) -> str:
+        return f"あなたは{self.name}です。{self.prompt}"
+
     def __call__(self, input_text: str) -> str:
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content=f"あなたは{self.name}です。{self.prompt}"),
-            HumanMessagePromptTemplate.from_template("{input}")
-        ])
-        chain = prompt | llm
-        content = chain.invoke({"input": input_text}).content
-        logging.info(f"Tool {self.name} invoked with input: {input_text}\nOutput: {content}")
-        return content
+        return tool_registry.invoke(self.name, input_text)
 
 brain_functions = {
     "意図推論ツール": LLMBrainTool(
@@ -72,104 +87,91 @@ brain_functions = {
         prompt="あなたの役割は自分が出した結論や提案を、相手が理解しやすい形にまとめ、明確に整形して伝えることです。出力は会話の一部として自然な形で行ってください。例えば、JSON形式ではなく、自然な言葉で発言してください。"
     )
 }
-brain_tools = []
-for name, tool in brain_functions.items():
-    brain_tools.append(
-        Tool(
-            name=name,
-            func=lambda x: tool(x),
-            description=tool.description
-        )
-    )
+# ツールのプロンプトとrunnableは一度だけ組み立て、全専門エージェント・全セッションで共有する
+@cache_resource
+def build_tool_registry():
+    registry = ToolRegistry()
+    for tool in brain_functions.values():
+        registry.register_prompt(tool.name, tool.description, tool.system_prompt, cached_llm, role="brain_tool")
+    return registry
+
+tool_registry = build_tool_registry()
+brain_tools = tool_registry.as_tools(brain_functions.keys())
 
 # ========== 各専門固有ツール ==========
 def create_legal_tools(llm):
     # 例：法律データベース検索
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたは法律専門家です。質問に関連する条文や判例を参照します。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="法律DB検索", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="法律の条文や判例を調べる"
-        )
-    ]
+    tool_registry.register_prompt(
+        "法律DB検索", "法律の条文や判例を調べる",
+        "あなたは法律専門家です。質問に関連する条文や判例を参照します。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["法律DB検索"])
 
 def create_engineer_tools(llm):
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたはエンジニアです。技術仕様を評価し、実装案を考えます。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="技術仕様評価", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="技術的実現性や工数を見積もる"
-        )
-    ]
+    tool_registry.register_prompt(
+        "技術仕様評価", "技術的実現性や工数を見積もる",
+        "あなたはエンジニアです。技術仕様を評価し、実装案を考えます。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["技術仕様評価"])
 
 def create_common_sense_tools(llm):
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="あなたは一般常識に詳しい専門家です。世間的な感覚や常識を反映します。"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    chain = prompt | llm
-    return [
-        Tool(
-            name="世間感覚分析", 
-            func=lambda x: chain.invoke({"input": x}).content, 
-            description="一般的な人々の受け止め方を予測する"
-        )
-    ]
+    tool_registry.register_prompt(
+        "世間感覚分析", "一般的な人々の受け止め方を予測する",
+        "あなたは一般常識に詳しい専門家です。世間的な感覚や常識を反映します。", llm, role="specialist_tool"
+    )
+    return tool_registry.as_tools(["世間感覚分析"])
 
 # ========== 専門エージェント ==========
 def create_specialist_agent(name: str, system_msg:str, specific_tools:list):
+    # SPECIALIST_AGENT_TYPE=tool_calling で、複数ツールをまとめて要求・並列実行するエージェントにする
     all_tools = brain_tools + specific_tools
-    return initialize_agent(
-        tools=all_tools,
-        llm=llm,
-        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-        verbose=True,
-        system_message=f"あなたの名前は{name}です。\n{system_msg}。ユーザーとの会話を通じて、あなたの専門知識を活かして答えてください。また自然な会話の流れを意識し、他のエージェントとの議論も行ってください。",
+    return create_specialist_executor(
+        name,
+        f"あなたの名前は{name}です。\n{system_msg}。ユーザーとの会話を通じて、あなたの専門知識を活かして答えてください。また自然な会話の流れを意識し、他のエージェントとの議論も行ってください。",
+        all_tools,
+        llm,
     )
 
-# エージェント定義
-agent_defs = {
-    "法律エージェント": {
-        "name": "法律エージェント",
-        "avatar": "https://icooon-mono.com/i/icon_14451/icon_144511_64.png",
-        "description": "法律の専門家として、法律に関する質問に答えます。",
-        "tool": create_specialist_agent(
-            name="法律エージェント", 
-            system_msg="あなたは法律の専門家です。", 
-            specific_tools=create_legal_tools(llm)
-        )
-    },
-    "エンジニアエージェント": {
-        "name": "エンジニアエージェント",
-        "avatar": "https://icooon-mono.com/i/icon_10193/icon_101931_64.png",
-        "description": "技術の専門家として、技術的な質問に答えます。",
-        "tool": create_specialist_agent(
-            name="エンジニアエージェント", 
-            system_msg="あなたは技術の専門家です。", 
-            specific_tools=create_engineer_tools(llm)
-        )
-    },
-    "一般常識エージェント": {
-        "name": "一般常識エージェント",
-        "avatar": "https://icooon-mono.com/i/icon_11127/icon_111271_64.png",
-        "description": "一般常識の専門家として、世間的な感覚や常識を反映します。",
-        "tool": create_specialist_agent(
-            name="一般常識エージェント", 
-            system_msg="あなたは一般常識の専門家です。", 
-            specific_tools=create_common_sense_tools(llm)
-        )
+# エージェント定義（ReActエージェントの組み立ては重いので、プロセスで1度だけ行う）
+@cache_resource
+def build_agent_defs():
+    return {
+        "法律エージェント": {
+            "name": "法律エージェント",
+            "avatar": "https://icooon-mono.com/i/icon_14451/icon_144511_64.png",
+            "description": "法律の専門家として、法律に関する質問に答えます。",
+        "keywords": ["法律", "法的", "契約", "規約", "違法", "権利", "条文", "判例", "責任"],
+            "tool": create_specialist_agent(
+                name="法律エージェント", 
+                system_msg="あなたは法律の専門家です。", 
+                specific_tools=create_legal_tools(llm)
+            )
+        },
+        "エンジニアエージェント": {
+            "name": "エンジニアエージェント",
+            "avatar": "https://icooon-mono.com/i/icon_10193/icon_101931_64.png",
+            "description": "技術の専門家として、技術的な質問に答えます。",
+        "keywords": ["技術", "システム", "実装", "開発", "コード", "AI", "ツール", "工数"],
+            "tool": create_specialist_agent(
+                name="エンジニアエージェント", 
+                system_msg="あなたは技術の専門家です。", 
+                specific_tools=create_engineer_tools(llm)
+            )
+        },
+        "一般常識エージェント": {
+            "name": "一般常識エージェント",
+            "avatar": "https://icooon-mono.com/i/icon_11127/icon_111271_64.png",
+            "description": "一般常識の専門家として、世間的な感覚や常識を反映します。",
+        "keywords": ["一般", "常識", "世間", "生活", "マナー", "普通", "みんな"],
+            "tool": create_specialist_agent(
+                name="一般常識エージェント", 
+                system_msg="あなたは一般常識の専門家です。", 
+                specific_tools=create_common_sense_tools(llm)
+            )
+        }
     }
-}
+
+agent_defs = build_agent_defs()
 
 
 # ========== 専門エージェントの動作テスト ==========
@@ -189,6 +191,23 @@ agent_defs = {
 # print("一般常識専門家の回答:", common_result)
 
 
+# ========== 会話履歴の要約エージェント ==========
+def create_summary_agent_chain(llm):
+    summary_prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content="以下の会話履歴を要約してください。必要なら結論を出してください。"),
+        MessagesPlaceholder(variable_name="chat_history"),
+        HumanMessagePromptTemplate.from_template("{input}")
+    ])
+    summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
+    return summary_chain
+
+
+# 専門エージェントを非同期に実行する（パネルモード用）
+async def ainvoke_specialist(agent, agent_input):
+    result = await agent.ainvoke({"input": agent_input})
+    return result["output"]
+
+
 # ========== ファシリテータ（議長）エージェントを定義　==========
 def create_facilitator_prompt(chilsd_agent_names: list[str]):
     facilitator_prompt = ChatPromptTemplate.from_messages([
@@ -199,84 +218,214 @@ def create_facilitator_prompt(chilsd_agent_names: list[str]):
     return facilitator_prompt
 
 
-# --- Streamlit UI ---
-st.set_page_config(page_title="マルチキャラエージェントチャット", layout="wide")
-st.title("🎭 マルチキャラクターチャット")
+# 状態を持たないチェーンは全セッションで共有する
+@cache_resource
+def build_chains():
+    return {
+        "summary": create_summary_agent_chain(summary_llm),
+        "facilitator_prompt": create_facilitator_prompt(list(agent_defs.keys())),
+        "synthesis": create_panel_synthesis_chain(llm),
+    }
 
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "agent_history" not in st.session_state:
-    st.session_state.agent_history = []
-if "display_chat_history" not in st.session_state:
-    st.session_state.display_chat_history = []
-if "agents" not in st.session_state:
-    st.session_state.agents = agent_defs
-if "facilitator" not in st.session_state:
-    st.session_state.facilitator_prompt = create_facilitator_prompt(list(agent_defs.keys()))
 
-# 入力欄
-user_input = st.chat_input("あなたの質問を入力...")
+# 列挙型の指名は関数呼び出しに対応したモデルが必要なので、constrained方式を選んだときだけ組み立てる
+@cache_resource
+def build_constrained_decide():
+    return create_constrained_decide(facilitator_llm, list(agent_defs.keys()), call=call_in_turn)
 
-# 過去の会話を表示
-for msg in st.session_state.display_chat_history:
-    with st.chat_message(name=msg.get("name", msg["role"]), avatar=msg.get("avatar", None)):
-        st.markdown(msg.get("name", msg["role"]) + ":")
-        st.markdown(msg["content"])
+chains = build_chains()
 
-if user_input:
-    st.session_state.chat_history.append({"role": "user", "content": user_input})
-    st.session_state.display_chat_history.append({"role": "user", "content": user_input})
-    with st.chat_message("user"):
-        st.markdown(user_input)
 
-    st.session_state.agent_history = []  # エージェントの発言履歴を初期化
+# ========== 1ターン分の応答（ワーカースレッドで実行するため、st.session_stateには触れない） ==========
+def run_panel_turn(turn, user_input, history, panel):
+    # 全専門エージェントに同時に問い合わせ、回答が終わった順に送る
+    agent_input = f"ユーザー発言: {user_input}\n過去の会話履歴:\n{history.as_text()}"
+    specialists = {
+        name: (lambda q, agent=d["tool"]: ainvoke_specialist(agent, q))
+        for name, d in agent_defs.items()
+    }
+    results = []
+    # 各専門エージェントの待ち時間はターンの残り時間で頭打ちにする（間に合わなければタイムアウトとして飛ばす）
+    for r in turn.stream(arun_panel(specialists, agent_input, panel["concurrency"], clamp_timeout(panel["timeout"]))):
+        if r.error is not None:
+            turn.emit("warning", content=f"⚠️ {r.name}の発言エラー: {r.error}")
+            continue
+        results.append(r)
+        # 保存するのは発言そのもの。プロンプト用の {'name': ..., 'content': ...} 形式はビューで作る
+        history.append({"role": "assistant", "name": r.name, "content": r.output})
+        turn.emit("message", r.name, r.output, avatar=agent_defs[r.name]["avatar"], caption=f"{r.elapsed:.1f}秒")
+
+    if panel["synthesis"] and results:
+        try:
+            turn.emit("speaker", "ファシリテーター")
+            synthesis = ""
+            for token in turn.stream(adeadline_iter(chains["synthesis"].astream({
+                "input": user_input,
+                "answers": format_panel_answers(results)
+            }), "統合")):
+                synthesis += token
+                turn.emit("token", "ファシリテーター", token)
+            history.append({"role": "assistant", "name": "ファシリテーター", "content": synthesis})
+            turn.emit("message", "ファシリテーター", synthesis)
+        except TurnCancelled:
+            raise
+        except DeadlineExceeded as e:
+            turn.emit("warning", content=f"⛔ {e}")
+        except Exception as e:
+            turn.emit("warning", content=f"⚠️ 統合エラー: {traceback.format_exc()}")
+
 
+def run_facilitator_turn(turn, user_input, history, scheduler, agent_history):
     # エージェントの発言ターン数
     for _ in range(len(agent_defs)):
+        next_agent_name = None
         try:
-            prompt_value = st.session_state.facilitator_prompt.invoke({
-                    "input": f"{user_input}",
-                    "chat_history": st.session_state.chat_history
-                })
-
-            decision = llm.invoke(prompt_value)
-            print(f"🗣️ ファシリテーター> {decision}")
-            next_agent_name = decision.content.strip()
-            if next_agent_name not in st.session_state.agents:
-                st.warning(f"⚠️ 無効なエージェント指定: {next_agent_name}")
+            turn.check()
+            next_agent_name = scheduler.next_speaker(user_input, history.for_prompt())
+            turn.check()
+            print(f"🗣️ ファシリテーター> {next_agent_name}")
+            if next_agent_name not in agent_defs:
+                turn.emit("warning", content=f"⚠️ 無効なエージェント指定: {next_agent_name}")
                 break
 
-            st.session_state.agent_history.append(next_agent_name)
-            
-            result = agent_defs[next_agent_name]["tool"].invoke(
-                f"ユーザー発言: {user_input}\n過去の会話履歴: {st.session_state.chat_history}",
+            agent_history.append(next_agent_name)
+            scheduler.observe(next_agent_name)
+
+            # 最終回答を生成され次第送る（停止ボタンで生成中のリクエストも打ち切る）
+            avatar = agent_defs[next_agent_name]["avatar"]
+            turn.emit("speaker", next_agent_name, avatar=avatar)
+            agent = agent_defs[next_agent_name]["tool"]
+            stream_handler = answer_stream_handler(
+                agent,
+                on_token=lambda t, name=next_agent_name: turn.emit("token", name, t),
             )
+            # ターンの残り時間で打ち切る（ReActのループやツール呼び出しもキャンセルされる）
+            result = turn.call(within_deadline(agent.ainvoke(
+                {"input": f"ユーザー発言: {user_input}\n過去の会話履歴:\n{history.as_text()}"},
+                config={"callbacks": [stream_handler]},
+            ), next_agent_name))
             print(f"🤖 {next_agent_name}> {result}")
-
             content = result["output"]
 
             if content != "無効なレスポンス":
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "name": next_agent_name,
-                    "content": f"{{'name': '{next_agent_name}', 'content': '{content}'}}"
-                })
-            st.session_state.display_chat_history.append({
-                "role": "assistant",
-                "avatar": agent_defs[next_agent_name]["avatar"],
-                "name": next_agent_name,
-                "content": content
-            })
-            with st.chat_message(name=next_agent_name, avatar=agent_defs[next_agent_name]["avatar"]):
-                st.markdown(next_agent_name + ":")
-                st.markdown(content)
-
+                history.append({"role": "assistant", "name": next_agent_name, "content": content})
+            turn.emit("message", next_agent_name, content, avatar=avatar)
+
+        except TurnCancelled:
+            raise
+        except DeadlineExceeded as e:
+            turn.emit("warning", content=f"⛔ {e}")
+            break
         except Exception as e:
-            # st.error(f"エラー: {e}")
-            # break
             error_message = traceback.format_exc()
+            turn.emit("warning", content=f"⚠️ {next_agent_name}の発言エラー: {error_message}")
+
+
+def run_multi_turn(turn, user_input, mode, history, scheduler, agent_history, panel):
+    agent_history.clear()  # エージェントの発言履歴を初期化
+    scheduler.start_turn(user_input)
+    # TURN_DEADLINE秒を過ぎたら打ち切り、それまでの回答をこのターンの結果とする（ワーカースレッドのコンテキストに設定）
+    start_deadline()
+    if mode == "panel":
+        run_panel_turn(turn, user_input, history, panel)
+    else:
+        run_facilitator_turn(turn, user_input, history, scheduler, agent_history)
+
+
+def display_extra(message):
+    # 保存済みの発言を表示するときにアイコンを補う
+    name = message.get("name")
+    return {"avatar": agent_defs[name]["avatar"]} if name in agent_defs else {}
+
+
+def render_message(msg):
+    with st.chat_message(name=msg.get("name", msg["role"]), avatar=msg.get("avatar", None)):
+        st.markdown(msg.get("name", msg["role"]) + ":")
+        st.markdown(msg["content"])
+        if msg.get("caption"):
+            st.caption(msg["caption"])
+
+
+# --- Streamlit UI ---
+st.set_page_config(page_title="マルチキャラエージェントチャット", layout="wide")
+st.title("🎭 マルチキャラクターチャット")
+
+# 発言はSQLiteに追記保存し、URLの ?session=<セッションID> で続きから再開できる
+store = get_session_store()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = st.query_params.get("session") or uuid.uuid4().hex
+    st.query_params["session"] = st.session_state.session_id
+    store.create_session(st.session_state.session_id, app="multi_streamlit")
+# 複数セッションが同じデプロイメントを使うため、レートリミッタの待ち行列はセッション単位で公平に回す
+rate_limit_key.set(st.session_state.session_id)
+st.sidebar.caption(f"セッションID: {st.session_state.session_id}")
+
+if "history" not in st.session_state:
+    # 直近の発言は原文、古い発言は要約に畳み込んでトークン予算内に収める（メモリ上には直近分だけを持つ）
+    st.session_state.history = HistoryManager(chains["summary"], store=store, session_id=st.session_state.session_id,
+                                              prompt_view=json_prompt_message)
+if "agent_history" not in st.session_state:
+    st.session_state.agent_history = []
+if "display_chat_history" not in st.session_state:
+    # 再開時は保存済みの直近の発言から表示用の履歴を作る
+    saved = store.recent(st.session_state.session_id, int(os.getenv("DISPLAY_HISTORY_LIMIT", "200")))
+    st.session_state.display_chat_history = display_view(saved, display_extra)
+if "turn_worker" not in st.session_state:
+    st.session_state.turn_worker = TurnWorker()
+worker = st.session_state.turn_worker
+
+# ファシリテータ方式の選択（llm以外はLLMを呼ばずにローカルで決定する）
+strategy = st.sidebar.selectbox(
+    "ファシリテーター方式",
+    SCHEDULER_STRATEGIES,
+    index=SCHEDULER_STRATEGIES.index(os.getenv("FACILITATOR_STRATEGY", "llm")),
+)
+if st.session_state.get("scheduler_strategy") != strategy:
+    st.session_state.scheduler_strategy = strategy
+    st.session_state.scheduler = create_scheduler(
+        strategy,
+        list(agent_defs.keys()),
+        # 指名の呼び出しもターンのcall経由で待ち、停止ボタンで打ち切れるようにする
+        decide=lambda user_input, chat_history: call_in_turn(facilitator_llm.ainvoke(chains["facilitator_prompt"].invoke({
+            "input": f"{user_input}",
+            "chat_history": chat_history
+        }))).content,
+        constrained_decide=build_constrained_decide() if strategy == "constrained" else None,
+        affinities={name: d["keywords"] for name, d in agent_defs.items()},
+    )
+
+# 応答モードの選択（パネル: 全専門エージェントに同時に問い合わせる）
+mode = st.sidebar.radio(
+    "応答モード",
+    ["facilitator", "panel"],
+    format_func=lambda m: {"facilitator": "ファシリテーター指名", "panel": "パネル（同時回答）"}[m],
+    index=["facilitator", "panel"].index(os.getenv("MULTI_AGENT_MODE", "facilitator")),
+)
+panel_concurrency = st.sidebar.number_input("パネル同時実行数", min_value=1, max_value=len(agent_defs), value=len(agent_defs))
+panel_timeout = st.sidebar.number_input("パネルのタイムアウト（秒）", min_value=5, value=120)
+panel_synthesis = st.sidebar.checkbox("専門家の回答を統合する", value=True)
+
+# 入力欄
+user_input = st.chat_input("あなたの質問を入力...", disabled=worker.running)
+rerun_timer.mark("セットアップ")
+
+if user_input:
+    st.session_state.history.append({"role": "user", "content": user_input})
+    st.session_state.display_chat_history.append({"role": "user", "content": user_input})
+    # ターンはワーカースレッドで実行し、発言は届いた順に逐次表示する
+    start_turn(
+        worker,
+        run_multi_turn,
+        user_input,
+        mode,
+        st.session_state.history,
+        st.session_state.scheduler,
+        st.session_state.agent_history,
+        {"concurrency": panel_concurrency, "timeout": panel_timeout, "synthesis": panel_synthesis},
+    )
 
-            st.warning(f"⚠️ {next_agent_name}の発言エラー: {error_message}")
+render_chat(worker, render_message)
 
+rerun_timer.render()
 
 # streamlit run .\personal_agent\multi_zero_shot_agent_streamlit.py
\ No newline at end of file
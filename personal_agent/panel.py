@@ -0,0 +1,61 @@
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+
+
+@dataclass
+class PanelResult:
+    name: str
+    output: Optional[str]
+    error: Optional[str]
+    elapsed: float
+
+
+# ========== パネルモード：全専門エージェントへの同時問い合わせ ==========
+async def arun_panel(
+    specialists: dict[str, Callable[[str], Awaitable[str]]],
+    question: str,
+    max_concurrency: int = 3,
+    timeout: Optional[float] = None,
+) -> AsyncIterator[PanelResult]:
+    # 同時実行数を制限しつつ全員に投げ、終わった順に結果を返す
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run_one(name: str, run: Callable[[str], Awaitable[str]]) -> PanelResult:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                output = await asyncio.wait_for(run(question), timeout)
+                return PanelResult(name, output, None, time.perf_counter() - start)
+            except asyncio.TimeoutError:
+                return PanelResult(name, None, f"タイムアウト（{timeout}秒）", time.perf_counter() - start)
+            except Exception as e:
+                return PanelResult(name, None, str(e), time.perf_counter() - start)
+
+    tasks = [asyncio.ensure_future(run_one(name, run)) for name, run in specialists.items()]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ========== 統合（最終まとめ）チェーン ==========
+def create_panel_synthesis_chain(llm):
+    prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content="あなたはファシリテーターです。複数の専門家の回答を踏まえ、重複を整理し、対立点があれば明示したうえで、ユーザーの質問への統合的な回答をまとめてください。"),
+        HumanMessagePromptTemplate.from_template("# ユーザーの質問\n{input}\n\n# 専門家の回答\n{answers}"),
+    ])
+    return prompt | llm | StrOutputParser()
+
+
+def format_panel_answers(results: list[PanelResult]) -> str:
+    return "\n\n".join(f"## {r.name}\n{r.output}" for r in results if r.output is not None)
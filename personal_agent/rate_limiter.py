@@ -0,0 +1,457 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import weakref
+import threading
+import itertools
+import contextvars
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+import httpx
+
+from token_utils import estimate_message_tokens
+from deadline import current_deadline, check_deadline
+from cassette import wrap_transport, wrap_async_transport
+
+logger = logging.getLogger(__name__)
+
+# 公平キューイングの単位（Streamlitではセッションごとに設定する）
+rate_limit_key: contextvars.ContextVar[str] = contextvars.ContextVar("rate_limit_key", default="default")
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+# ========== リトライ設定 ==========
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        default = cls()
+        return cls(
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", default.max_retries)),
+            base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", default.base_delay)),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", default.max_delay)),
+        )
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # Retry-Afterがあればそれを優先し、なければフルジッタ付きの指数バックオフ
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) + random.uniform(0, self.base_delay / 2)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+def parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ========== RPM / TPM トークンバケット ==========
+class RateLimiter:
+    """1デプロイメント分のRPM/TPMクォータをプロセス内の全呼び出しで共有する。
+
+    Azureは1分あたりのクォータを10秒単位でも判定するため、バケットの容量を
+    クォータの1/6に抑え、補充速度をクォータ×headroomにしてバーストさせない。
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, headroom: float = 0.9):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._req_rate = rpm * headroom / 60 if rpm else None
+        self._tok_rate = tpm * headroom / 60 if tpm else None
+        self._req_capacity = max(1.0, rpm / 6) if rpm else None
+        self._tok_capacity = max(1.0, tpm / 6) if tpm else None
+        self._req_level = self._req_capacity or 0.0
+        self._tok_level = self._tok_capacity or 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        # キー（セッション）ごとの待ち行列をラウンドロビンで処理する
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._tickets = itertools.count()
+        # 待っている呼び出しの起こし方（チケット→関数）。先頭になったときだけ起こす
+        self._waiters: dict[int, Callable[[], None]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"granted": 0, "waited": 0.0, "throttled": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rpm or self.tpm)
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self._req_rate:
+            self._req_level = min(self._req_capacity, self._req_level + elapsed * self._req_rate)
+        if self._tok_rate:
+            self._tok_level = min(self._tok_capacity, self._tok_level + elapsed * self._tok_rate)
+
+    def _enqueue(self, key: str, wake: Callable[[], None]) -> int:
+        ticket = next(self._tickets)
+        with self._lock:
+            self._waiters[ticket] = wake
+            self._queues.setdefault(key, deque()).append(ticket)
+        return ticket
+
+    def _remove(self, key: str, ticket: int):
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[key]
+        self._wake_head()
+
+    def _wake_head(self):
+        # 先頭が入れ替わったら、新しい先頭の呼び出しだけを起こす（ロック保持中に呼ぶ）
+        if not self._queues:
+            return
+        wake = self._waiters.get(self._queues[next(iter(self._queues))][0])
+        if wake is not None:
+            wake()
+
+    def _try_grant(self, key: str, ticket: int, cost: int) -> Optional[float]:
+        # 許可できれば0を、先頭なら補充を待つ秒数を、先頭でなければNone（起こされるまで待つ）を返す
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            head_key = next(iter(self._queues))
+            if head_key != key or self._queues[key][0] != ticket:
+                return None
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            cost = min(cost, self._tok_capacity) if self._tok_capacity else cost
+            waits = []
+            if self._req_rate and self._req_level < 1:
+                waits.append((1 - self._req_level) / self._req_rate)
+            if self._tok_rate and self._tok_level < cost:
+                waits.append((cost - self._tok_level) / self._tok_rate)
+            if waits:
+                return max(waits)
+            if self._req_rate:
+                self._req_level -= 1
+            if self._tok_rate:
+                self._tok_level -= cost
+            self._queues[key].popleft()
+            if self._queues[key]:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self.stats["granted"] += 1
+            self._wake_head()
+            return 0.0
+
+    def _wait_timeout(self, wait: Optional[float]) -> Optional[float]:
+        # 先頭でない間は起こされるまで（ターンの期限があればその残り時間まで）待つ
+        deadline = current_deadline()
+        if deadline is None:
+            return wait
+        return deadline.remaining() if wait is None else min(wait, deadline.remaining())
+
+    def acquire(self, cost: int = 0, key: Optional[str] = None):
+        if not self.enabled:
+            return
+        key = key or rate_limit_key.get()
+        event = threading.Event()
+        ticket = self._enqueue(key, event.set)
+        start = time.monotonic()
+        try:
+            while True:
+                event.clear()
+                wait = self._try_grant(key, ticket, cost)
+                if wait == 0:
+                    break
+                check_deadline("レート制限の待ち")
+                event.wait(self._wait_timeout(wait))
+        except BaseException:
+            with self._lock:
+                self._remove(key, ticket)
+            raise
+        finally:
+            with self._lock:
+                self._waiters.pop(ticket, None)
+        self.stats["waited"] += time.monotonic() - start
+
+    async def aacquire(self, cost: int = 0, key: Optional[str] = None):
+        if not self.enabled:
+            return
+        key = key or rate_limit_key.get()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        # 起こすのは別スレッド（他のループや同期呼び出し）の場合もあるので、ループ経由でセットする
+        ticket = self._enqueue(key, lambda: loop.call_soon_threadsafe(event.set))
+        start = time.monotonic()
+        try:
+            while True:
+                event.clear()
+                wait = self._try_grant(key, ticket, cost)
+                if wait == 0:
+                    break
+                check_deadline("レート制限の待ち")
+                try:
+                    await asyncio.wait_for(event.wait(), self._wait_timeout(wait))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                self._remove(key, ticket)
+            raise
+        finally:
+            with self._lock:
+                self._waiters.pop(ticket, None)
+        self.stats["waited"] += time.monotonic() - start
+
+    def throttle(self, retry_after: Optional[float]):
+        # 429を受けたら全呼び出しをRetry-Afterの間止める（各自がバラバラに再送しない）
+        with self._lock:
+            self.stats["throttled"] += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + (retry_after or 1.0))
+            self._req_level = min(self._req_level, 0.0)
+
+    def observe_headers(self, headers: httpx.Headers):
+        # Azureが返す残りクォータに合わせてバケットを補正する（他プロセスの消費分も反映される）
+        with self._lock:
+            remaining = headers.get("x-ratelimit-remaining-tokens")
+            if remaining and self._tok_capacity:
+                try:
+                    self._tok_level = min(self._tok_level, float(remaining))
+                except ValueError:
+                    pass
+            remaining = headers.get("x-ratelimit-remaining-requests")
+            if remaining and self._req_capacity:
+                try:
+                    self._req_level = min(self._req_level, float(remaining))
+                except ValueError:
+                    pass
+
+
+# ========== デプロイメントごとのリミッタ ==========
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(deployment: str) -> RateLimiter:
+    # LLM_RPM / LLM_TPM が未設定ならバケットは無効（リトライのみ行う）
+    with _limiters_lock:
+        limiter = _limiters.get(deployment)
+        if limiter is None:
+            rpm = os.getenv("LLM_RPM")
+            tpm = os.getenv("LLM_TPM")
+            limiter = RateLimiter(
+                rpm=int(rpm) if rpm else None,
+                tpm=int(tpm) if tpm else None,
+                headroom=float(os.getenv("RATE_LIMIT_HEADROOM", "0.9")),
+            )
+            _limiters[deployment] = limiter
+        return limiter
+
+
+_DEPLOYMENT_RE = re.compile(r"/deployments/([^/]+)/")
+DEFAULT_COMPLETION_TOKENS = 500
+
+
+def _deployment_of(request: httpx.Request) -> Optional[str]:
+    m = _DEPLOYMENT_RE.search(request.url.path)
+    return m.group(1) if m else None
+
+
+def estimate_request_cost(request: httpx.Request) -> int:
+    # Azureは「プロンプト + max_tokens」でTPMを見積もるので同じ計算で予約する
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return DEFAULT_COMPLETION_TOKENS
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS
+    return estimate_message_tokens(body.get("messages", [])) + max_tokens
+
+
+# ========== ターンの期限 ==========
+_TIMEOUT_KEYS = ("connect", "read", "write", "pool")
+
+
+def apply_deadline(request: httpx.Request):
+    # ターンの残り時間を、このリクエストの各タイムアウトの上限にする（期限切れなら送らない）
+    deadline = current_deadline()
+    if deadline is None:
+        return
+    deadline.check(request.url.path)
+    remaining = deadline.remaining()
+    timeout = request.extensions.get("timeout") or {}
+    request.extensions["timeout"] = {
+        key: remaining if timeout.get(key) is None else min(timeout[key], remaining) for key in _TIMEOUT_KEYS
+    }
+
+
+def retry_fits_deadline(delay: float) -> bool:
+    # 待ってから再送しても期限内に終わらないなら、リトライせずに諦める
+    deadline = current_deadline()
+    return deadline is None or delay < deadline.remaining()
+
+
+# ========== httpxトランスポートとして差し込むラッパー ==========
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, inner: httpx.BaseTransport, policy: Optional[RetryPolicy] = None):
+        self.inner = inner
+        self.policy = policy or RetryPolicy.from_env()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        deployment = _deployment_of(request)
+        if deployment is None:
+            # LLM以外（検索APIなど）もターンの期限だけは守る
+            apply_deadline(request)
+            return self.inner.handle_request(request)
+        limiter = get_rate_limiter(deployment)
+        cost = estimate_request_cost(request)
+        attempt = 0
+        while True:
+            apply_deadline(request)
+            limiter.acquire(cost)
+            try:
+                response = self.inner.handle_request(request)
+            except (httpx.ConnectError, httpx.ReadTimeout, httpx.RemoteProtocolError) as e:
+                delay = self.policy.delay(attempt)
+                if attempt >= self.policy.max_retries or not retry_fits_deadline(delay):
+                    raise
+                logger.warning(f"{deployment}: {e!r}, retrying in {delay:.1f}s")
+            else:
+                limiter.observe_headers(response.headers)
+                if response.status_code not in RETRY_STATUS or attempt >= self.policy.max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers)
+                if response.status_code == 429:
+                    limiter.throttle(retry_after)
+                delay = self.policy.delay(attempt, retry_after)
+                if not retry_fits_deadline(delay):
+                    return response
+                logger.warning(f"{deployment}: HTTP {response.status_code}, retrying in {delay:.1f}s")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.inner.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, policy: Optional[RetryPolicy] = None):
+        self.inner = inner
+        self.policy = policy or RetryPolicy.from_env()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        deployment = _deployment_of(request)
+        if deployment is None:
+            # LLM以外（検索APIなど）もターンの期限だけは守る
+            apply_deadline(request)
+            return await self.inner.handle_async_request(request)
+        limiter = get_rate_limiter(deployment)
+        cost = estimate_request_cost(request)
+        attempt = 0
+        while True:
+            apply_deadline(request)
+            await limiter.aacquire(cost)
+            try:
+                response = await self.inner.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ReadTimeout, httpx.RemoteProtocolError) as e:
+                delay = self.policy.delay(attempt)
+                if attempt >= self.policy.max_retries or not retry_fits_deadline(delay):
+                    raise
+                logger.warning(f"{deployment}: {e!r}, retrying in {delay:.1f}s")
+            else:
+                limiter.observe_headers(response.headers)
+                if response.status_code not in RETRY_STATUS or attempt >= self.policy.max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers)
+                if response.status_code == 429:
+                    limiter.throttle(retry_after)
+                delay = self.policy.delay(attempt, retry_after)
+                if not retry_fits_deadline(delay):
+                    return response
+                logger.warning(f"{deployment}: HTTP {response.status_code}, retrying in {delay:.1f}s")
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+# ========== AzureChatOpenAI用のHTTPクライアント ==========
+class PerLoopAsyncTransport(httpx.AsyncBaseTransport):
+    """接続プールはイベントループに紐づくため、ループごとに別のトランスポートを作って使い分ける。
+
+    AzureChatOpenAIには構築時に1つのAsyncClientしか渡せないので、クライアントは共有し、
+    その下のトランスポートをループ単位にする（常駐ループとエンジンのループが同じモデルを使う）。
+    """
+
+    def __init__(self, factory: Callable[[], httpx.AsyncBaseTransport]):
+        self.factory = factory
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncBaseTransport]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _current(self) -> httpx.AsyncBaseTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = self._transports[loop] = self.factory()
+            return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._current().handle_async_request(request)
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.pop(loop, None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_clients: Optional[dict] = None
+_clients_lock = threading.Lock()
+
+
+def rate_limited_client_kwargs() -> dict:
+    """AzureChatOpenAI(**rate_limited_client_kwargs()) で全エージェントが同じリミッタを通る。
+
+    リトライはトランスポート側で行うので、SDK側のリトライは無効にする。
+    """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            _clients = {
+                # CASSETTE_MODE が設定されていれば、最下層で応答を記録・再生する
+                "http_client": httpx.Client(transport=RateLimitedTransport(wrap_transport(httpx.HTTPTransport()))),
+                "http_async_client": httpx.AsyncClient(transport=AsyncRateLimitedTransport(
+                    PerLoopAsyncTransport(lambda: wrap_async_transport(httpx.AsyncHTTPTransport()))
+                )),
+                "max_retries": 0,
+            }
+        return dict(_clients)
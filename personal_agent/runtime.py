@@ -0,0 +1,98 @@
+import time
+from collections import deque
+from typing import Any, Callable, TypeVar
+
+import streamlit as st
+
+from turn_worker import TurnWorker, TurnEvent
+
+T = TypeVar("T")
+
+
+# ========== プロセス共有リソース ==========
+def cache_resource(builder: Callable[[], T]) -> Callable[[], T]:
+    """Streamlitの再実行やセッションをまたいで、1プロセスにつき1度だけ構築する。
+
+    LLMクライアント・ツールレジストリ・エージェントのように、状態を持たず
+    全セッションで共有できるものに使う（会話履歴などはsession_stateに置く）。
+    """
+    return st.cache_resource(show_spinner=False)(builder)
+
+
+# ========== 再実行オーバーヘッドの計測 ==========
+class RerunTimer:
+    def __init__(self, keep: int = 20):
+        self.start = time.perf_counter()
+        self.marks: list[tuple[str, float]] = []
+        self.keep = keep
+
+    def mark(self, label: str):
+        self.marks.append((label, time.perf_counter() - self.start))
+
+    def render(self):
+        # スクリプト全体の所要時間をセッションごとに記録し、サイドバーに表示する
+        total = time.perf_counter() - self.start
+        timings = st.session_state.setdefault("rerun_timings", deque(maxlen=self.keep))
+        timings.append(total)
+        with st.sidebar.expander("⏱️ 再実行の所要時間"):
+            for label, elapsed in self.marks:
+                st.caption(f"{label}: {elapsed * 1000:.1f} ms")
+            st.caption(f"合計: {total * 1000:.1f} ms（直近{len(timings)}回の平均 {sum(timings) / len(timings) * 1000:.1f} ms）")
+
+
+# ========== バックグラウンドで実行中のターンの逐次表示 ==========
+def start_turn(worker: TurnWorker, fn: Callable[..., None], *args: Any):
+    # ここまでの表示履歴は確定分、以降はワーカーから届いた分として描画する
+    st.session_state.turn_state = {"start": len(st.session_state.display_chat_history), "current": None, "notices": []}
+    worker.start(fn, *args)
+
+
+def _apply_events(events: list[TurnEvent]) -> bool:
+    state = st.session_state.turn_state
+    done = False
+    for event in events:
+        if event.kind == "speaker":
+            state["current"] = {"role": "assistant", "name": event.name, "content": "", **event.data}
+        elif event.kind == "token" and state["current"] is not None:
+            state["current"]["content"] += event.content
+        elif event.kind == "message":
+            state["current"] = None
+            st.session_state.display_chat_history.append({"role": "assistant", "name": event.name, "content": event.content, **event.data})
+        elif event.kind in ("warning", "error"):
+            state["notices"].append(event.content)
+        elif event.kind == "cancelled":
+            state["notices"].append("⏹️ ターンを停止しました")
+        elif event.kind == "done":
+            done = True
+    return done
+
+
+@st.fragment(run_every=0.3)
+def _live_turn(worker: TurnWorker, render_message: Callable[[dict], None]):
+    # この部分だけを定期的に再実行し、ワーカーから届いた発言を描画する
+    state = st.session_state.turn_state
+    if _apply_events(worker.drain()) or not worker.running:
+        st.rerun()
+    for msg in st.session_state.display_chat_history[state["start"]:]:
+        render_message(msg)
+    if state["current"] is not None:
+        render_message({**state["current"], "content": state["current"]["content"] + "▌"})
+    for notice in state["notices"]:
+        st.warning(notice)
+    st.button("⏹️ 停止", on_click=worker.stop)
+
+
+def render_chat(worker: TurnWorker, render_message: Callable[[dict], None]):
+    """確定した会話を描画し、ターン実行中なら逐次表示と停止ボタンを出す。"""
+    state = st.session_state.setdefault("turn_state", {"start": 0, "current": None, "notices": []})
+    _apply_events(worker.drain())
+    history = st.session_state.display_chat_history
+    if not worker.running:
+        for msg in history:
+            render_message(msg)
+        for notice in state["notices"]:
+            st.warning(notice)
+        return
+    for msg in history[:state["start"]]:
+        render_message(msg)
+    _live_turn(worker, render_message)
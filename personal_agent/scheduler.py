@@ -0,0 +1,214 @@
+import re
+import random
+import difflib
+import logging
+import unicodedata
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ========== 発言者スケジューラ ==========
+class SpeakerScheduler:
+    """次に発言するエージェントを決める。LLMファシリテータもこの戦略の一つとして扱う。"""
+
+    def __init__(self, agent_names: list[str]):
+        self.agent_names = list(agent_names)
+        self.spoken_this_turn: list[str] = []
+        self.last_spoken: dict[str, int] = {}
+        self.spoken_count: dict[str, int] = {}
+        self._clock = 0
+        # 直近の判断内容（LLM戦略では生の出力が入る）
+        self.last_decision: Optional[str] = None
+
+    def start_turn(self, user_input: str):
+        # ユーザー発言ごとに呼ぶ
+        self.spoken_this_turn = []
+
+    def observe(self, name: str):
+        # 実際に発言したエージェントを記録する
+        self._clock += 1
+        self.last_spoken[name] = self._clock
+        self.spoken_count[name] = self.spoken_count.get(name, 0) + 1
+        self.spoken_this_turn.append(name)
+
+    def candidates(self) -> list[str]:
+        # このユーザーターンでまだ発言していないエージェント（全員発言済みなら全員）
+        remaining = [n for n in self.agent_names if n not in self.spoken_this_turn]
+        return remaining or list(self.agent_names)
+
+    def choose(self, user_input: str, chat_history: list) -> Optional[str]:
+        raise NotImplementedError
+
+    def next_speaker(self, user_input: str, chat_history: list) -> Optional[str]:
+        self.last_decision = self.choose(user_input, chat_history)
+        return self.last_decision
+
+    def ranked_candidates(self, user_input: str) -> list[str]:
+        # 投機実行などで「次に選ばれそうな順」が欲しい場合に使う
+        return sorted(self.candidates(), key=lambda n: self.last_spoken.get(n, 0))
+
+
+class RoundRobinScheduler(SpeakerScheduler):
+    def __init__(self, agent_names: list[str]):
+        super().__init__(agent_names)
+        self._index = 0
+
+    def choose(self, user_input, chat_history):
+        name = self.agent_names[self._index % len(self.agent_names)]
+        self._index += 1
+        return name
+
+    def ranked_candidates(self, user_input):
+        n = len(self.agent_names)
+        return [self.agent_names[(self._index + i) % n] for i in range(n)]
+
+
+class LeastRecentlySpokenScheduler(SpeakerScheduler):
+    def choose(self, user_input, chat_history):
+        return self.ranked_candidates(user_input)[0]
+
+
+class WeightedRandomScheduler(SpeakerScheduler):
+    def __init__(self, agent_names: list[str], weights: Optional[dict[str, float]] = None, seed: Optional[int] = None):
+        super().__init__(agent_names)
+        self.weights = {n: (weights or {}).get(n, 1.0) for n in self.agent_names}
+        self._random = random.Random(seed)
+
+    def choose(self, user_input, chat_history):
+        candidates = self.candidates()
+        return self._random.choices(candidates, weights=[self.weights[n] for n in candidates], k=1)[0]
+
+    def ranked_candidates(self, user_input):
+        return sorted(self.candidates(), key=lambda n: -self.weights[n])
+
+
+class KeywordAffinityScheduler(SpeakerScheduler):
+    def __init__(self, agent_names: list[str], affinities: Optional[dict[str, list[str]]] = None):
+        super().__init__(agent_names)
+        self.affinities = affinities or {}
+
+    def score(self, name: str, user_input: str) -> int:
+        return sum(user_input.count(keyword) for keyword in self.affinities.get(name, []))
+
+    def ranked_candidates(self, user_input):
+        # キーワード一致数が多い順、同点なら発言が古い順
+        return sorted(
+            self.candidates(),
+            key=lambda n: (-self.score(n, user_input), self.last_spoken.get(n, 0)),
+        )
+
+    def choose(self, user_input, chat_history):
+        return self.ranked_candidates(user_input)[0]
+
+
+class LLMFacilitatorScheduler(SpeakerScheduler):
+    def __init__(self, agent_names: list[str], decide: Callable[[str, list], str]):
+        super().__init__(agent_names)
+        self.decide = decide
+
+    def choose(self, user_input, chat_history):
+        return self.decide(user_input, chat_history).strip()
+
+
+# ========== 名前の補正（LLMの出力を手元でエージェント名に合わせる） ==========
+_NAME_NOISE_RE = re.compile(r"[\s　\"'`「」『』（）()\[\]【】:：、。,.!?！？*]+")
+
+
+def _normalize_name(text: str) -> str:
+    return _NAME_NOISE_RE.sub("", unicodedata.normalize("NFKC", text)).lower()
+
+
+def repair_agent_name(raw: Optional[str], agent_names: list[str]) -> Optional[str]:
+    """「エージェントA: ...」「A」「エージェントＡです」のような出力をエージェント名に直す。直せなければNone。"""
+    if not raw:
+        return None
+    if raw in agent_names:
+        return raw
+    normalized = {_normalize_name(n): n for n in agent_names}
+    key = _normalize_name(raw)
+    if not key:
+        return None
+    if key in normalized:
+        return normalized[key]
+    # 出力の中に名前が含まれていれば、最初に出てきたものを使う
+    found = sorted((key.find(k), -len(k), n) for k, n in normalized.items() if k in key)
+    if found:
+        return found[0][2]
+    # 名前の一部だけ（「A」「法律」など）で、1人に絞れる場合
+    partial = [n for k, n in normalized.items() if key in k]
+    if len(partial) == 1:
+        return partial[0]
+    # 表記ゆれは類似度で拾う（同点で絞れない場合は補正しない）
+    scored = sorted(((difflib.SequenceMatcher(None, key, k).ratio(), n) for k, n in normalized.items()), reverse=True)
+    if scored[0][0] >= 0.6 and (len(scored) == 1 or scored[0][0] > scored[1][0]):
+        return scored[0][1]
+    return None
+
+
+class ConstrainedFacilitatorScheduler(SpeakerScheduler):
+    """LLMには会話履歴の代わりに発言状況の要約だけを渡し、エージェント名の列挙型から1つ選ばせる。
+
+    decide(user_input, summary) の出力は手元で補正し、それでも決まらない場合や応答を読み取れなかった場合は
+    しばらく発言していないエージェントを選ぶ。予算超過・期限切れはそのまま伝えてターンを終わらせる。
+    """
+
+    def __init__(self, agent_names: list[str], decide: Callable[[str, str], str], max_question_chars: int = 200):
+        super().__init__(agent_names)
+        self.decide = decide
+        self.max_question_chars = max_question_chars
+        self.stats = {"exact": 0, "repaired": 0, "fallback": 0}
+
+    def summary(self, user_input: str) -> str:
+        lines = [f"# ユーザーの質問\n{user_input[:self.max_question_chars]}", "# 発言状況"]
+        for name in self.agent_names:
+            this_turn = self.spoken_this_turn.count(name)
+            lines.append(f"- {name}: 今回{this_turn}回 / 累計{self.spoken_count.get(name, 0)}回")
+        if self.spoken_this_turn:
+            lines.append(f"直前の発言者: {self.spoken_this_turn[-1]}")
+        return "\n".join(lines)
+
+    def choose(self, user_input, chat_history):
+        try:
+            raw = self.decide(user_input, self.summary(user_input))
+        except (ValueError, KeyError, TypeError) as e:
+            # 関数呼び出しの引数が壊れているなど、指名を読み取れなかった場合だけ補正に回す
+            # （BudgetExceeded / DeadlineExceeded や通信エラーは呼び出し元でターンを終わらせる）
+            logger.warning(f"facilitator reply could not be parsed, falling back: {e}")
+            raw = None
+        name = repair_agent_name(raw, self.agent_names)
+        if name is not None:
+            self.stats["exact" if name == raw else "repaired"] += 1
+            return name
+        self.stats["fallback"] += 1
+        return self.ranked_candidates(user_input)[0]
+
+
+SCHEDULER_STRATEGIES = ["llm", "constrained", "round_robin", "least_recent", "weighted_random", "keyword"]
+
+
+def create_scheduler(
+    strategy: str,
+    agent_names: list[str],
+    decide: Optional[Callable[[str, list], str]] = None,
+    constrained_decide: Optional[Callable[[str, str], str]] = None,
+    weights: Optional[dict[str, float]] = None,
+    affinities: Optional[dict[str, list[str]]] = None,
+) -> SpeakerScheduler:
+    if strategy == "llm":
+        if decide is None:
+            raise ValueError("llm strategy requires a decide function")
+        return LLMFacilitatorScheduler(agent_names, decide)
+    if strategy == "constrained":
+        if constrained_decide is None:
+            raise ValueError("constrained strategy requires a constrained_decide function")
+        return ConstrainedFacilitatorScheduler(agent_names, constrained_decide)
+    if strategy == "round_robin":
+        return RoundRobinScheduler(agent_names)
+    if strategy == "least_recent":
+        return LeastRecentlySpokenScheduler(agent_names)
+    if strategy == "weighted_random":
+        return WeightedRandomScheduler(agent_names, weights)
+    if strategy == "keyword":
+        return KeywordAffinityScheduler(agent_names, affinities)
+    raise ValueError(f"unknown scheduler strategy: {strategy}")
@@ -0,0 +1,160 @@
+import os
+import re
+import time
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import httpx
+
+from transport import HTTPTransport, TransportConfig
+from rate_limiter import RETRY_STATUS, RetryPolicy, parse_retry_after, retry_fits_deadline
+from async_runtime import run_coroutine
+
+
+class SearchError(Exception):
+    pass
+
+
+# ========== TTL付きの検索結果キャッシュ ==========
+class TTLCache:
+    def __init__(self, ttl: float = 300.0, max_entries: int = 512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[tuple, tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, value: dict):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip()
+
+
+# ========== FAISS検索APIクライアント ==========
+class SearchClient:
+    """接続プール・タイムアウト・TTLキャッシュ付きの検索APIクライアント。"""
+
+    def __init__(self, url: Optional[str] = None, transport: Optional[HTTPTransport] = None,
+                 timeout: Optional[float] = None, cache: Optional[TTLCache] = None,
+                 retry: Optional[RetryPolicy] = None):
+        self.url = url or os.getenv("SEARCH_API_URL", "http://localhost:8000/faiss/deep_test/search")
+        # 検索APIはLLMより速く返る想定なので、専用のプールと短めのタイムアウトを使う
+        self.timeout = timeout if timeout is not None else float(os.getenv("SEARCH_TIMEOUT", "10"))
+        self.transport = transport or HTTPTransport(TransportConfig(
+            pool_size=int(os.getenv("SEARCH_POOL_SIZE", "10")),
+            connect_timeout=float(os.getenv("SEARCH_CONNECT_TIMEOUT", "3")),
+            read_timeout=self.timeout,
+        ))
+        self.cache = cache or TTLCache(
+            ttl=float(os.getenv("SEARCH_CACHE_TTL", "300")),
+            max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512")),
+        )
+        # 接続エラー・タイムアウト・一時的なHTTPエラーは短い間隔で数回だけ再送する
+        self.retry = retry or RetryPolicy(
+            max_retries=int(os.getenv("SEARCH_MAX_RETRIES", "2")),
+            base_delay=float(os.getenv("SEARCH_RETRY_BASE_DELAY", "0.2")),
+            max_delay=float(os.getenv("SEARCH_RETRY_MAX_DELAY", "2")),
+        )
+
+    def _key(self, query: str, top_k: int) -> tuple:
+        return (self.url, _normalize_query(query), top_k)
+
+    def _retry_delay(self, attempt: int, error: httpx.HTTPError) -> float:
+        # 再送する場合は待ち秒数を返し、諦める場合はSearchErrorにする
+        status_error = isinstance(error, httpx.HTTPStatusError)
+        retryable = isinstance(error, httpx.TransportError) or (status_error and error.response.status_code in RETRY_STATUS)
+        delay = self.retry.delay(attempt, parse_retry_after(error.response.headers) if status_error else None)
+        if not retryable or attempt >= self.retry.max_retries or not retry_fits_deadline(delay):
+            raise SearchError(f"検索APIの呼び出しに失敗しました: {error}") from error
+        return delay
+
+    @staticmethod
+    def _parse(response: httpx.Response) -> dict:
+        try:
+            return response.json()
+        except ValueError as e:
+            raise SearchError(f"検索APIの応答を解釈できませんでした: {e}") from e
+
+    def search(self, query: str, top_k: int = 5) -> dict:
+        key = self._key(query, top_k)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        attempt = 0
+        while True:
+            try:
+                response = self.transport.post_json(self.url, {}, {"query": query, "top_k": top_k}, timeout=self.timeout)
+                break
+            except httpx.HTTPError as e:
+                time.sleep(self._retry_delay(attempt, e))
+            attempt += 1
+        data = self._parse(response)
+        self.cache.put(key, data)
+        return data
+
+    async def asearch(self, query: str, top_k: int = 5) -> dict:
+        key = self._key(query, top_k)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        attempt = 0
+        while True:
+            try:
+                response = await self.transport.apost_json(self.url, {}, {"query": query, "top_k": top_k}, timeout=self.timeout)
+                break
+            except httpx.HTTPError as e:
+                await asyncio.sleep(self._retry_delay(attempt, e))
+            attempt += 1
+        data = self._parse(response)
+        self.cache.put(key, data)
+        return data
+
+    async def asearch_many(self, queries: list[str], top_k: int = 5) -> list:
+        # 複数の問いを同時に検索する（失敗した問いはSearchErrorを結果として返す）
+        return await asyncio.gather(*[self.asearch(q, top_k) for q in queries], return_exceptions=True)
+
+    def search_many(self, queries: list[str], top_k: int = 5) -> list:
+        return run_coroutine(self.asearch_many(queries, top_k))
+
+    def close(self):
+        self.transport.close()
+
+
+_default_client: Optional[SearchClient] = None
+_default_lock = threading.Lock()
+
+
+def get_search_client() -> SearchClient:
+    global _default_client
+    if _default_client is None:
+        with _default_lock:
+            if _default_client is None:
+                _default_client = SearchClient()
+    return _default_client
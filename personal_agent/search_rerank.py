@@ -0,0 +1,192 @@
+import re
+import math
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from token_utils import estimate_tokens
+
+
+@dataclass
+class Passage:
+    text: str
+    source: Optional[str] = None
+    api_score: Optional[float] = None
+    score: float = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+    def format(self) -> str:
+        return f"[{self.source}] {self.text}" if self.source else self.text
+
+
+# ========== 検索結果のパース ==========
+_TEXT_KEYS = ("text", "content", "page_content", "document", "passage", "snippet")
+_LIST_KEYS = ("results", "hits", "documents", "matches", "data")
+
+
+def _hit_to_passage(hit: Any) -> Optional[Passage]:
+    if isinstance(hit, str):
+        return Passage(hit) if hit.strip() else None
+    if not isinstance(hit, dict):
+        return None
+    text = next((hit[k] for k in _TEXT_KEYS if isinstance(hit.get(k), str)), None)
+    if not text:
+        return None
+    metadata = hit.get("metadata") or {}
+    source = hit.get("source") or (metadata.get("source") if isinstance(metadata, dict) else None) or hit.get("id")
+    score = hit.get("score", hit.get("distance"))
+    return Passage(text.strip(), str(source) if source is not None else None,
+                   float(score) if isinstance(score, (int, float)) else None)
+
+
+def parse_hits(data: Any) -> list[Passage]:
+    # APIのレスポンス形式（results/hits/documentsなど）や、複数クエリ分のリストを平らにする
+    if isinstance(data, list):
+        passages = []
+        for item in data:
+            if isinstance(item, dict) and any(k in item for k in _LIST_KEYS):
+                passages.extend(parse_hits(item))
+            else:
+                p = _hit_to_passage(item)
+                if p is not None:
+                    passages.append(p)
+        return passages
+    if isinstance(data, dict):
+        for key in _LIST_KEYS:
+            if isinstance(data.get(key), list):
+                return parse_hits(data[key])
+        p = _hit_to_passage(data)
+        return [p] if p is not None else []
+    return []
+
+
+# ========== 文字n-gram BM25 ==========
+# 日本語は単語区切りがないため、形態素解析の代わりに文字2-gramで照合する
+_SKIP_RE = re.compile(r"[\s　、。，．,.!?！？「」『』（）()\[\]【】・:：;；\"'\-]+")
+
+
+def char_ngrams(text: str, n: int = 2) -> list[str]:
+    text = _SKIP_RE.sub(" ", unicodedata.normalize("NFKC", text).lower())
+    grams = []
+    for chunk in text.split():
+        if len(chunk) < n:
+            grams.append(chunk)
+            continue
+        grams.extend(chunk[i:i + n] for i in range(len(chunk) - n + 1))
+    return grams
+
+
+class BM25:
+    def __init__(self, documents: list[str], k1: float = 1.2, b: float = 0.75, n: int = 2):
+        self.k1 = k1
+        self.b = b
+        self.n = n
+        self.docs = [Counter(char_ngrams(d, n)) for d in documents]
+        self.lengths = [sum(c.values()) for c in self.docs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        df = Counter(g for c in self.docs for g in c)
+        total = len(self.docs)
+        self.idf = {g: math.log(1 + (total - f + 0.5) / (f + 0.5)) for g, f in df.items()}
+
+    def score(self, query: str, index: int) -> float:
+        doc = self.docs[index]
+        length = self.lengths[index]
+        score = 0.0
+        for g in set(char_ngrams(query, self.n)):
+            tf = doc.get(g)
+            if not tf:
+                continue
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+            score += self.idf.get(g, 0.0) * tf * (self.k1 + 1) / (tf + norm)
+        return score
+
+    def scores(self, query: str) -> list[float]:
+        return [self.score(query, i) for i in range(len(self.docs))]
+
+
+# ========== 並べ替え・切り詰め・トークン予算への詰め込み ==========
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+
+
+def trim_passage(query: str, passage: Passage, max_tokens: int) -> Passage:
+    # 長い文書は、クエリに近い文だけを元の順序のまま残す
+    if passage.tokens <= max_tokens:
+        return passage
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(passage.text) if s.strip()]
+    if len(sentences) <= 1:
+        text = passage.text
+        while estimate_tokens(text) > max_tokens and len(text) > 1:
+            text = text[:int(len(text) * 0.8)]
+        return Passage(text, passage.source, passage.api_score, passage.score)
+    bm25 = BM25(sentences)
+    ranked = sorted(range(len(sentences)), key=lambda i: -bm25.score(query, i))
+    keep, used = set(), 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i])
+        if keep and used + cost > max_tokens:
+            continue
+        keep.add(i)
+        used += cost
+    return Passage("".join(sentences[i] for i in sorted(keep)), passage.source, passage.api_score, passage.score)
+
+
+def rerank(query: str, passages: list[Passage]) -> list[Passage]:
+    if not passages:
+        return []
+    # 同じ文書が複数のクエリでヒットした場合は1つにまとめる
+    unique = list({p.text: p for p in passages}.values())
+    bm25 = BM25([p.text for p in unique])
+    for p, s in zip(unique, bm25.scores(query)):
+        p.score = s
+    return sorted(unique, key=lambda p: -p.score)
+
+
+def pack(passages: list[Passage], budget: int) -> list[Passage]:
+    packed, used = [], 0
+    for p in passages:
+        cost = p.tokens
+        if used + cost > budget:
+            continue
+        packed.append(p)
+        used += cost
+    return packed
+
+
+@dataclass
+class SearchContext:
+    passages: list[Passage]
+    direct: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return "\n\n".join(p.format() for p in self.passages)
+
+
+def select_context(
+    query: str,
+    data: Any,
+    budget: int = 800,
+    max_passage_tokens: int = 300,
+    direct_max_tokens: int = 150,
+    min_score: float = 0.0,
+) -> SearchContext:
+    """検索結果をクエリとの関連度で並べ替え、トークン予算内に収まる分だけ返す。
+
+    クエリと文字2-gramを共有しない文書（言い換えや英語の文書など、ベクトル検索ならではのヒット）も捨てず、
+    スコアが min_score 以下のものはAPIが返した順で後ろに回す。
+    最上位の文書が十分短ければ direct に入れ、LLMによる要約を省略できるようにする。
+    """
+    reranked = rerank(query, parse_hits(data))
+    # rerankは安定ソートなので、照合しなかった文書はAPIの順のまま並んでいる
+    ranked = [p for p in reranked if p.score > min_score] + [p for p in reranked if p.score <= min_score]
+    if not ranked:
+        return SearchContext([])
+    top = ranked[0]
+    if top.tokens <= direct_max_tokens:
+        return SearchContext([top], direct=top.format())
+    trimmed = [trim_passage(query, p, max_passage_tokens) for p in ranked]
+    return SearchContext(pack(trimmed, budget))
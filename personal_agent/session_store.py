@@ -0,0 +1,208 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Callable, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    app TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    summary TEXT NOT NULL DEFAULT '',
+    summary_seq INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated_at DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts TEXT NOT NULL,
+    role TEXT NOT NULL,
+    name TEXT,
+    content TEXT NOT NULL,
+    meta TEXT,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+_FIELDS = ("role", "name", "content")
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _row_to_message(row) -> dict:
+    seq, role, name, content, meta = row
+    message = {"seq": seq, "role": role, "content": content}
+    if name is not None:
+        message["name"] = name
+    if meta:
+        message.update(json.loads(meta))
+    return message
+
+
+# ========== 会話セッションの永続化 ==========
+class SessionStore:
+    """1発言1行の追記専用ストア。(session_id, seq) の主キーで直近N件を索引から読む。
+
+    保存するのは発言そのもの（role/name/content と表示用の付帯情報）だけで、
+    プロンプト用・表示用の形はそれぞれのビュー関数で組み立てる。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("SESSION_STORE_PATH", "chat_logs/sessions.sqlite3")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+
+    # ---------- セッション ----------
+    def create_session(self, session_id: str, app: Optional[str] = None) -> bool:
+        # 既にあれば何もしない（再開）。新規作成したらTrue
+        now = _now()
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO sessions (id, app, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, app, now, now),
+            )
+            return cur.rowcount > 0
+
+    def exists(self, session_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+    def list_sessions(self, limit: int = 20, app: Optional[str] = None) -> list[dict]:
+        query = "SELECT id, app, created_at, updated_at, message_count FROM sessions"
+        params: tuple = ()
+        if app is not None:
+            query += " WHERE app = ?"
+            params = (app,)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY updated_at DESC LIMIT ?", params + (limit,)).fetchall()
+        return [dict(zip(("id", "app", "created_at", "updated_at", "message_count"), r)) for r in rows]
+
+    def delete_session(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    # ---------- 発言の追記 ----------
+    def append(self, session_id: str, message: dict) -> int:
+        return self.append_many(session_id, [message])[-1]
+
+    def append_many(self, session_id: str, messages: list[dict]) -> list[int]:
+        # role/name/content 以外のキー（avatarなど）はmetaにJSONで入れる
+        now = _now()
+        seqs = []
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                self._conn.execute("INSERT INTO sessions (id, created_at, updated_at) VALUES (?, ?, ?)", (session_id, now, now))
+                count = 0
+            else:
+                count = row[0]
+            for message in messages:
+                count += 1
+                meta = {k: v for k, v in message.items() if k not in _FIELDS and k != "seq"}
+                self._conn.execute(
+                    "INSERT INTO messages (session_id, seq, ts, role, name, content, meta) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, count, now, message["role"], message.get("name"), message["content"],
+                     json.dumps(meta, ensure_ascii=False) if meta else None),
+                )
+                seqs.append(count)
+            self._conn.execute("UPDATE sessions SET message_count = ?, updated_at = ? WHERE id = ?", (count, now, session_id))
+        return seqs
+
+    # ---------- 読み出し ----------
+    def recent(self, session_id: str, n: int, after_seq: int = 0) -> list[dict]:
+        # 主キーを逆順にたどるので、履歴が長くても直近N件だけを読む
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, role, name, content, meta FROM messages WHERE session_id = ? AND seq > ? ORDER BY seq DESC LIMIT ?",
+                (session_id, after_seq, n),
+            ).fetchall()
+        return [_row_to_message(r) for r in reversed(rows)]
+
+    def count(self, session_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    # ---------- 要約 ----------
+    def get_summary(self, session_id: str) -> tuple[str, int]:
+        # (要約, 要約に畳み込み済みの最後のseq)
+        with self._lock:
+            row = self._conn.execute("SELECT summary, summary_seq FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def set_summary(self, session_id: str, summary: str, summary_seq: int):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE sessions SET summary = ?, summary_seq = ? WHERE id = ?", (summary, summary_seq, session_id))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ========== ビュー ==========
+def display_view(messages: list[dict], extra: Optional[Callable[[dict], dict]] = None) -> list[dict]:
+    # 画面表示用（seqを除き、アプリごとの付帯情報を足す）
+    view = []
+    for m in messages:
+        item = {k: v for k, v in m.items() if k != "seq"}
+        if extra is not None:
+            item.update(extra(m))
+        view.append(item)
+    return view
+
+
+def prompt_message(message: dict) -> dict:
+    # プロンプト用（LangChainのメッセージに変換できるキーだけを残す）
+    item = {"role": message["role"], "content": message["content"]}
+    if message.get("name"):
+        item["name"] = message["name"]
+    return item
+
+
+def named_prompt_message(message: dict) -> dict:
+    # CLI版：エージェントの発言は「名前: 本文」の形でプロンプトに入れる
+    item = prompt_message(message)
+    if item["role"] == "assistant" and item.get("name"):
+        item["content"] = f"{item['name']}: {item['content']}"
+    return item
+
+
+def json_prompt_message(message: dict) -> dict:
+    # Streamlit版：エージェントの発言は {'name': ..., 'content': ...} の形でプロンプトに入れる
+    item = prompt_message(message)
+    if item["role"] == "assistant" and item.get("name"):
+        item["content"] = f"{{'name': '{item['name']}', 'content': '{item['content']}'}}"
+    return item
+
+
+def format_resumed(messages: list[dict]) -> str:
+    # 再開時に直近の会話を見せる
+    lines = []
+    for m in messages:
+        speaker = "あなた" if m["role"] == "user" else m.get("name", m["role"])
+        lines.append(f"  {speaker}> {m['content']}")
+    return "\n".join(lines)
+
+
+_default_store: Optional[SessionStore] = None
+_default_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    global _default_store
+    if _default_store is None:
+        with _default_lock:
+            if _default_store is None:
+                _default_store = SessionStore()
+    return _default_store
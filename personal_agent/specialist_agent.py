@@ -0,0 +1,92 @@
+import os
+from typing import Callable, Optional
+
+from langchain.agents import AgentExecutor, AgentType, create_tool_calling_agent, initialize_agent
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import SystemMessage
+
+from streaming import FinalAnswerStreamHandler, TokenStreamHandler
+from brain_pipeline import BrainPipeline, default_brain_stages, FINAL_ANSWER_TAG
+from deadline import executor_limits
+
+# react: Thought/Action/Observation を1ステップずつ回す（1ツール1往復）
+# tool_calling: 関数呼び出しで複数のツールを1回の応答でまとめて要求し、並列に実行する
+# pipeline: 脳ツールを固定のDAGどおりに実行する（計画役のLLMを挟まない）
+SPECIALIST_AGENT_TYPES = ["react", "tool_calling", "pipeline"]
+
+
+def specialist_agent_type(name: str) -> str:
+    # SPECIALIST_AGENT_TYPE で全体の既定を、SPECIALIST_AGENT_TYPES="法律エージェント=tool_calling,..." で個別に切り替える
+    overrides = dict(
+        (k.strip(), v.strip())
+        for k, _, v in (item.partition("=") for item in os.getenv("SPECIALIST_AGENT_TYPES", "").split(","))
+        if v
+    )
+    agent_type = overrides.get(name, os.getenv("SPECIALIST_AGENT_TYPE", "react"))
+    if agent_type not in SPECIALIST_AGENT_TYPES:
+        raise ValueError(f"unknown specialist agent type for {name}: {agent_type}")
+    return agent_type
+
+
+# ========== ReActエージェント ==========
+def create_react_specialist(llm, tools: list, system_msg: str) -> AgentExecutor:
+    return initialize_agent(
+        tools=tools,
+        llm=llm,
+        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=True,
+        system_message=system_msg,
+        metadata={"agent_type": "react"},
+        **executor_limits(),
+    )
+
+
+# ========== 関数呼び出し（並列ツール実行）エージェント ==========
+def create_tool_calling_specialist(llm, tools: list, system_msg: str) -> AgentExecutor:
+    prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content=f"{system_msg}\n必要なツールは1回の応答でまとめて呼び出してください（互いに依存しないツールは同時に実行されます）。ツールの結果がそろったら、回答の本文だけを書いてください。"),
+        HumanMessagePromptTemplate.from_template("{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ])
+    agent = create_tool_calling_agent(llm, tools, prompt)
+    # 非同期実行（ainvoke）では、1ステップで要求されたツールをasyncio.gatherで同時に実行する
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=True,
+        metadata={"agent_type": "tool_calling"},
+        **executor_limits(),
+    )
+
+
+# ========== 固定パイプライン ==========
+def create_pipeline_specialist(tools: list, system_msg: str) -> BrainPipeline:
+    # 脳ツール以外（法律DB検索など専門固有のツール）は意図推論の後に並列で走らせ、ステップ計画へ渡す
+    brain_names = {stage.name for stage in default_brain_stages([])}
+    domain_tools = [tool.name for tool in tools if tool.name not in brain_names]
+    return BrainPipeline(tools, default_brain_stages(domain_tools), system_msg)
+
+
+def create_specialist_executor(name: str, system_msg: str, tools: list, llm, agent_type: Optional[str] = None):
+    agent_type = agent_type or specialist_agent_type(name)
+    if agent_type == "pipeline":
+        return create_pipeline_specialist(tools, system_msg)
+    if agent_type == "tool_calling":
+        return create_tool_calling_specialist(llm, tools, system_msg)
+    return create_react_specialist(llm, tools, system_msg)
+
+
+def agent_type_of(agent) -> str:
+    return (getattr(agent, "metadata", None) or {}).get("agent_type", "react")
+
+
+def answer_stream_handler(agent, on_token: Callable[[str], None], on_start: Optional[Callable[[], None]] = None) -> BaseCallbackHandler:
+    # ReActは "Final Answer:" 以降だけを、関数呼び出し型は本文のトークンをそのまま流す（ツール要求の応答は本文が空）
+    # パイプラインは最終段（最終出力整形）のトークンだけを流す
+    agent_type = agent_type_of(agent)
+    if agent_type == "pipeline":
+        return TokenStreamHandler(on_token=on_token, on_start=on_start, tag=FINAL_ANSWER_TAG)
+    if agent_type == "tool_calling":
+        return TokenStreamHandler(on_token=on_token, on_start=on_start)
+    return FinalAnswerStreamHandler(on_token=on_token, on_start=on_start)
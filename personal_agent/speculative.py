@@ -0,0 +1,130 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from accounting import BranchCharge, BudgetExceeded, set_branch_charge
+
+
+# ========== 投機実行の出力バッファ ==========
+class BranchOutput:
+    """投機ブランチのトークンを溜めておき、勝者に決まった時点で表示先へ流し直す。"""
+
+    def __init__(self):
+        self._chunks: list[str] = []
+        self._sink: Optional[Callable[[str], None]] = None
+        self._lock = threading.Lock()
+
+    def write(self, token: str):
+        with self._lock:
+            self._chunks.append(token)
+            if self._sink is not None:
+                self._sink(token)
+
+    def attach(self, sink: Callable[[str], None]):
+        with self._lock:
+            for chunk in self._chunks:
+                sink(chunk)
+            self._sink = sink
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+
+def _over_budget(task: asyncio.Future) -> bool:
+    return task.done() and not task.cancelled() and isinstance(task.exception(), BudgetExceeded)
+
+
+class BranchError(Exception):
+    # 採用されたエージェントの実行が失敗した場合（ファシリテータの失敗と区別する）
+    def __init__(self, name: str, error: BaseException):
+        super().__init__(f"{name}: {error}")
+        self.name = name
+        self.error = error
+
+
+# ========== ファシリテータ判断と次エージェント生成の投機並列実行 ==========
+class SpeculativeTurnRunner:
+    def __init__(self, max_branches: int = 2):
+        # 同時に走らせる投機ブランチ数（0なら投機しない）
+        self.max_branches = max_branches
+        self.stats = {"hits": 0, "misses": 0, "cancelled": 0}
+
+    @staticmethod
+    def _branch(run_agent: Callable[[str, BranchOutput], Awaitable[Any]], name: str, out: BranchOutput, charge: BranchCharge) -> asyncio.Future:
+        async def run():
+            # タスクごとのコンテキストで、このブランチ内のLLM呼び出しを仮計上にする
+            set_branch_charge(charge)
+            return await run_agent(name, out)
+        return asyncio.ensure_future(run())
+
+    async def _cancel(self, tasks: Iterable[asyncio.Future]):
+        tasks = list(tasks)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                self.stats["cancelled"] += 1
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _discard(self, branches: dict[str, tuple[asyncio.Future, BranchOutput, BranchCharge]]):
+        await self._cancel(t for t, _, _ in branches.values())
+        for _, _, charge in branches.values():
+            charge.discard()
+        branches.clear()
+
+    async def arun(
+        self,
+        decide: Callable[[], Awaitable[str]],
+        run_agent: Callable[[str, BranchOutput], Awaitable[Any]],
+        candidates: list[str],
+        is_valid: Callable[[str], bool] = lambda name: True,
+        on_decision: Optional[Callable[[str], None]] = None,
+        sink_for: Optional[Callable[[str], Callable[[str], None]]] = None,
+    ) -> tuple[str, Optional[Any]]:
+        # ファシリテータが考えている間に、候補エージェントの発言生成を先に始めておく
+        decision_task = asyncio.ensure_future(decide())
+        branches: dict[str, tuple[asyncio.Future, BranchOutput, BranchCharge]] = {}
+        task: Optional[asyncio.Future] = None
+        for name in candidates[:self.max_branches]:
+            out, charge = BranchOutput(), BranchCharge()
+            branches[name] = (self._branch(run_agent, name, out, charge), out, charge)
+
+        try:
+            name = await decision_task
+            if on_decision:
+                on_decision(name)
+            if not is_valid(name):
+                return name, None
+
+            chosen = branches.pop(name, None)
+            # 外れたブランチは即座に打ち切り（HTTPリクエストごとキャンセルされる）、その呼び出しをターンの予算から外す
+            await self._discard(branches)
+            if chosen is not None and _over_budget(chosen[0]):
+                # 他のブランチの仮計上分で予算を超えただけなので、外れを取り消した後で改めて実行する
+                chosen[2].discard()
+                chosen = None
+            if chosen is not None:
+                self.stats["hits"] += 1
+                task, out, charge = chosen
+                charge.commit()
+            else:
+                self.stats["misses"] += 1
+                out = BranchOutput()
+                task = asyncio.ensure_future(run_agent(name, out))
+
+            if sink_for:
+                out.attach(sink_for(name))
+            try:
+                result = await task
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                raise BranchError(name, e) from e
+            return name, result
+        finally:
+            if not decision_task.done():
+                decision_task.cancel()
+            await self._discard(branches)
+            if task is not None:
+                await self._cancel([task])
@@ -0,0 +1,196 @@
+import json
+from typing import Callable, Iterable, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# ========== CLI向けストリーミング出力 ==========
+def print_stream(prefix: str, chunks: Iterable[str]) -> str:
+    # トークンを受け取り次第表示し、最後に全文を返す
+    print(prefix, end="", flush=True)
+    text = ""
+    for chunk in chunks:
+        print(chunk, end="", flush=True)
+        text += chunk
+    print()
+    return text
+
+
+class StreamPrinter:
+    """発言者が決まってからプレフィックスを付けて逐次表示する（投機実行時など）。"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.started = False
+
+    def start(self, prefix: str) -> "StreamPrinter":
+        self.prefix = prefix
+        return self
+
+    def __call__(self, token: str):
+        if not self.started:
+            print(self.prefix, end="", flush=True)
+            self.started = True
+        print(token, end="", flush=True)
+
+    def finish(self, text: str):
+        # 1トークンも流れなかった場合は全文をまとめて表示する
+        if self.started:
+            print()
+        else:
+            print(f"{self.prefix}{text}")
+
+
+# ========== JSON出力からのフィールド逐次抽出 ==========
+class JSONFieldStream:
+    """{"name": ..., "content": ...} 形式で生成中のテキストから、指定フィールドの値だけを逐次取り出す。"""
+
+    _ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "/": "/", "\\": "\\", '"': '"', "'": "'"}
+
+    def __init__(self, chunks: Iterable[str], field: str = "content"):
+        self.chunks = chunks
+        self.field = field
+        self.raw = ""
+        self.value = ""
+        self._pos = 0
+        self._quote: Optional[str] = None
+        self._done = False
+
+    def _find_value_start(self) -> bool:
+        # "content": " または 'content': ' の開始位置を探す（シングルクォートの出力にも対応）
+        for key_quote in ('"', "'"):
+            key = f"{key_quote}{self.field}{key_quote}"
+            idx = self.raw.find(key)
+            if idx < 0:
+                continue
+            rest = self.raw[idx + len(key):]
+            stripped = rest.lstrip()
+            if not stripped.startswith(":"):
+                continue
+            after_colon = stripped[1:].lstrip()
+            if not after_colon or after_colon[0] not in ('"', "'"):
+                continue
+            self._quote = after_colon[0]
+            self._pos = len(self.raw) - len(after_colon) + 1
+            return True
+        return False
+
+    def _consume(self) -> str:
+        out = ""
+        while self._pos < len(self.raw):
+            ch = self.raw[self._pos]
+            if ch == "\\":
+                if self._pos + 1 >= len(self.raw):
+                    break
+                nxt = self.raw[self._pos + 1]
+                if nxt == "u":
+                    if self._pos + 6 > len(self.raw):
+                        break
+                    try:
+                        out += chr(int(self.raw[self._pos + 2:self._pos + 6], 16))
+                    except ValueError:
+                        out += self.raw[self._pos:self._pos + 6]
+                    self._pos += 6
+                    continue
+                out += self._ESCAPES.get(nxt, nxt)
+                self._pos += 2
+                continue
+            if ch == self._quote:
+                self._done = True
+                self._pos += 1
+                break
+            out += ch
+            self._pos += 1
+        return out
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self.chunks:
+            self.raw += chunk
+            if self._done:
+                continue
+            if self._quote is None and not self._find_value_start():
+                continue
+            piece = self._consume()
+            if piece:
+                self.value += piece
+                yield piece
+
+
+# ========== ReActエージェントの最終回答ストリーミング ==========
+class FinalAnswerStreamHandler(BaseCallbackHandler):
+    """ReActエージェントの出力のうち "Final Answer:" 以降のトークンだけを転送する。"""
+
+    # 非同期実行時もスレッドを経由せず、トークン順を保ったまま呼び出す
+    run_inline = True
+
+    def __init__(
+        self,
+        on_token: Callable[[str], None],
+        on_start: Optional[Callable[[], None]] = None,
+        answer_prefix: str = "Final Answer:",
+    ):
+        self.on_token = on_token
+        self.on_start = on_start
+        self.answer_prefix = answer_prefix
+        self.streamed = False
+        self.text = ""
+        self._buffer = ""
+        self._in_answer = False
+
+    def _reset(self):
+        self._buffer = ""
+        self._in_answer = False
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._reset()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._reset()
+
+    def _emit(self, token: str):
+        if not self.streamed:
+            token = token.lstrip()
+            if not token:
+                return
+            self.streamed = True
+            if self.on_start:
+                self.on_start()
+        self.text += token
+        self.on_token(token)
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self._in_answer:
+            self._emit(token)
+            return
+        self._buffer += token
+        idx = self._buffer.find(self.answer_prefix)
+        if idx >= 0:
+            self._in_answer = True
+            self._emit(self._buffer[idx + len(self.answer_prefix):])
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """LLMが生成したテキストトークンをそのまま転送する（関数呼び出しのみの応答は空なので流れない）。
+
+    tagを指定すると、そのタグが付いた呼び出しのトークンだけを転送する。
+    """
+
+    run_inline = True
+
+    def __init__(self, on_token: Callable[[str], None], on_start: Optional[Callable[[], None]] = None,
+                 tag: Optional[str] = None):
+        self.on_token = on_token
+        self.on_start = on_start
+        self.tag = tag
+        self.streamed = False
+        self.text = ""
+
+    def on_llm_new_token(self, token: str, *, tags: Optional[list[str]] = None, **kwargs):
+        if not token or (self.tag is not None and self.tag not in (tags or [])):
+            return
+        if not self.streamed:
+            self.streamed = True
+            if self.on_start:
+                self.on_start()
+        self.text += token
+        self.on_token(token)
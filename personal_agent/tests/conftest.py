@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# モジュールはpersonal_agent直下にフラットに置かれている
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# ========== テスト用のローカルHTTPスタブ ==========
+class StubServer:
+    """respond(method, path, body) が返す (status, body, headers) をそのまま返すHTTPサーバー。
+
+    bodyがdictならJSON、listなら要素ごとにflushして送る（ストリーミング応答の代わり）。
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests: list[tuple[str, str, bytes]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with stub._lock:
+                    stub.requests.append((self.command, self.path, body))
+                status, payload, headers = stub.respond(self.command, self.path, body)
+                try:
+                    self.send_response(status)
+                    for k, v in (headers or {}).items():
+                        self.send_header(k, v)
+                    if isinstance(payload, list):
+                        self.send_header("Connection", "close")
+                        self.end_headers()
+                        for chunk in payload:
+                            self.wfile.write(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+                            self.wfile.flush()
+                        self.close_connection = True
+                        return
+                    if isinstance(payload, dict):
+                        payload = json.dumps(payload, ensure_ascii=False)
+                    data = payload if isinstance(payload, bytes) else payload.encode("utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # タイムアウトしたクライアントは先に切断している
+                    pass
+
+            do_GET = do_POST = do_HEAD = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(respond) -> StubServer:
+        server = StubServer(respond)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,146 @@
+import json
+import time
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+from cassette import AsyncCassetteTransport, Cassette, CassetteMiss, CassetteTransport
+
+CHAT_PATH = "/openai/deployments/gpt-4o/chat/completions"
+COMPLETION = {"choices": [{"message": {"role": "assistant", "content": "こんにちは"}}]}
+SSE = ['data: {"choices": [{"delta": {"content": "こん"}}]}\n\n', 'data: {"choices": [{"delta": {"content": "にちは"}}]}\n\n', "data: [DONE]\n\n"]
+
+
+class _Offline(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    # 再生中にネットワークへ出たら失敗させる
+    def handle_request(self, request):
+        raise AssertionError(f"unexpected request to {request.url}")
+
+    async def handle_async_request(self, request):
+        raise AssertionError(f"unexpected request to {request.url}")
+
+
+def _respond(method, path, body):
+    payload = json.loads(body)
+    if payload.get("stream"):
+        return 200, SSE, {"Content-Type": "text/event-stream"}
+    return 200, COMPLETION, {"Content-Type": "application/json", "x-ratelimit-remaining-tokens": "1000"}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _record(path, server):
+    cassette = Cassette(str(path), "record")
+    with httpx.Client(transport=CassetteTransport(httpx.HTTPTransport(), cassette), base_url=server.url) as client:
+        plain = client.post(CHAT_PATH, json={"messages": [{"role": "user", "content": "やあ"}], "temperature": 0})
+        with client.stream("POST", CHAT_PATH, json={"messages": [{"role": "user", "content": "やあ"}], "stream": True}) as r:
+            streamed = [line for line in r.iter_lines() if line]
+    cassette.close()
+    return plain, streamed
+
+
+def test_record_then_replay_round_trip(tmp_path, stub_server):
+    server = stub_server(_respond)
+    path = tmp_path / "cassette.jsonl"
+    plain, streamed = _record(path, server)
+    assert len(server.requests) == 2
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 2
+
+    cassette = Cassette(str(path), "replay", latency_scale=0)
+    # ホスト名は照合に使わないので、記録時と別のエンドポイントでも再生できる
+    with httpx.Client(transport=CassetteTransport(_Offline(), cassette), base_url="http://cassette.invalid") as client:
+        # JSONのキー順が違っても同じリクエストとして扱う
+        replayed = client.post(CHAT_PATH, json={"temperature": 0, "messages": [{"content": "やあ", "role": "user"}]})
+        assert replayed.status_code == plain.status_code
+        assert replayed.json() == COMPLETION
+        assert replayed.headers["x-ratelimit-remaining-tokens"] == "1000"
+        with client.stream("POST", CHAT_PATH, json={"messages": [{"role": "user", "content": "やあ"}], "stream": True}) as r:
+            assert [line for line in r.iter_lines() if line] == streamed
+    assert (cassette.hits, cassette.misses) == (2, 0)
+    assert len(server.requests) == 2
+
+
+def test_async_replay_of_sync_recording(tmp_path, stub_server):
+    server = stub_server(_respond)
+    path = tmp_path / "cassette.jsonl"
+    _, streamed = _record(path, server)
+    cassette = Cassette(str(path), "replay", latency_scale=0)
+
+    async def replay():
+        async with httpx.AsyncClient(transport=AsyncCassetteTransport(_Offline(), cassette), base_url="http://cassette.invalid") as client:
+            async with client.stream("POST", CHAT_PATH, json={"messages": [{"role": "user", "content": "やあ"}], "stream": True}) as r:
+                return [line async for line in r.aiter_lines() if line]
+
+    assert asyncio.run(replay()) == streamed
+
+
+def test_replay_keeps_recorded_latency(tmp_path):
+    def slow(request):
+        time.sleep(0.2)
+        return httpx.Response(200, json=COMPLETION)
+
+    path = tmp_path / "cassette.jsonl"
+    cassette = Cassette(str(path), "record")
+    with httpx.Client(transport=CassetteTransport(httpx.MockTransport(slow), cassette)) as client:
+        client.post(f"http://llm{CHAT_PATH}", json={"messages": []})
+    cassette.close()
+
+    replay = Cassette(str(path), "replay", latency_scale=0.5)
+    with httpx.Client(transport=CassetteTransport(_Offline(), replay)) as client:
+        start = time.monotonic()
+        client.post(f"http://other{CHAT_PATH}", json={"messages": []})
+        assert 0.08 < time.monotonic() - start < 0.2
+        # 記録より短い読み取りタイムアウトならタイムアウトとして再生する
+        with pytest.raises(httpx.ReadTimeout):
+            client.post(f"http://other{CHAT_PATH}", json={"messages": []}, timeout=0.01)
+
+
+def test_transport_errors_are_recorded_and_replayed(tmp_path):
+    path = tmp_path / "cassette.jsonl"
+    url = f"http://127.0.0.1:{_free_port()}{CHAT_PATH}"
+    cassette = Cassette(str(path), "record")
+    with httpx.Client(transport=CassetteTransport(httpx.HTTPTransport(), cassette)) as client:
+        with pytest.raises(httpx.ConnectError):
+            client.post(url, json={"messages": []})
+    cassette.close()
+
+    replay = Cassette(str(path), "replay", latency_scale=0)
+    with httpx.Client(transport=CassetteTransport(_Offline(), replay)) as client:
+        with pytest.raises(httpx.ConnectError):
+            client.post(url, json={"messages": []})
+
+
+def test_unrecorded_request_falls_back_by_path_or_misses(tmp_path, stub_server):
+    server = stub_server(_respond)
+    path = tmp_path / "cassette.jsonl"
+    _record(path, server)
+    cassette = Cassette(str(path), "replay", latency_scale=0)
+    with httpx.Client(transport=CassetteTransport(_Offline(), cassette), base_url="http://cassette.invalid") as client:
+        # プロンプトが変わっても同じエンドポイントの記録を使う
+        assert client.post(CHAT_PATH, json={"messages": [{"role": "user", "content": "別の質問"}]}).status_code == 200
+        assert cassette.misses == 1
+        with pytest.raises(CassetteMiss):
+            client.post("/faiss/deep_test/search", json={"query": "x"})
+
+
+def test_fallback_matches_azure_urls_with_api_version(tmp_path, stub_server):
+    server = stub_server(_respond)
+    path = tmp_path / "cassette.jsonl"
+    url = f"{CHAT_PATH}?api-version=2023-05-15"
+    cassette = Cassette(str(path), "record")
+    with httpx.Client(transport=CassetteTransport(httpx.HTTPTransport(), cassette), base_url=server.url) as client:
+        client.post(url, json={"messages": [{"role": "user", "content": "やあ"}]})
+    cassette.close()
+
+    replay = Cassette(str(path), "replay", latency_scale=0)
+    with httpx.Client(transport=CassetteTransport(_Offline(), replay), base_url="http://cassette.invalid") as client:
+        # プロンプトが変わった呼び出しも、クエリ付きのURLで記録した応答に代替される
+        response = client.post(url, json={"messages": [{"role": "user", "content": "別の質問"}]})
+        assert response.json() == COMPLETION
+    assert (replay.hits, replay.misses) == (0, 1)
@@ -0,0 +1,93 @@
+import time
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.outputs import Generation
+
+import llm_cache
+from llm_cache import LLMResponseCache, effective_temperature
+
+DETERMINISTIC = '{"kwargs": {"deployment_name": "gpt-4o"}}---[(\'stop\', None), (\'temperature\', 0)]'
+SAMPLING = '{"kwargs": {"deployment_name": "gpt-4o"}}---[(\'stop\', None), (\'temperature\', 0.7)]'
+
+
+def test_effective_temperature_prefers_call_params():
+    assert effective_temperature(DETERMINISTIC) == 0
+    assert effective_temperature(SAMPLING) == 0.7
+    # 呼び出し時に指定が無ければモデルの設定値
+    assert effective_temperature('{"kwargs": {"temperature": 0}}---[(\'stop\', None)]') == 0
+    assert effective_temperature('{"kwargs": {}}---[(\'stop\', None)]') is None
+
+
+def test_hit_and_miss_across_memory_and_disk(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = LLMResponseCache(path)
+    assert cache.lookup("質問", DETERMINISTIC) is None
+    cache.update("質問", DETERMINISTIC, [Generation(text="回答")])
+    # 全角・空白の揺れは同じキーになる
+    assert [g.text for g in cache.lookup(" 質問 ", DETERMINISTIC)] == ["回答"]
+    cache.close()
+
+    reopened = LLMResponseCache(path)
+    assert [g.text for g in reopened.lookup("質問", DETERMINISTIC)] == ["回答"]
+    assert [g.text for g in reopened.lookup("質問", DETERMINISTIC)] == ["回答"]
+    stats = reopened.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 0)
+    reopened.close()
+
+
+def test_sampling_calls_are_not_cached(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.update("質問", SAMPLING, [Generation(text="回答")])
+    assert cache.lookup("質問", SAMPLING) is None
+    assert cache.stats()["skipped"] == 1
+    assert cache.stats()["writes"] == 0
+    cache.close()
+
+
+def test_chat_model_reuses_only_temperature_zero_calls(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"))
+    llm = FakeListChatModel(responses=["一回目", "二回目", "三回目", "四回目"], cache=cache)
+    deterministic = llm.bind(temperature=0)
+    assert deterministic.invoke("こんにちは").content == "一回目"
+    assert deterministic.invoke("こんにちは").content == "一回目"
+    sampling = llm.bind(temperature=0.7)
+    assert sampling.invoke("こんにちは").content == "二回目"
+    assert sampling.invoke("こんにちは").content == "三回目"
+    cache.close()
+
+
+def test_max_entries_evicts_least_recently_used_from_memory_too(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.update("a", DETERMINISTIC, [Generation(text="A")])
+    time.sleep(0.01)
+    cache.update("b", DETERMINISTIC, [Generation(text="B")])
+    time.sleep(0.01)
+    # aを使ったので、次に追い出されるのはb
+    assert cache.lookup("a", DETERMINISTIC) is not None
+    cache.update("c", DETERMINISTIC, [Generation(text="C")])
+    assert cache.lookup("b", DETERMINISTIC) is None
+    assert [g.text for g in cache.lookup("a", DETERMINISTIC)] == ["A"]
+    assert [g.text for g in cache.lookup("c", DETERMINISTIC)] == ["C"]
+    assert cache.stats()["evictions"] == 1
+    cache.close()
+
+
+def test_ttl_expiry_drops_entries_from_memory(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"), ttl=0.05)
+    cache.update("a", DETERMINISTIC, [Generation(text="A")])
+    time.sleep(0.1)
+    cache.update("b", DETERMINISTIC, [Generation(text="B")])
+    assert "a" not in cache._memory
+    assert cache.lookup("a", DETERMINISTIC) is None
+    assert [g.text for g in cache.lookup("b", DETERMINISTIC)] == ["B"]
+    cache.close()
+
+
+def test_with_cache_is_bypassed_while_recording_or_replaying(monkeypatch, tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"))
+    llm = FakeListChatModel(responses=["一回目"])
+    assert llm_cache.with_cache(llm, cache).cache is cache
+    for mode in ("record", "replay"):
+        monkeypatch.setattr(llm_cache, "CASSETTE_MODE", mode)
+        assert llm_cache.with_cache(llm, cache) is llm
+    cache.close()
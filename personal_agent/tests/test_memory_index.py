@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from log_writer import JSONLLogWriter
+from memory_index import MemoryIndex
+
+SEPARATOR = "-" * 50 + "\n"
+
+
+def _contents(index: MemoryIndex) -> list[tuple[str, str]]:
+    return sorted(index._conn.execute("SELECT session, content FROM turns").fetchall())
+
+
+def test_text_logs_with_the_same_first_line_are_ingested_separately(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    greeting = "USER (ユーザー): こんにちは\n" + SEPARATOR
+    (logs / "a.txt").write_text(greeting + "ASSISTANT (A): Aの回答です\n" + SEPARATOR, encoding="utf-8")
+    (logs / "b.txt").write_text(greeting + "ASSISTANT (B): Bの長い回答です。" * 3 + "\n" + SEPARATOR, encoding="utf-8")
+    index = MemoryIndex(str(tmp_path / "memory.sqlite3"), use_vectors=False)
+    assert index.ingest_dir(str(logs)) == 4
+    assert index.ingest_dir(str(logs)) == 0
+    assert [s for s, _ in _contents(index)] == ["a", "a", "b", "b"]
+    index.close()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_rotated_segments_are_ingested_once(tmp_path, compress):
+    logs = tmp_path / "logs"
+    index = MemoryIndex(str(tmp_path / "memory.sqlite3"), use_vectors=False)
+    writer = JSONLLogWriter(str(logs / "s1.jsonl"), batch_size=1, max_bytes=300, backup_count=5, compress=compress)
+    for i in range(30):
+        writer.write({"event": "chat", "role": "user", "name": "u", "content": f"メッセージ{i:03d}"})
+        writer.flush()
+        if i % 7 == 3:
+            # 取り込みの合間にローテーションが起きても重複・取りこぼしが出ない
+            index.ingest_dir(str(logs))
+    writer.close()
+    index.ingest_dir(str(logs))
+    assert len([n for n in os.listdir(logs) if n != "s1.jsonl"]) > 1
+    assert _contents(index) == [("s1", f"メッセージ{i:03d}") for i in range(30)]
+    index.close()
+
+
+def test_rewritten_shorter_file_is_read_from_the_start(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    path = logs / "s.jsonl"
+    path.write_text('{"event": "chat", "role": "user", "content": "一つ目"}\n{"event": "chat", "role": "user", "content": "二つ目"}\n', encoding="utf-8")
+    index = MemoryIndex(str(tmp_path / "memory.sqlite3"), use_vectors=False)
+    assert index.ingest_dir(str(logs)) == 2
+    # 同じ先頭行で、前回の取り込み位置より短く書き直された
+    path.write_text('{"event": "chat", "role": "user", "content": "一つ目"}\n{"event": "chat", "role": "user", "content": "X"}\n', encoding="utf-8")
+    assert index.ingest_dir(str(logs)) == 2
+    index.close()
@@ -0,0 +1,201 @@
+import time
+import uuid
+import socket
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+from deadline import DeadlineExceeded, start_deadline
+from rate_limiter import (
+    AsyncRateLimitedTransport, RateLimitedTransport, RateLimiter, RetryPolicy, get_rate_limiter, parse_retry_after,
+)
+
+COMPLETION = {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+POLICY = RetryPolicy(max_retries=2, base_delay=0.01, max_delay=0.5)
+
+
+async def _grant_order(limiter: RateLimiter, requests: list[tuple[str, int]]) -> list[str]:
+    order = []
+
+    async def call(name: str, cost: int):
+        await limiter.aacquire(cost, key=name[0])
+        order.append(name)
+
+    # タスクは作った順に待ち行列へ入る
+    tasks = [asyncio.ensure_future(call(name, cost)) for name, cost in requests]
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_rpm_round_robin_between_keys():
+    limiter = RateLimiter(rpm=6000, headroom=1.0)
+    # 429を受けた直後の状態にして、全員を待ち行列に並ばせる
+    limiter.throttle(0.1)
+    order = asyncio.run(_grant_order(limiter, [("a1", 0), ("a2", 0), ("a3", 0), ("a4", 0), ("b1", 0), ("b2", 0)]))
+    # 先に大量に並んだセッションがあっても、後から来たセッションが交互に割り込める
+    assert order == ["a1", "b1", "a2", "b2", "a3", "a4"]
+    assert limiter.stats["granted"] == 6
+
+
+def test_tpm_round_robin_does_not_let_large_requests_starve_others():
+    limiter = RateLimiter(tpm=600_000, headroom=1.0)
+    limiter.throttle(0.05)
+    capacity = 100_000
+    order = asyncio.run(_grant_order(limiter, [("a1", capacity // 50), ("a2", capacity // 50), ("b1", 100), ("b2", 100)]))
+    assert order == ["a1", "b1", "a2", "b2"]
+
+
+def test_tpm_paces_tokens():
+    limiter = RateLimiter(tpm=600_000, headroom=1.0)
+    capacity = 100_000
+    start = time.monotonic()
+    limiter.acquire(capacity, key="a")
+    assert time.monotonic() - start < 0.05
+    # 補充は1秒あたり10000トークン。2000トークン分は0.2秒待つ
+    limiter.acquire(capacity // 50, key="a")
+    assert 0.15 < time.monotonic() - start < 0.6
+
+
+def test_oversized_request_is_clamped_to_bucket_capacity():
+    limiter = RateLimiter(tpm=600_000, headroom=1.0)
+    start = time.monotonic()
+    limiter.acquire(10_000_000, key="a")
+    assert time.monotonic() - start < 0.05
+
+
+def test_sync_and_async_waiters_share_one_queue():
+    limiter = RateLimiter(rpm=6000, headroom=1.0)
+    limiter.throttle(0.1)
+    order = []
+    thread = threading.Thread(target=lambda: (limiter.acquire(key="sync"), order.append("sync")))
+    thread.start()
+    while "sync" not in limiter._queues:
+        time.sleep(0.001)
+
+    async def run():
+        await limiter.aacquire(key="async")
+        order.append("async")
+
+    asyncio.run(run())
+    thread.join(1)
+    assert order == ["sync", "async"]
+
+
+def test_waiting_stops_at_turn_deadline_and_leaves_queue():
+    limiter = RateLimiter(rpm=6000, headroom=1.0)
+    limiter.throttle(5.0)
+
+    async def run():
+        start_deadline(0.1)
+        await limiter.aacquire(key="a")
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(run())
+    assert time.monotonic() - start < 1.0
+    assert not limiter._queues and not limiter._waiters
+
+
+# ========== リトライ（ローカルのスタブサーバー相手） ==========
+def _deployment_url(server) -> tuple[str, str]:
+    # リミッタはデプロイメント名ごとに共有されるので、テストごとに別の名前を使う
+    deployment = f"test-{uuid.uuid4().hex[:8]}"
+    return deployment, f"{server.url}/openai/deployments/{deployment}/chat/completions?api-version=2023-05-15"
+
+
+def _replies(*replies):
+    replies = iter(replies)
+    return lambda method, path, body: next(replies)
+
+
+def _post(url: str, policy: RetryPolicy = POLICY) -> httpx.Response:
+    with httpx.Client(transport=RateLimitedTransport(httpx.HTTPTransport(), policy)) as client:
+        return client.post(url, json={"messages": [{"role": "user", "content": "やあ"}], "max_tokens": 10})
+
+
+def test_parse_retry_after_headers():
+    assert parse_retry_after(httpx.Headers({"retry-after-ms": "250", "retry-after": "3"})) == 0.25
+    assert parse_retry_after(httpx.Headers({"retry-after": "2"})) == 2.0
+    assert 0 < parse_retry_after(httpx.Headers({"retry-after": "Wed, 21 Oct 2099 07:28:00 GMT"}))
+    assert parse_retry_after(httpx.Headers({"retry-after": "soon"})) is None
+    assert parse_retry_after(httpx.Headers()) is None
+
+
+def test_429_honours_retry_after_ms_and_throttles_the_deployment(stub_server):
+    server = stub_server(_replies((429, "slow down", {"retry-after-ms": "200"}), (200, COMPLETION, None)))
+    deployment, url = _deployment_url(server)
+    start = time.monotonic()
+    response = _post(url)
+    assert response.status_code == 200
+    assert response.json() == COMPLETION
+    assert time.monotonic() - start >= 0.2
+    assert len(server.requests) == 2
+    assert get_rate_limiter(deployment).stats["throttled"] == 1
+
+
+def test_retry_after_is_capped_by_max_delay(stub_server):
+    server = stub_server(_replies((503, "busy", {"retry-after": "30"}), (200, COMPLETION, None)))
+    _, url = _deployment_url(server)
+    start = time.monotonic()
+    assert _post(url, RetryPolicy(max_retries=2, base_delay=0.01, max_delay=0.1)).status_code == 200
+    assert time.monotonic() - start < 1.0
+
+
+def test_5xx_is_retried_with_backoff(stub_server):
+    server = stub_server(_replies((500, "error", None), (502, "bad gateway", None), (200, COMPLETION, None)))
+    _, url = _deployment_url(server)
+    assert _post(url).status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_gives_up_after_max_retries_and_returns_last_response(stub_server):
+    server = stub_server(lambda method, path, body: (503, "busy", None))
+    _, url = _deployment_url(server)
+    assert _post(url).status_code == 503
+    assert len(server.requests) == POLICY.max_retries + 1
+
+
+def test_client_errors_are_not_retried(stub_server):
+    server = stub_server(lambda method, path, body: (400, "bad request", None))
+    _, url = _deployment_url(server)
+    assert _post(url).status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_connection_errors_are_retried_then_raised():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    attempts = []
+
+    class Counting(httpx.HTTPTransport):
+        def handle_request(self, request):
+            attempts.append(request)
+            return super().handle_request(request)
+
+    with httpx.Client(transport=RateLimitedTransport(Counting(), POLICY)) as client:
+        with pytest.raises(httpx.ConnectError):
+            client.post(f"http://127.0.0.1:{port}/openai/deployments/gone/chat/completions", json={"messages": []})
+    assert len(attempts) == POLICY.max_retries + 1
+
+
+def test_async_transport_retries_429_and_5xx(stub_server):
+    server = stub_server(_replies((429, "slow down", {"retry-after-ms": "50"}), (504, "timeout", None), (200, COMPLETION, None)))
+    _, url = _deployment_url(server)
+
+    async def post():
+        async with httpx.AsyncClient(transport=AsyncRateLimitedTransport(httpx.AsyncHTTPTransport(), POLICY)) as client:
+            return await client.post(url, json={"messages": []})
+
+    response = asyncio.run(post())
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_non_llm_requests_are_not_retried(stub_server):
+    server = stub_server(lambda method, path, body: (503, "busy", None))
+    with httpx.Client(transport=RateLimitedTransport(httpx.HTTPTransport(), POLICY)) as client:
+        assert client.post(f"{server.url}/faiss/deep_test/search", json={"query": "x"}).status_code == 503
+    assert len(server.requests) == 1
@@ -0,0 +1,125 @@
+import json
+import time
+import asyncio
+
+import pytest
+
+from rate_limiter import RetryPolicy
+from search_client import SearchClient, SearchError, TTLCache
+from search_rerank import parse_hits
+from transport import HTTPTransport, TransportConfig
+
+RESULTS = {"results": [
+    {"text": "東京は日本の首都です。", "score": 0.9, "metadata": {"source": "doc1"}},
+    {"content": "大阪は西日本の中心都市です。", "distance": 0.4, "id": 7},
+]}
+
+
+def make_client(server, timeout: float = 1.0, max_retries: int = 2) -> SearchClient:
+    return SearchClient(
+        url=f"{server.url}/faiss/deep_test/search",
+        transport=HTTPTransport(TransportConfig(connect_timeout=1.0, read_timeout=timeout)),
+        timeout=timeout,
+        cache=TTLCache(ttl=60),
+        retry=RetryPolicy(max_retries=max_retries, base_delay=0.01, max_delay=0.02),
+    )
+
+
+def test_search_posts_query_and_caches_result(stub_server):
+    server = stub_server(lambda method, path, body: (200, RESULTS, {"Content-Type": "application/json"}))
+    client = make_client(server)
+    assert client.search("首都は？", top_k=3) == RESULTS
+    # 全角・空白の揺れは同じクエリとしてキャッシュから返す
+    assert client.search("  首都は？ ", top_k=3) == RESULTS
+    assert len(server.requests) == 1
+    method, path, body = server.requests[0]
+    assert (method, path) == ("POST", "/faiss/deep_test/search")
+    assert json.loads(body) == {"query": "首都は？", "top_k": 3}
+    assert (client.cache.hits, client.cache.misses) == (1, 1)
+    client.close()
+
+
+def test_search_retries_transient_errors(stub_server):
+    statuses = iter([503, 502, 200])
+    server = stub_server(lambda method, path, body: (next(statuses), RESULTS, None))
+    client = make_client(server)
+    assert client.search("首都") == RESULTS
+    assert len(server.requests) == 3
+    client.close()
+
+
+def test_search_gives_up_after_max_retries(stub_server):
+    server = stub_server(lambda method, path, body: (503, "busy", None))
+    client = make_client(server, max_retries=2)
+    with pytest.raises(SearchError):
+        client.search("首都")
+    assert len(server.requests) == 3
+    # 失敗した結果はキャッシュしない
+    with pytest.raises(SearchError):
+        client.search("首都")
+    assert len(server.requests) == 6
+    client.close()
+
+
+def test_search_does_not_retry_client_errors(stub_server):
+    server = stub_server(lambda method, path, body: (400, "bad request", None))
+    client = make_client(server)
+    with pytest.raises(SearchError):
+        client.search("首都")
+    assert len(server.requests) == 1
+    client.close()
+
+
+def test_search_read_timeout_is_retried_then_reported(stub_server):
+    def slow(method, path, body):
+        time.sleep(0.5)
+        return 200, RESULTS, None
+
+    server = stub_server(slow)
+    client = make_client(server, timeout=0.1, max_retries=1)
+    start = time.monotonic()
+    with pytest.raises(SearchError):
+        client.search("首都")
+    assert time.monotonic() - start < 0.45
+    assert len(server.requests) == 2
+    client.close()
+
+
+def test_search_invalid_json_raises_search_error(stub_server):
+    server = stub_server(lambda method, path, body: (200, "<html>not json</html>", None))
+    client = make_client(server)
+    with pytest.raises(SearchError):
+        client.search("首都")
+    client.close()
+
+
+def test_asearch_many_runs_concurrently_and_returns_failures(stub_server):
+    def respond(method, path, body):
+        time.sleep(0.2)
+        if json.loads(body)["query"] == "壊れた問い":
+            return 400, "bad request", None
+        return 200, {"results": [{"text": json.loads(body)["query"]}]}, None
+
+    server = stub_server(respond)
+    client = make_client(server)
+    start = time.monotonic()
+    results = asyncio.run(client.asearch_many(["東京", "壊れた問い", "大阪"]))
+    assert time.monotonic() - start < 0.5
+    assert results[0] == {"results": [{"text": "東京"}]}
+    assert isinstance(results[1], SearchError)
+    assert results[2] == {"results": [{"text": "大阪"}]}
+    client.close()
+
+
+def test_parse_hits_reads_api_shapes():
+    passages = parse_hits(RESULTS)
+    assert [(p.text, p.source, p.api_score) for p in passages] == [
+        ("東京は日本の首都です。", "doc1", 0.9),
+        ("大阪は西日本の中心都市です。", "7", 0.4),
+    ]
+    # search_many の結果（問いごとのレスポンスと失敗）も平らにする
+    batched = [RESULTS, {"query": "x", "error": "failed"}, {"hits": ["京都は古都です。", ""]}]
+    assert [p.text for p in parse_hits(batched)] == [
+        "東京は日本の首都です。", "大阪は西日本の中心都市です。", "京都は古都です。",
+    ]
+    assert parse_hits(None) == []
@@ -0,0 +1,66 @@
+from search_rerank import BM25, Passage, char_ngrams, pack, rerank, select_context, trim_passage
+
+
+def test_char_ngrams_normalizes_width_and_punctuation():
+    assert char_ngrams("ＤＢ障害。") == ["db", "b障", "障害"]
+    assert char_ngrams("a b") == ["a", "b"]
+
+
+def test_bm25_prefers_documents_sharing_rare_bigrams():
+    bm25 = BM25(["ディスク容量の不足でDBが停止した", "会議室の予約方法", "ディスクの交換手順"])
+    scores = bm25.scores("ディスク容量不足")
+    assert scores[0] > scores[2] > scores[1] == 0.0
+
+
+def test_trim_passage_keeps_query_sentences_in_original_order():
+    passage = Passage("前置きの文です。" * 10 + "障害の原因はディスク容量の不足でした。" + "後書きの文です。" * 10 + "再発防止に監視を追加しました。",
+                      source="doc1", api_score=0.5)
+    trimmed = trim_passage("障害の原因と再発防止", passage, max_tokens=40)
+    assert trimmed.tokens <= 40
+    assert trimmed.text.index("障害の原因") < trimmed.text.index("再発防止")
+    assert (trimmed.source, trimmed.api_score) == ("doc1", 0.5)
+    # 短い文書はそのまま
+    short = Passage("短い文書です。")
+    assert trim_passage("文書", short, max_tokens=40) is short
+
+
+def test_pack_skips_passages_that_do_not_fit():
+    a, b, c = Passage("あ" * 40), Passage("い" * 400), Passage("う" * 40)
+    assert pack([a, b, c], budget=a.tokens + c.tokens) == [a, c]
+
+
+def test_rerank_merges_duplicates_across_queries():
+    ranked = rerank("障害", [Passage("会議の議事録"), Passage("障害の報告"), Passage("障害の報告")])
+    assert [p.text for p in ranked] == ["障害の報告", "会議の議事録"]
+
+
+def test_select_context_returns_short_top_hit_directly():
+    context = select_context("DB障害の原因", {"results": [{"text": "DB障害の原因はディスク不足です。", "source": "kb"}]})
+    assert context.direct == "[kb] DB障害の原因はディスク不足です。"
+
+
+def test_select_context_keeps_hits_without_lexical_overlap():
+    # ベクトル検索の言い換え・英語の文書は文字2-gramでは1つも一致しない
+    context = select_context("トラブル事例", {"results": [{"text": "Disk full caused database outage."}]})
+    assert [p.text for p in context.passages] == ["Disk full caused database outage."]
+    data = {"results": [{"text": "Second semantic hit."}, {"text": "トラブルの事例集"}, {"text": "Third semantic hit."}]}
+    context = select_context("トラブル事例", data, direct_max_tokens=0)
+    # 照合した文書が先、それ以外はAPIの順
+    assert [p.text for p in context.passages] == ["トラブルの事例集", "Second semantic hit.", "Third semantic hit."]
+
+
+def test_select_context_without_direct_keeps_every_sub_question():
+    data = [{"results": [{"text": "東京の人口は約1400万人です。"}]}, {"results": [{"text": "大阪の名物はたこ焼きです。"}]}]
+    context = select_context("東京の人口\n大阪の名物", data, direct_max_tokens=0)
+    assert context.direct is None
+    assert {p.text for p in context.passages} == {"東京の人口は約1400万人です。", "大阪の名物はたこ焼きです。"}
+
+
+def test_select_context_trims_and_packs_to_budget():
+    long_text = "障害の原因を調べました。" + "関係のない説明が続きます。" * 60
+    data = {"results": [{"text": long_text}, {"text": "障害対応の手順書です。" * 5}]}
+    context = select_context("障害の原因", data, budget=120, max_passage_tokens=60, direct_max_tokens=0)
+    assert context.passages
+    assert sum(p.tokens for p in context.passages) <= 120
+    assert all(p.tokens <= 60 for p in context.passages)
+    assert select_context("障害", None).passages == []
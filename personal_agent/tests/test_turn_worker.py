@@ -0,0 +1,31 @@
+import time
+import asyncio
+
+from scheduler import create_scheduler
+from turn_worker import TurnWorker, call_in_turn
+
+
+def test_stop_cancels_in_flight_facilitator_call():
+    started, finished = [], []
+
+    async def slow_decide():
+        started.append(True)
+        await asyncio.sleep(5)
+        finished.append(True)
+        return "A"
+
+    scheduler = create_scheduler("llm", ["A", "B"], decide=lambda user_input, chat_history: call_in_turn(slow_decide()))
+    worker = TurnWorker()
+    worker.start(lambda turn: scheduler.next_speaker("質問", []))
+    while not started:
+        time.sleep(0.01)
+    start = time.monotonic()
+    worker.stop()
+    worker._thread.join(2)
+    assert time.monotonic() - start < 0.5
+    assert [e.kind for e in worker.drain()] == ["cancelled", "done"]
+    assert not finished
+
+
+def test_call_in_turn_outside_a_turn_runs_on_background_loop():
+    assert call_in_turn(asyncio.sleep(0, "結果")) == "結果"
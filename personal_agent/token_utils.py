@@ -0,0 +1,54 @@
+import os
+import re
+from functools import lru_cache
+from typing import Any, Optional
+
+# ========== オフラインでのトークン数見積もり ==========
+# 日本語（ひらがな・カタカナ・漢字・全角記号）は1文字あたり約1トークン、
+# 英数字は約4文字で1トークンとして概算する。TOKEN_ESTIMATOR=tiktoken の場合は
+# （エンコーディングがローカルにキャッシュされていれば）tiktokenで正確に数える。
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_WORD_RE = re.compile(r"[A-Za-z0-9_]+")
+
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=1)
+def _load_encoding() -> Optional[Any]:
+    if os.getenv("TOKEN_ESTIMATOR", "heuristic") != "tiktoken":
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # 未インストールやオフラインでダウンロードできない場合は概算にフォールバック
+        return None
+
+
+def heuristic_tokens(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    words = _WORD_RE.findall(text)
+    word_tokens = sum((len(w) + 3) // 4 for w in words)
+    rest = len(text) - cjk - sum(len(w) for w in words) - text.count(" ")
+    return cjk + word_tokens + max(rest, 0) // 2
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _load_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return heuristic_tokens(text)
+
+
+def _message_content(message: Any) -> str:
+    if isinstance(message, dict):
+        content = message.get("content", "")
+    else:
+        content = getattr(message, "content", message)
+    return content if isinstance(content, str) else str(content)
+
+
+def estimate_message_tokens(messages: list) -> int:
+    return sum(estimate_tokens(_message_content(m)) + MESSAGE_OVERHEAD_TOKENS for m in messages)
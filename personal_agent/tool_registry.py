@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from langchain.agents import Tool
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableConfig
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ToolStats:
+    calls: int = 0
+    errors: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    @property
+    def avg_latency(self) -> float:
+        return self.total_latency / self.calls if self.calls else 0.0
+
+
+@dataclass
+class RegisteredTool:
+    name: str
+    description: str
+    runnable: Runnable
+
+
+# ========== 事前構築済みツールのレジストリ ==========
+class ToolRegistry:
+    """ツールごとのプロンプトとrunnableを一度だけ組み立て、全専門エージェントで共有する。"""
+
+    def __init__(self):
+        self._tools: dict[str, RegisteredTool] = {}
+        self.stats: dict[str, ToolStats] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, description: str, runnable: Runnable) -> RegisteredTool:
+        with self._lock:
+            if name not in self._tools:
+                self._tools[name] = RegisteredTool(name, description, runnable)
+                self.stats[name] = ToolStats()
+            return self._tools[name]
+
+    def register_prompt(self, name: str, description: str, system_prompt: str, llm, role: str = "tool") -> RegisteredTool:
+        # 同名のツールが登録済みならそれを返す（専門エージェント間で共有する）
+        if name in self._tools:
+            return self._tools[name]
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessage(content=system_prompt),
+            HumanMessagePromptTemplate.from_template("{input}")
+        ])
+        runnable = (prompt | llm | StrOutputParser()).with_config(
+            run_name=name,
+            metadata={"role": role, "agent": name},
+        )
+        return self.register(name, description, runnable)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def get(self, name: str) -> RegisteredTool:
+        return self._tools[name]
+
+    def _record(self, name: str, start: float, error: bool, count: int = 1):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self.stats[name]
+            stats.calls += count
+            stats.errors += int(error)
+            stats.total_latency += elapsed
+            stats.max_latency = max(stats.max_latency, elapsed)
+
+    def invoke(self, name: str, input_text: str, config: Optional[RunnableConfig] = None) -> str:
+        tool = self._tools[name]
+        start = time.perf_counter()
+        try:
+            output = tool.runnable.invoke({"input": input_text}, config=config)
+        except Exception:
+            self._record(name, start, error=True)
+            raise
+        self._record(name, start, error=False)
+        logger.info("Tool %s invoked with input: %s\nOutput: %s", name, input_text, output)
+        return output
+
+    async def ainvoke(self, name: str, input_text: str, config: Optional[RunnableConfig] = None) -> str:
+        tool = self._tools[name]
+        start = time.perf_counter()
+        try:
+            output = await tool.runnable.ainvoke({"input": input_text}, config=config)
+        except Exception:
+            self._record(name, start, error=True)
+            raise
+        self._record(name, start, error=False)
+        logger.info("Tool %s invoked with input: %s\nOutput: %s", name, input_text, output)
+        return output
+
+    def batch(self, name: str, inputs: list[str], config: Optional[RunnableConfig] = None, max_concurrency: Optional[int] = None) -> list[str]:
+        # 同じツールへの複数入力をまとめて並列実行する
+        tool = self._tools[name]
+        if max_concurrency is not None:
+            config = {**(config or {}), "max_concurrency": max_concurrency}
+        start = time.perf_counter()
+        try:
+            outputs = tool.runnable.batch([{"input": x} for x in inputs], config=config)
+        except Exception:
+            self._record(name, start, error=True, count=len(inputs))
+            raise
+        self._record(name, start, error=False, count=len(inputs))
+        return outputs
+
+    def as_tool(self, name: str) -> Tool:
+        # nameを引数で束縛するので、ループで作っても最後のツールに化けない
+        tool = self._tools[name]
+
+        def func(input_text: str, callbacks=None) -> str:
+            return self.invoke(name, input_text, {"callbacks": callbacks} if callbacks else None)
+
+        async def coroutine(input_text: str, callbacks=None) -> str:
+            return await self.ainvoke(name, input_text, {"callbacks": callbacks} if callbacks else None)
+
+        return Tool(name=name, func=func, coroutine=coroutine, description=tool.description)
+
+    def as_tools(self, names: Iterable[str]) -> list[Tool]:
+        return [self.as_tool(name) for name in names]
+
+    def format_stats(self) -> str:
+        with self._lock:
+            rows = [(name, s) for name, s in self.stats.items() if s.calls]
+        return "\n".join(
+            f"{name}: {s.calls}回 (エラー {s.errors}) 平均 {s.avg_latency:.2f}s / 最大 {s.max_latency:.2f}s"
+            for name, s in sorted(rows, key=lambda r: -r[1].total_latency)
+        )
@@ -0,0 +1,170 @@
+import os
+import asyncio
+import threading
+import weakref
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, Optional
+
+import httpx
+
+from rate_limiter import RateLimitedTransport, AsyncRateLimitedTransport
+from cassette import wrap_transport, wrap_async_transport
+
+logger = logging.getLogger(__name__)
+
+
+# ========== HTTPトランスポート設定 ==========
+@dataclass(frozen=True)
+class TransportConfig:
+    pool_size: int = 20
+    max_keepalive: int = 10
+    keepalive_expiry: float = 120.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 10.0
+
+    @classmethod
+    def from_env(cls) -> "TransportConfig":
+        # 環境変数で上書き可能（未設定ならデフォルト値）
+        default = cls()
+        return cls(
+            pool_size=int(os.getenv("LLM_POOL_SIZE", default.pool_size)),
+            max_keepalive=int(os.getenv("LLM_POOL_KEEPALIVE", default.max_keepalive)),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", default.keepalive_expiry)),
+            connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", default.connect_timeout)),
+            read_timeout=float(os.getenv("LLM_READ_TIMEOUT", default.read_timeout)),
+            write_timeout=float(os.getenv("LLM_WRITE_TIMEOUT", default.write_timeout)),
+            pool_timeout=float(os.getenv("LLM_POOL_TIMEOUT", default.pool_timeout)),
+        )
+
+
+# ========== 共有HTTPトランスポート ==========
+class HTTPTransport:
+    """keep-alive付きの接続プールを持つHTTPクライアントをプロセス内で共有する。"""
+
+    def __init__(self, config: Optional[TransportConfig] = None):
+        self.config = config or TransportConfig.from_env()
+        self._client: Optional[httpx.Client] = None
+        # httpx.AsyncClientはイベントループに紐づくため、ループごとに保持する
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def timeout(self, read_timeout: Optional[float] = None) -> httpx.Timeout:
+        cfg = self.config
+        return httpx.Timeout(
+            connect=cfg.connect_timeout,
+            read=read_timeout if read_timeout is not None else cfg.read_timeout,
+            write=cfg.write_timeout,
+            pool=cfg.pool_timeout,
+        )
+
+    def _limits(self) -> httpx.Limits:
+        cfg = self.config
+        return httpx.Limits(
+            max_connections=cfg.pool_size,
+            max_keepalive_connections=cfg.max_keepalive,
+            keepalive_expiry=cfg.keepalive_expiry,
+        )
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # LLM宛てのリクエストは共有レートリミッタとリトライを通す（カセット有効時は最下層で記録・再生）
+                    self._client = httpx.Client(
+                        transport=RateLimitedTransport(wrap_transport(httpx.HTTPTransport(limits=self._limits()))),
+                        timeout=self.timeout(),
+                    )
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    transport=AsyncRateLimitedTransport(wrap_async_transport(httpx.AsyncHTTPTransport(limits=self._limits()))),
+                    timeout=self.timeout(),
+                )
+                self._async_clients[loop] = client
+        return client
+
+    def post_json(self, url: str, headers: dict, payload: dict, timeout: Optional[float] = None) -> httpx.Response:
+        response = self.client.post(url, headers=headers, json=payload, timeout=self.timeout(timeout))
+        response.raise_for_status()
+        return response
+
+    async def apost_json(self, url: str, headers: dict, payload: dict, timeout: Optional[float] = None) -> httpx.Response:
+        response = await self.async_client.post(url, headers=headers, json=payload, timeout=self.timeout(timeout))
+        response.raise_for_status()
+        return response
+
+    # Server-Sent Events形式のレスポンスを1行ずつ返す
+    def stream_lines(self, url: str, headers: dict, payload: dict, timeout: Optional[float] = None) -> Iterator[str]:
+        with self.client.stream("POST", url, headers=headers, json=payload, timeout=self.timeout(timeout)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield line
+
+    async def astream_lines(self, url: str, headers: dict, payload: dict, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        async with self.async_client.stream("POST", url, headers=headers, json=payload, timeout=self.timeout(timeout)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    yield line
+
+    # 起動時に接続（TCP+TLS）を張っておき、初回呼び出しのハンドシェイクを省く
+    def warmup(self, url: str, connections: int = 1) -> None:
+        # 順番に送ると同じ接続が使い回されるだけなので、同時に送って接続を connections 本張る
+        client = self.client
+        timeout = self.timeout(self.config.connect_timeout)
+        connections = max(1, connections)
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="http-warmup") as executor:
+            futures = [executor.submit(client.head, url, timeout=timeout) for _ in range(connections)]
+        for future in futures:
+            e = future.exception()
+            if e is not None:
+                logger.warning(f"warmup failed for {url}: {e}")
+
+    async def awarmup(self, url: str, connections: int = 1) -> None:
+        client = self.async_client
+        timeout = self.timeout(self.config.connect_timeout)
+        results = await asyncio.gather(
+            *[client.head(url, timeout=timeout) for _ in range(max(1, connections))],
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                logger.warning(f"async warmup failed for {url}: {r}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+
+_default_transport: Optional[HTTPTransport] = None
+_default_lock = threading.Lock()
+
+
+def get_default_transport() -> HTTPTransport:
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = HTTPTransport()
+    return _default_transport
@@ -0,0 +1,179 @@
+import queue
+import asyncio
+import threading
+import traceback
+import contextvars
+import concurrent.futures
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+from async_runtime import run_coroutine, submit_coroutine
+
+T = TypeVar("T")
+
+
+class TurnCancelled(Exception):
+    pass
+
+
+@dataclass
+class TurnEvent:
+    # kind: speaker（発言開始）/ token / message（発言確定）/ warning / error / cancelled / done
+    kind: str
+    name: Optional[str] = None
+    content: str = ""
+    data: dict = field(default_factory=dict)
+
+
+_DONE = object()
+
+
+# ========== ターン実行中のコンテキスト ==========
+class TurnContext:
+    """ワーカースレッド側で使う。LLM呼び出しはcall/streamを通すと停止ボタンで中断できる。"""
+
+    def __init__(self, events: "queue.Queue[TurnEvent]"):
+        self.events = events
+        self._cancel = threading.Event()
+        self._futures: set = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        # 実行中の非同期呼び出しをキャンセルし、HTTPリクエストごと打ち切る
+        self._cancel.set()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise TurnCancelled()
+
+    def emit(self, kind: str, name: Optional[str] = None, content: str = "", **data: Any):
+        self.events.put(TurnEvent(kind, name, content, data))
+
+    def _track(self, coro: Awaitable) -> "concurrent.futures.Future":
+        self.check()
+        future = submit_coroutine(coro)
+        with self._lock:
+            self._futures.add(future)
+        # 登録と同時に停止された場合も取りこぼさない
+        if self.cancelled:
+            future.cancel()
+        return future
+
+    def _untrack(self, future: "concurrent.futures.Future"):
+        with self._lock:
+            self._futures.discard(future)
+
+    def call(self, coro: Awaitable[T]) -> T:
+        future = self._track(coro)
+        try:
+            return future.result()
+        except (concurrent.futures.CancelledError, asyncio.CancelledError):
+            raise TurnCancelled()
+        finally:
+            self._untrack(future)
+
+    def stream(self, agen: AsyncIterator[T]) -> Iterator[T]:
+        # 非同期ジェネレータを要素が届き次第返す（iterate_asyncのキャンセル対応版）
+        items: "queue.Queue" = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((item, None))
+            except BaseException as e:
+                items.put((_DONE, e))
+                return
+            items.put((_DONE, None))
+
+        future = self._track(pump())
+        try:
+            while True:
+                try:
+                    item, error = items.get(timeout=0.1)
+                except queue.Empty:
+                    if future.cancelled():
+                        raise TurnCancelled()
+                    continue
+                if item is _DONE:
+                    if isinstance(error, asyncio.CancelledError) or self.cancelled:
+                        raise TurnCancelled()
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            future.cancel()
+            self._untrack(future)
+
+
+# ワーカースレッドで実行中のターン（ターンの外ではNone）
+_current_turn: contextvars.ContextVar[Optional[TurnContext]] = contextvars.ContextVar("turn_context", default=None)
+
+
+def current_turn() -> Optional[TurnContext]:
+    return _current_turn.get()
+
+
+def call_in_turn(coro: Awaitable[T]) -> T:
+    # ターン中ならcall経由で待つ（停止ボタンで実行中のリクエストごと打ち切れる）。ターンの外では常駐ループで待つ
+    turn = _current_turn.get()
+    return run_coroutine(coro) if turn is None else turn.call(coro)
+
+
+# ========== セッションごとのバックグラウンド実行 ==========
+class TurnWorker:
+    """1セッションにつき1つ。ターンを別スレッドで実行し、結果をイベントとしてキューに積む。
+
+    ワーカースレッドからはst.session_stateに触れないこと（スクリプト実行コンテキストがないため）。
+    """
+
+    def __init__(self):
+        self.events: "queue.Queue[TurnEvent]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._context: Optional[TurnContext] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, fn: Callable[..., None], *args: Any):
+        if self.running:
+            raise RuntimeError("前のターンがまだ実行中です")
+        turn = self._context = TurnContext(self.events)
+
+        def run():
+            # スケジューラのdecideのように、turnを引数で受け取らない呼び出しからも使えるようにする
+            _current_turn.set(turn)
+            try:
+                fn(turn, *args)
+            except TurnCancelled:
+                turn.emit("cancelled")
+            except Exception:
+                turn.emit("error", content=traceback.format_exc())
+            finally:
+                turn.emit("done")
+
+        # 呼び出し元のcontextvars（レートリミットのキーなど）を引き継ぐ
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(run,), name="turn-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._context is not None:
+            self._context.cancel()
+
+    def drain(self) -> list[TurnEvent]:
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
@@ -2,19 +2,19 @@
 from langchain.chains import LLMChain
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.tools import Tool
 import os, logging
+from llm_cache import with_cache
+from model_registry import get_llm
 
 logging.basicConfig(level=logging.INFO)
 
-# LLMの初期化
-llm = AzureChatOpenAI(
-    openai_api_version="2023-05-15",
-    deployment_name="gpt-4o",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-)
+# LLMの初期化（役割ごとのデプロイメントとパラメータは models.json で切り替える）
+llm = get_llm("specialist")
+# 各係のツールと検索結果の要約は軽いモデルに回せるよう役割を分ける
+tool_llm = get_llm("brain_tool")
+search_summary_llm = get_llm("search_summary")
 
 # エージェント設定
 agent_definitions = {
@@ -41,19 +41,53 @@ agent_definitions = {
 }
 
 
-import requests
+import re
+from search_client import get_search_client, SearchError
+from search_rerank import select_context
+
+# 要約に渡す検索結果のトークン予算と、要約を省略して直接返す上限
+SEARCH_CONTEXT_TOKENS = int(os.getenv("SEARCH_CONTEXT_TOKENS", "800"))
+SEARCH_DIRECT_MAX_TOKENS = int(os.getenv("SEARCH_DIRECT_MAX_TOKENS", "150"))
+
+# 仮の外部APIエンドポイント（SEARCH_API_URLで変更可。ベンチマークではフェイクサーバに向ける）
+search_client = get_search_client()
+
+
+def split_sub_questions(query: str) -> list[str]:
+    # 箇条書きや改行で複数の問いが渡された場合は、それぞれを別の検索として扱う
+    lines = [re.sub(r"^\s*(?:[-・*•]|\d+[.)．])\s*", "", line).strip() for line in query.splitlines()]
+    return [line for line in lines if line] or [query]
 
-search_url = "http://localhost:8000/faiss/deep_test/search"  # 仮の外部APIエンドポイント
 
 def external_search_api(
     query: str,
     logger: logging.Logger = logging.getLogger(__name__),
 ) -> str:
-    # 仮：外部API呼び出し
-    response = requests.post(search_url, json={"query": query, "top_k": 5})
-    if response.status_code == 200:
-        data = response.json()
-        summaries = f"{data}"
+    # 外部API呼び出し（プール済み接続・タイムアウト・TTLキャッシュ付き。複数の問いは同時に検索する）
+    sub_questions = split_sub_questions(query)
+    try:
+        if len(sub_questions) == 1:
+            data = search_client.search(sub_questions[0], top_k=5)
+        else:
+            data = [
+                {"query": q, "error": str(r)} if isinstance(r, Exception) else r
+                for q, r in zip(sub_questions, search_client.search_many(sub_questions, top_k=5))
+            ]
+    except SearchError as e:
+        logger.warning(f"{e}")
+        data = None
+    if data is not None:
+        # 関連度の高い文書だけをトークン予算内に詰めてから要約に渡す
+        # 複数の問いを検索した場合は、最上位の1件だけを返すと他の問いへの答えが落ちるので必ず要約に回す
+        direct_max_tokens = SEARCH_DIRECT_MAX_TOKENS if len(sub_questions) == 1 else 0
+        context = select_context(query, data, budget=SEARCH_CONTEXT_TOKENS, direct_max_tokens=direct_max_tokens)
+        if not context.passages:
+            return "関連する検索結果が見つかりませんでした。"
+        if context.direct is not None:
+            # 最上位の文書が十分短い場合はLLM要約を省略してそのまま返す
+            logger.info(f"検索結果（要約なし）: {context.direct}")
+            return context.direct
+        summaries = context.text
 
         logger.info(f"検索結果: {summaries}")
 
@@ -62,7 +96,7 @@ def external_search_api(
             SystemMessage(content="以下の検索結果を、ユーザーの質問に関連するポイントを絞って要約してください。"),
             HumanMessagePromptTemplate.from_template("ユーザー質問: {query}\n検索結果:\n{summaries}")
         ])
-        summary_chain = prompt | llm
+        summary_chain = prompt | with_cache(search_summary_llm)
         summary = summary_chain.invoke({"query": query, "summaries": summaries}).content
 
         return summary
@@ -90,7 +124,7 @@ for name, cfg in agent_definitions.items():
             SystemMessage(content=cfg["system_prompt"]),
             HumanMessagePromptTemplate.from_template("{input}")
         ])
-        chain = prompt | llm
+        chain = prompt | tool_llm
 
         def make_tool(chain):
             return Tool(
@@ -105,15 +139,19 @@ for name, cfg in agent_definitions.items():
 
 
 from langchain.agents import initialize_agent, AgentType
+from deadline import executor_limits, start_deadline
 
 agent_executor = initialize_agent(
     tools=agent_tools,
     llm=llm,
     agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-    verbose=True
+    verbose=True,
+    # ステップ数と実行時間の上限（AGENT_MAX_ITERATIONS / AGENT_MAX_EXECUTION_TIME）
+    **executor_limits(),
 )
 
-# 実行
+# 実行（検索APIやLLMへのリクエストはTURN_DEADLINEの残り時間をタイムアウトにする）
+start_deadline()
 result = agent_executor.invoke(
     # input = "新しい社員研修制度を考えたい。どう整理し、考え始めるべき？"
     input="トラブル事例を調べてまとめて"